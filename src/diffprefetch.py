@@ -0,0 +1,122 @@
+""" Background prefetch of file diffs around the table cursor.
+"""
+import collections
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def text_size(text):
+    # Diffs are decoded with surrogateescape, undecodable bytes count once.
+    return len(text.encode(errors='surrogateescape'))
+
+
+class DiffCache:
+    """ LRU cache of diff texts bounded by their total size in bytes. """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        value_size = text_size(value)
+        if value_size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= text_size(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += value_size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= text_size(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class DiffPrefetcher:
+    """
+    Loads diffs of the focused row and its neighbours with a worker thread.
+
+    fetch_fn(fp, is_wanted, cancel) returns the diff text of a file and may
+    give up early by returning None once is_wanted() turns false, which
+    happens when the cursor has moved away from the row. The threading.Event
+    cancel is set then as well, to stop a git command already running.
+    """
+
+    def __init__(self, fetch_fn, max_bytes):
+        self.fetch_fn = fetch_fn
+        self.cache = DiffCache(max_bytes)
+        self.wanted = []
+        self.neighbourhood = set()
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.fetching = None
+        self.cancel = threading.Event()
+        worker = threading.Thread(target=self.run, daemon=True)
+        worker.start()
+
+    def focus(self, filepaths):
+        """ Replaces the queue, nearest rows first. """
+        with self.condition:
+            self.neighbourhood = set(filepaths)
+            if self.fetching not in self.neighbourhood:
+                self.cancel.set()
+            self.wanted = [fp for fp in filepaths
+                           if self.cache.get(fp) is None]
+            self.condition.notify()
+
+    def get(self, fp):
+        return self.cache.get(fp)
+
+    def put(self, fp, text):
+        self.cache.put(fp, text)
+
+    def clear(self):
+        with self.condition:
+            self.generation += 1
+            self.wanted = []
+            self.neighbourhood = set()
+            self.cancel.set()
+            self.cache.clear()
+
+    def is_wanted(self, fp, generation):
+        with self.condition:
+            return (generation == self.generation and
+                    fp in self.neighbourhood)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.wanted:
+                    self.condition.wait()
+                fp = self.wanted.pop(0)
+                generation = self.generation
+                self.fetching = fp
+                cancel = self.cancel = threading.Event()
+            if self.cache.get(fp) is None:
+                try:
+                    text = self.fetch_fn(
+                        fp, lambda: self.is_wanted(fp, generation), cancel)
+                except Exception:
+                    # The diff is loaded again when its row is opened, the
+                    # worker goes on with the other rows.
+                    logger.exception('Prefetching the diff of %s failed', fp)
+                    text = None
+                with self.condition:
+                    self.fetching = None
+                    if text is not None and generation == self.generation:
+                        self.cache.put(fp, text)
@@ -2,28 +2,195 @@
 """
 import inspect
 import json
+import os
+import queue
 import sys
+import threading
+import time
+import urllib.request
 
+import utils
 from utils import run_cmd
 
+DEFAULT_CACHE_NAME = 'gitradar-envs.json'
 
-def build__environment__version(envs, map_version_to_tag):
+# Versions fetched less than cache_ttl seconds ago are not asked again, and
+# each environment gets query_timeout seconds to answer. The cache is
+# DEFAULT_CACHE_NAME in the git directory unless cache_path is set.
+cache_path = None
+cache_ttl = 300
+query_timeout = 10
+
+
+class ProviderRegistry:
+    """
+    Sources of the version deployed to an environment.
+
+    A provider is fn(env) returning the version running in env, or None
+    when it does not know env. Providers are asked in the order added, the
+    first version found is used.
+    """
+
+    def __init__(self):
+        self.providers = []
+
+    def add_provider(self, name, fn):
+        self.providers = [p for p in self.providers if p[0] != name]
+        self.providers.append((name, fn))
+
+
+providers = ProviderRegistry()
+
+
+def http_provider(url_template):
+    """
+    Reads the version from url_template with {env} replaced, either plain
+    text or JSON with a version field.
+    """
+    def fetch(env):
+        url = url_template.format(env=env)
+        with urllib.request.urlopen(url,
+                                    timeout=utils.remaining_time()) as r:
+            body = r.read().decode().strip()
+        if body.startswith('{'):
+            return json.loads(body).get('version')
+        return body or None
+    return fetch
+
+
+try:
+    # Custom providers register themselves into providers on import.
+    import customizedenvs
+except ModuleNotFoundError:
+    customizedenvs = None
+
+if hasattr(customizedenvs, 'build__environment__version'):
+    # The former hook mapping all environments at once, asked per
+    # environment here so that environments are queried concurrently.
+    providers.add_provider(
+        'customizedenvs',
+        lambda env: customizedenvs.build__environment__version(
+            [env], lambda version: version).get(env))
+
+
+class EnvironmentCache:
+    """ Versions of environments with the time they were fetched. """
+
+    def __init__(self, path=None, ttl=300):
+        self.path = path or utils.git_path(DEFAULT_CACHE_NAME)
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def versions(self, envs):
+        """ Versions known for envs, also those older than ttl. """
+        with self.lock:
+            return {env: self.entries[env][0] for env in envs
+                    if env in self.entries}
+
+    def stale(self, envs):
+        now = time.time()
+        with self.lock:
+            return [env for env in envs if env not in self.entries or
+                    now - self.entries[env][1] >= self.ttl]
+
+    def update(self, environment__version):
+        now = time.time()
+        with self.lock:
+            for env, version in environment__version.items():
+                self.entries[env] = [version, now]
+            try:
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp, self.path)
+            except OSError:
+                # e.g. outside a repository, the versions are asked again.
+                pass
+
+
+def query_environments(envs, timeout=None):
+    """
+    Asks the providers about all environments at the same time.
+    :return: dict of env -> version of the environments which answered
+             within timeout seconds
+    """
+    timeout = query_timeout if timeout is None else timeout
+    answers = queue.Queue()
+
+    def query(env):
+        version = None
+        try:
+            with utils.deadline(timeout):
+                for name, fn in providers.providers:
+                    version = fn(env)
+                    if version:
+                        break
+        except Exception:
+            # Unreachable or timed out, labels go without the environment.
+            version = None
+        answers.put((env, version))
+
+    for env in envs:
+        threading.Thread(target=query, args=(env,), daemon=True).start()
     environment__version = {}
-    # customize this with your specific part
+    end = time.monotonic() + timeout
+    for _ in envs:
+        try:
+            env, version = answers.get(timeout=max(0, end -
+                                                   time.monotonic()))
+        except queue.Empty:
+            break
+        if version:
+            environment__version[env] = version
+    return environment__version
 
-    try:
-        from customizedenvs import build__environment__version as custom_envs
-        return custom_envs(envs, map_version_to_tag)
-    except ModuleNotFoundError:
+
+def environment_cache():
+    return EnvironmentCache(cache_path, cache_ttl)
+
+
+def refresh_environments(envs, on_done):
+    """
+    Asks the providers about environments not asked within cache_ttl in a
+    background thread, on_done() is called from it once the cache has
+    their versions.
+    """
+    def refresh():
+        cache = environment_cache()
+        cache.update(query_environments(cache.stale(envs)))
+        on_done()
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def build__environment__version(envs, map_version_to_tag, wait=True):
+    """
+    :param wait: ask the providers about environments with outdated
+                 versions first, otherwise the cached versions are used
+    :return: dict of env -> version tag
+    """
+    if envs and not providers.providers:
         print('No customization available')
-    return environment__version
+        return {}
+    cache = environment_cache()
+    stale = cache.stale(envs)
+    if wait and stale:
+        cache.update(query_environments(stale))
+    return {env: map_version_to_tag(version)
+            for env, version in cache.versions(envs).items()}
 
 
 def build__version__commit(environment__version):
     version__commit = {}
     for version in environment__version.values():
 
-        for line in run_cmd(f'git rev-list -n 1 {version}',
+        for line in run_cmd(['git', 'rev-list', '-n', '1', version],
                             inspect.stack()[0][0].f_code.co_name):
             version__commit[version] = line
             """
@@ -1,17 +1,36 @@
-# noinspection PyUnresolvedReferences
+import time
+
+started_at = time.perf_counter()
+
 import logging
 import os
+import sys
 from optparse import OptionParser
 
-from panwid.datatable import *
-from panwid.listbox import ScrollingListBox
-from urwid_utils.palette import *
-
+import environmentindex
 from environmentindex import build__environment__version, \
-    build__version__commit
-from gitradartablebox import GitRadarTableBox
+    build__version__commit, http_provider
+import ownership
+from pathscope import IGNORE_FILE, build_path_scope
+import snapshotstore
+from snapshotstore import SnapshotStore
+from radarsnapshot import RadarSnapshot, write_snapshot
+from radardaemon import RadarClient, RadarState, default_socket_path, serve
 from stages import stage_names, stage_shortnames
-from workspaceindex import analyze_changes
+from startupprofile import StartupProfile
+from uilatency import LatencyRecorder
+import utils
+import workspaceindex
+from workspaceindex import analyze_changes, analyze_changes_diff, \
+    describe_commits, fetch_remotes
+
+# Suffix of the label of a stage whose git commands timed out.
+TIMED_OUT_MARK = '!'
+
+# Stages whose column label lists the environments running them.
+ENV_LABELED_STAGES = ['pushed_but_not_merged', 'in_merged_prs_not_released',
+                      'in_last_production_release',
+                      'in_previous_production_release']
 
 
 def init_settings(main_branch='', dev_branch=''):
@@ -69,9 +88,80 @@ def invert_dict(x):
     return y
 
 
+def build_stage_labels(stage_names, stage_data, envs, wait=True):
+    """
+    :param wait: ask the environments first instead of using the versions
+                 cached from earlier runs
+    :return: dict of stage name -> column label with the release version
+             and the environments running it
+    """
+    def map_version_to_tag(version):
+        if version.startswith('v'):
+            return version[1:]
+        return version
+
+    environment__version = build__environment__version(envs,
+                                                       map_version_to_tag,
+                                                       wait)
+    version__environments = invert_dict(environment__version)
+    version__commit = build__version__commit(environment__version)
+    commit__versions = invert_dict(version__commit)
+
+    labels = {}
+    for s in stage_names:
+        label = stage_shortnames.get(s, s)
+        if 'version_number' in stage_data[s]:
+            label += ' ' + stage_data[s]['version_number']
+        if s in ENV_LABELED_STAGES:
+            label += get_possible_matching_envs(environment__version,
+                                                version__environments,
+                                                commit__versions,
+                                                stage_data[s], None)
+        if stage_data[s].get('timed_out'):
+            label += TIMED_OUT_MARK
+        labels[s] = label
+    return labels
+
+
+def load_score_files():
+    try:
+        from hotspotscore import score_files
+    except ModuleNotFoundError:
+        return None
+    return score_files
+
+
+def print_headless(stage_names, stage_data, filepaths, history=None,
+                   sort_by_score=False):
+    score_files = load_score_files()
+    scores = None
+    if score_files:
+        scores = score_files(stage_names, stage_data, filepaths,
+                             history=history)
+    timed_out = [s for s in stage_names if stage_data[s].get('timed_out')]
+    if timed_out:
+        print('Timed out, shown without files: ' + ', '.join(timed_out),
+              file=sys.stderr)
+    print('\t'.join(['file'] + [stage_shortnames.get(s, s) +
+                                (TIMED_OUT_MARK if s in timed_out else '')
+                                for s in stage_names] +
+                    (['score', 'churn_rank', 'cochange'] if scores else [])))
+    stage_files = {s: set(stage_data[s]['filepaths']) for s in stage_names}
+    order = range(len(filepaths))
+    if scores and sort_by_score:
+        order = (-scores['score']).argsort(kind='stable')
+    for i in order:
+        filepath = filepaths[i]
+        columns = [filepath] + ['x' if filepath in stage_files[s]
+                                else ' ' for s in stage_names]
+        if scores:
+            columns += [str(scores['score'][i]),
+                        str(scores['churn_rank'][i]),
+                        str(int(scores['cochange'][i]))]
+        print('\t'.join(columns))
+
+
 def main():
-    os.system('echo "Running git fetch" && git fetch')
-    os.system('echo "Running git fetcth upstream" && git fetch upstream')
     logger = logging.getLogger(__name__)
     parser = OptionParser()
     parser.add_option("-d", "--dir", dest="dir", help="git repo dir",
@@ -80,33 +170,249 @@ def main():
     parser.add_option("-e", "--environment", action="append",
                       dest="environments"),
     parser.add_option('-D', '--debug', action="store_true", default=True)
+    parser.add_option("--daemon", action="store_true", default=False,
+                      help="keep analysis warm and serve it over a socket")
+    parser.add_option("--attach", action="store_true", default=False,
+                      help="use the data of a running daemon")
+    parser.add_option("--socket", dest="socket", metavar="PATH",
+                      help="daemon socket, default gitradar.sock in the "
+                           "git directory")
+    parser.add_option("--refresh-interval", dest="refresh_interval",
+                      type="int", default=300,
+                      help="seconds between daemon refreshes")
+    parser.add_option("--headless", action="store_true", default=False,
+                      help="print the stage matrix instead of the UI")
+    parser.add_option("--find-renames", action="store_true", default=False,
+                      help="show renamed files as one row")
+    parser.add_option("--rename-limit", dest="rename_limit", type="int",
+                      default=workspaceindex.rename_limit,
+                      help="max files for inexact rename detection")
+    parser.add_option("--diff-cache-mb", dest="diff_cache_mb", type="int",
+                      default=32,
+                      help="memory for prefetched diffs, 0 disables")
+    parser.add_option("--diff-size-kb", dest="diff_size_kb", type="int",
+                      default=workspaceindex.diff_size_limit // 1024,
+                      help="larger files show their size change until "
+                           "More is pressed, default 512")
+    parser.add_option("--diff-lines", dest="diff_lines", type="int",
+                      default=workspaceindex.diff_line_limit,
+                      help="lines of diffs shown at a time, default 500")
+    parser.add_option("--path", action="append", dest="paths",
+                      metavar="DIR", help="only show changes under DIR")
+    parser.add_option("--exclude", action="append", dest="excludes",
+                      metavar="PATTERN",
+                      help="drop files matching a gitignore style pattern")
+    parser.add_option("--exclude-from", dest="exclude_from", metavar="FILE",
+                      help="exclude patterns, default " + IGNORE_FILE)
+    parser.add_option("--history-db", dest="history_db", metavar="FILE",
+                      help="run history, default " +
+                           snapshotstore.DEFAULT_DB_NAME +
+                           " in the git directory")
+    parser.add_option("--record", action="store_true", default=False,
+                      help="append this run to the history")
+    parser.add_option("--hotspots", dest="hotspots", metavar="STAGE",
+                      help="list files often in STAGE according to history")
+    parser.add_option("--weeks", dest="weeks", type="int", default=12,
+                      help="weeks of history for --hotspots")
+    parser.add_option("--min-weeks", dest="min_weeks", type="int",
+                      default=4,
+                      help="weeks a file must appear in for --hotspots")
+    parser.add_option("--sort-by-score", action="store_true", default=False,
+                      help="order --headless output by hotspot score")
+    parser.add_option("--fast-status", action="store_true", default=False,
+                      help="use git's untracked cache and fsmonitor")
+    parser.add_option("--compare", action="append", dest="compare",
+                      metavar="REF",
+                      help="add a column for a ref or range A..B")
+    parser.add_option("--startup-profile", action="store_true",
+                      default=False,
+                      help="report time spent until the first frame")
+    parser.add_option("--export-snapshot", dest="export_snapshot",
+                      metavar="FILE",
+                      help="write the radar to FILE for browsing elsewhere")
+    parser.add_option("--export-diffs", action="store_true", default=False,
+                      help="include diffs in --export-snapshot")
+    parser.add_option("--snapshot", dest="snapshot", metavar="FILE",
+                      help="browse a snapshot without running git")
+    parser.add_option("--submodules", action="store_true", default=False,
+                      help="show changes inside submodules")
+    parser.add_option("--jobs", dest="jobs", type="int",
+                      default=workspaceindex.submodule_jobs,
+                      help="submodules analyzed at the same time")
+    parser.add_option("--fetch-timeout", dest="fetch_timeout", type="int",
+                      default=workspaceindex.fetch_timeout,
+                      help="seconds git fetch may take, 0 waits forever")
+    parser.add_option("--timeout", dest="timeout", type="int",
+                      default=workspaceindex.git_timeout,
+                      help="seconds a stage or diff may take, 0 waits "
+                           "forever")
+    parser.add_option("--owners", action="store_true", default=False,
+                      help="add a column with the top author by git blame")
+    parser.add_option("--owners-db", dest="owners_db", metavar="FILE",
+                      help="blame cache, default " +
+                           ownership.DEFAULT_DB_NAME + " in the git directory")
+    parser.add_option("--env-url", dest="env_url", metavar="URL",
+                      help="URL telling the version of an -e environment, "
+                           "{env} is replaced by its name")
+    parser.add_option("--env-ttl", dest="env_ttl", type="int",
+                      default=environmentindex.cache_ttl,
+                      help="seconds environment versions are cached")
+    parser.add_option("--env-timeout", dest="env_timeout", type="int",
+                      default=environmentindex.query_timeout,
+                      help="seconds an environment may take to answer")
+    parser.add_option("--latency-log", dest="latency_log", metavar="FILE",
+                      help="record keypress and frame latency to FILE, "
+                           "shown with meta l")
+    parser.add_option("--minimal-redraw", action="store_true", default=False,
+                      help="write only the changed cells of the screen and "
+                           "report the bytes per frame, e.g. over slow SSH")
+    parser.add_option("--max-fps", dest="max_fps", type="int", default=10,
+                      help="frames per second with --minimal-redraw, 0 "
+                           "for no limit, default 10")
     (options, args) = parser.parse_args()
+    if options.snapshot and (options.export_snapshot or options.record or
+                             options.attach or options.daemon or
+                             options.hotspots):
+        parser.error('--snapshot only browses a snapshot')
+    if options.max_fps < 0:
+        parser.error('--max-fps must be 0 or more')
+    profile = StartupProfile(started_at)
+    profile.mark('imports')
     os.chdir(options.dir)
+    workspaceindex.find_renames = options.find_renames
+    workspaceindex.rename_limit = options.rename_limit
+    workspaceindex.status_accelerators = options.fast_status
+    workspaceindex.recurse_submodules = options.submodules
+    workspaceindex.submodule_jobs = options.jobs
+    workspaceindex.fetch_timeout = options.fetch_timeout
+    workspaceindex.git_timeout = options.timeout
+    workspaceindex.debug = options.verbose > 0
+    workspaceindex.diff_size_limit = options.diff_size_kb * 1024
+    workspaceindex.diff_line_limit = options.diff_lines
     envs = options.environments if options.environments is not None else []
+    environmentindex.cache_ttl = options.env_ttl
+    environmentindex.query_timeout = options.env_timeout
+    if options.env_url:
+        environmentindex.providers.add_provider(
+            'url', http_provider(options.env_url))
+    socket_path = history_db = None
+    # Browsing a snapshot runs no git command, not even to find the
+    # repository.
+    if not options.snapshot:
+        workspaceindex.path_scope = build_path_scope(options.paths,
+                                                     options.excludes,
+                                                     options.exclude_from,
+                                                     utils.git_toplevel())
+        socket_path = options.socket or default_socket_path()
+        history_db = options.history_db or snapshotstore.default_db_path()
 
     model = init_settings()
     main_branch, dev_branch, stage_names, stage_shortnames = model
-    stage_names, stage_data, filepaths = analyze_changes(main_branch,
-                                                         dev_branch,
-                                                         stage_names)
 
-    def map_version_to_tag(version):
-        if version.startswith('v'):
-            return version[1:]
-        return version
-
-    environment__version = build__environment__version(envs,
-                                                       map_version_to_tag)
-    version__environments = invert_dict(environment__version)
-    version__commit = build__version__commit(environment__version)
-    commit__versions = invert_dict(version__commit)
-
-    last_prod_version = stage_data['in_last_production_release'][
-        'version_number']
-    prev_prod_version = stage_data['in_previous_production_release'][
-        'version_number']
+    if options.hotspots:
+        stage_name = {v: k for k, v in stage_shortnames.items()}.get(
+            options.hotspots, options.hotspots)
+        store = SnapshotStore(history_db)
+        for filepath, weeks in store.hotspots(stage_name, options.min_weeks,
+                                              options.weeks):
+            print('{}\t{}'.format(weeks, filepath))
+        store.close()
+        return
+
+    if options.daemon:
+        serve(socket_path, RadarState(main_branch, dev_branch, stage_names,
+                                      options.refresh_interval))
+        return
+
+    radar_client = None
+    snapshot = None
+    stage_data = None
+    filepaths = None
+    if options.snapshot:
+        with profile.phase('analysis'):
+            snapshot = RadarSnapshot(options.snapshot)
+            stage_names = snapshot.stage_names
+            if options.headless:
+                stage_names, stage_data, filepaths = snapshot.to_analysis()
+    elif options.attach:
+        radar_client = RadarClient(socket_path)
+        with profile.phase('analysis'):
+            stage_names, stage_data, filepaths = \
+                radar_client.analyze_changes()
+    else:
+        with profile.phase('fetch'):
+            fetch_remotes()
+        with profile.phase('analysis'):
+            stage_names, stage_data, filepaths = analyze_changes(main_branch,
+                                                                 dev_branch,
+                                                                 stage_names)
+
+    if options.record:
+        store = SnapshotStore(history_db)
+        store.record(stage_names, stage_data)
+        store.close()
+
+    score_history = None
+    if history_db and os.path.exists(history_db):
+        store = SnapshotStore(history_db)
+        score_history = store.presence_counts(options.weeks)
+        store.close()
+
+    if options.export_snapshot:
+        scores = None
+        score_files = load_score_files()
+        if score_files:
+            scores = score_files(stage_names, stage_data, filepaths,
+                                 history=score_history)['score']
+
+        def diff_fn(stage_name, fp):
+            try:
+                if radar_client:
+                    return radar_client.diff(stage_name, fp)
+                with workspaceindex.git_deadline():
+                    return analyze_changes_diff(stage_name, main_branch,
+                                                dev_branch, fp,
+                                                stage_data[stage_name])
+            except utils.CommandTimeout:
+                return '(diff timed out)\n'
+
+        write_snapshot(options.export_snapshot, stage_names, stage_data,
+                       filepaths,
+                       labels=build_stage_labels(stage_names, stage_data,
+                                                 envs),
+                       scores=scores,
+                       describe_fn=describe_commits,
+                       diff_fn=diff_fn if options.export_diffs else None)
+        return
+
+    if options.headless:
+        print_headless(stage_names, stage_data, filepaths, score_history,
+                       options.sort_by_score)
+        if options.startup_profile:
+            profile.mark('output')
+            profile.report()
+        return
+
+    # The UI modules are only needed from here on, not for the other modes.
+    with profile.phase('ui imports'):
+        import urwid
+        from panwid.datatable import DataTable, DataTableColumn
+        from panwid.listbox import ScrollingListBox
+        from urwid_utils.palette import Palette, PaletteEntry
+        from gitradartable import score_files
+        from gitradartablebox import GitRadarTableBox
+        from uiredraw import MinimalRedrawScreen, cap_frame_rate
+
+    with profile.phase('environments'):
+        if snapshot:
+            labels = snapshot.labels
+        else:
+            # Environments are asked in the background once the UI is
+            # up, the labels are updated then.
+            labels = build_stage_labels(stage_names, stage_data, envs,
+                                        wait=False)
 
-    if options.debug:
+    if options.debug and stage_data is not None:
         for s in stage_names:
             for k, v in stage_data[s].items():
                 if k == 'commits':
@@ -148,7 +454,10 @@ def main():
     entries.update(DataTable.get_palette_entries(user_entries=attr_entries))
     palette = Palette("default", **entries)
 
-    screen = urwid.raw_display.Screen()
+    if options.minimal_redraw:
+        screen = MinimalRedrawScreen()
+    else:
+        screen = urwid.raw_display.Screen()
     # screen.set_terminal_properties(1<<24)
     screen.set_terminal_properties(256)
 
@@ -158,22 +467,21 @@ def main():
     NORMAL_FG_256 = "light gray"
     NORMAL_BG_256 = "g0"
 
-    def env_matcher(stage):
-        return get_possible_matching_envs(environment__version,
-                                          version__environments,
-                                          commit__versions, stage_data[stage],
-                                          None)
-
-    e1 = env_matcher('in_previous_production_release')
-    e2 = env_matcher('in_last_production_release')
-    e3 = env_matcher('pushed_but_not_merged')
-    e4 = env_matcher('in_merged_prs_not_released')
     COLUMNS = [
         # DataTableColumn("uniqueid", width=10, align="right", padding=1),
+        DataTableColumn("marked", label="*", width=2, padding=0),
         DataTableColumn("file", label="File", width=78),
+        DataTableColumn(
+            "untracked",
+            label=labels['untracked'],
+            width=10,
+            align="right",
+            sort_reverse=True,
+            sort_icon=False,
+            padding=1),
         DataTableColumn(
             "unstaged",
-            label=stage_shortnames['unstaged'],
+            label=labels['unstaged'],
             width=10,
             align="right",
             sort_key=lambda v: (v is None, v),
@@ -183,7 +491,7 @@ def main():
                 v for v in values if v is not None)),
         DataTableColumn(
             "staged",
-            label=stage_shortnames['staged'],
+            label=labels['staged'],
             width=10,
             align="right",
             sort_reverse=True,
@@ -191,7 +499,7 @@ def main():
             padding=1),  # margin=5),
         DataTableColumn(
             "in_commits_but_not_pushed",
-            label=stage_shortnames['in_commits_but_not_pushed'],
+            label=labels['in_commits_but_not_pushed'],
             width=10,
             align="right",
             sort_reverse=True,
@@ -199,7 +507,7 @@ def main():
             padding=1),  # margin=5),
         DataTableColumn(
             "pushed_but_not_merged",
-            label=stage_shortnames['pushed_but_not_merged'] + e3,
+            label=labels['pushed_but_not_merged'],
             width=10,
             align="right",
             sort_reverse=True,
@@ -207,7 +515,7 @@ def main():
             padding=1),  # margin=5),
         DataTableColumn(
             "in_merged_prs_not_released",
-            label=stage_shortnames['in_merged_prs_not_released'] + e4,
+            label=labels['in_merged_prs_not_released'],
             width=10,
             align="right",
             sort_reverse=True,
@@ -215,8 +523,7 @@ def main():
             padding=1),  # margin=5),
         DataTableColumn(
             "in_last_production_release",
-            label=stage_shortnames[
-                      'in_last_production_release'] + ' ' + last_prod_version + e2,
+            label=labels['in_last_production_release'],
             width=10,
             align="right",
             sort_reverse=True,
@@ -224,13 +531,35 @@ def main():
             padding=1),  # margin=5),
         DataTableColumn(
             "in_previous_production_release",
-            label=stage_shortnames[
-                      'in_previous_production_release'] + ' ' + prev_prod_version + e1,
+            label=labels['in_previous_production_release'],
             width=10,
             align="right",
             sort_reverse=True,
             sort_icon=False,
             padding=1),  # margin=5),
+        DataTableColumn(
+            "score",
+            label="score",
+            width=8,
+            align="right",
+            sort_reverse=True,
+            sort_icon=False,
+            padding=1,
+            hide=score_files is None),
+        DataTableColumn(
+            "commits",
+            label="commits",
+            width=8,
+            align="right",
+            sort_reverse=True,
+            sort_icon=False,
+            padding=1),
+        DataTableColumn(
+            "owner",
+            label="owner",
+            width=20,
+            padding=1,
+            hide=not options.owners or snapshot is not None),
         DataTableColumn(
             "qux",
             label=urwid.Text([("red", "q"), ("green", "u"), ("blue", "x")]),
@@ -239,26 +568,55 @@ def main():
         # DataTableColumn("empty", label="empty", width=5),
     ]
 
-    def detail_fn(data):
+    # Custom stages from stages.registry get plain columns.
+    known_columns = [c.name for c in COLUMNS]
+    first_extra = known_columns.index("score")
+    for stage_name in stage_names:
+        if stage_name not in known_columns:
+            COLUMNS.insert(first_extra, DataTableColumn(
+                stage_name,
+                label=labels.get(stage_name, stage_name),
+                width=10,
+                align="right",
+                sort_reverse=True,
+                sort_icon=False,
+                padding=1))
+            first_extra += 1
 
-        return urwid.Padding(
-            urwid.Columns([
-                ("weight", 1, data.get("qux")),
-                ("weight", 1, urwid.Text(str(data.get("file_len")))),
-                ("weight", 1, urwid.Text(str(data.get("xyzzy")))),
-            ]))
-
-    grtb = GitRadarTableBox(
-        COLUMNS,
-        logger,
-        model,
-        33,
-        index="uniqueid",
-        detail_fn=detail_fn,
-        # detail_column="staged", outcommented by Ville 2020/09
-        cell_selection=True,
-        sort_refocus=True,
-        sort_by="file")
+    def detail_fn(data):
+        return grtb.table.detail_widget(data)
+
+    latency = None
+    if options.latency_log:
+        latency = LatencyRecorder(
+            options.latency_log,
+            written=(lambda: screen.written) if options.minimal_redraw
+            else None)
+
+    with profile.phase('table'):
+        grtb = GitRadarTableBox(
+            COLUMNS,
+            logger,
+            model,
+            33,
+            index="uniqueid",
+            detail_fn=detail_fn,
+            # detail_column="staged", outcommented by Ville 2020/09
+            cell_selection=True,
+            sort_refocus=True,
+            sort_by="file",
+            radar_client=radar_client,
+            snapshot=snapshot,
+            owners_db=(options.owners_db or ownership.default_db_path())
+            if options.owners and snapshot is None else None,
+            diff_cache_bytes=options.diff_cache_mb * 1024 * 1024,
+            score_history=score_history,
+            latency=latency,
+            envs=envs,
+            labels_fn=lambda stage_names, stage_data: build_stage_labels(
+                stage_names, stage_data, envs, wait=False),
+            analysis=(stage_names, stage_data, filepaths)
+            if snapshot is None else None)
 
     boxes = [grtb]
 
@@ -289,12 +647,47 @@ def main():
         screen=screen,
         unhandled_input=global_input)
 
+    draw_screen = main.draw_screen
+    if latency is not None:
+        untimed_draw_screen = main.draw_screen
+        process_input = main.process_input
+
+        def process_timed_input(keys):
+            latency.input_received(keys)
+            return process_input(keys)
+
+        def draw_screen():
+            latency.draw(untimed_draw_screen)
+
+        main.process_input = process_timed_input
+
+    if options.minimal_redraw:
+        draw_screen = cap_frame_rate(main, draw_screen, options.max_fps)
+
+    def draw_first_frame():
+        draw_screen()
+        profile.mark('first frame')
+        main.draw_screen = draw_screen
+
+    main.draw_screen = draw_first_frame
+
     try:
         grtb.loop = main
         grtb._body = main_frame
+        for spec in options.compare or []:
+            grtb.table.add_comparison(spec)
+        grtb.table.request_owners(0)
+        if snapshot is None:
+            grtb.table.refresh_labels()
         main.run()
     finally:
         screen.tty_signal_keys(*old_signal_keys)
+        if options.startup_profile:
+            profile.report()
+        if latency is not None:
+            latency.close()
+        if options.minimal_redraw:
+            print('\n'.join(screen.report_lines()), file=sys.stderr)
 
 
 if __name__ == "__main__":
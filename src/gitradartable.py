@@ -4,15 +4,31 @@ import logging
 logger = logging.getLogger(__name__)
 from panwid.datatable import *
 from urwid_utils.palette import *
+import contextlib
+import os
 import random
+import re
 import string
+import tempfile
+import threading
 
-from workspaceindex import analyze_changes, analyze_changes_unstaged_diff, \
-    analyze_changes_staged_diff, \
-    analyze_changes_in_commits_but_not_pushed_diff, \
-    analyze_changes_in_recent_production_release_diff, \
-    analyze_changes_pushed_but_not_merged_diff, \
-    analyze_changes_in_merged_prs_not_released_diff
+import utils
+import workspaceindex
+from diffprefetch import DiffPrefetcher
+from environmentindex import refresh_environments
+from ownership import OwnershipResolver, owner_label
+from stages import stage_shortnames
+try:
+    from hotspotscore import score_files
+except ModuleNotFoundError:
+    # NumPy is optional, without it there is no score column.
+    score_files = None
+from workspaceindex import analyze_changes, analyze_changes_diff, \
+    analyze__ref_comparison, commits_touching_file, comparison_stages, \
+    diff_blob_sizes, export_diffs, format_size, prefetch_diff_blobs, \
+    resolve_stages, size_summary, stage_commits_of_file
+
+BINARY_DIFF = re.compile(r'^Binary files .* differ$', re.MULTILINE)
 
 
 class DialogExit(Exception):
@@ -120,29 +136,132 @@ class ActionButton(urwid.Button):
                                 focus_map='reversed')
 
 
+class PromptEdit(urwid.Edit):
+    def __init__(self, caption, on_done):
+        super(PromptEdit, self).__init__(caption)
+        self.on_done = on_done
+
+    def keypress(self, size, key):
+        if key == 'enter':
+            self.on_done(self.edit_text)
+        elif key == 'esc':
+            self.on_done(None)
+        else:
+            return super(PromptEdit, self).keypress(size, key)
+
+
+class SnapshotRows:
+    """
+    Rows of a snapshot, built when the page showing them is queried.
+    """
+
+    def __init__(self, snapshot, make_row):
+        self.snapshot = snapshot
+        self.make_row = make_row
+        self.order = range(len(snapshot))
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.make_row(j) for j in self.order[i]]
+        return self.make_row(self.order[i])
+
+    def sort_by_field(self, field, reverse):
+        self.order = self.snapshot.order_by(field, reverse)
+
+
 class GitRadarTable(DataTable):
     columns = []
     index = "index"
 
-    def __init__(self, columns_, parent, model, num_rows=10, *args, **kwargs):
+    prefetch_behind = 1
+    prefetch_ahead = 3
+    # Snapshots are paged, only the rows scrolled to are read.
+    snapshot_page_rows = 200
+    # Owners are looked up for about a screen of rows around the cursor.
+    owners_behind = 10
+    owners_ahead = 40
+
+    def __init__(self, columns_, parent, model, num_rows=10, *args,
+                 radar_client=None, diff_cache_bytes=32 * 1024 * 1024,
+                 score_history=None, analysis=None, snapshot=None,
+                 owners_db=None, latency=None, envs=(), labels_fn=None,
+                 **kwargs):
+        """
+        :param analysis: (stage_names, stage_data, filepaths) of the analysis
+                         done at startup, shown instead of analyzing again
+        :param snapshot: RadarSnapshot to browse instead of the repository
+        :param owners_db: file caching owners, enables the owner column
+        :param latency: LatencyRecorder timing queries and row widgets
+        :param envs: environments asked for their versions on refresh
+        :param labels_fn: fn(stage names, stage data) returning the column
+                          labels, called once the environments answered
+        """
         self.num_rows = num_rows
+        self.latency = latency
+        self.envs = envs
+        self.labels_fn = labels_fn
         self.parent = parent
+        self.radar_client = radar_client
+        self.snapshot = snapshot
+        if snapshot is not None:
+            kwargs.setdefault('limit', self.snapshot_page_rows)
+        self.score_history = score_history
+        self.scores = None
+        self.owners = {}
+        self.marked = set()
+        self.timed_out_diffs = set()
+        self.summarized_diffs = set()
+        self.owner_updates = {}
+        self.owner_lock = threading.Lock()
+        self.owner_pipe = None
+        self.owner_resolver = None
+        if owners_db and snapshot is None:
+            self.owner_resolver = OwnershipResolver(
+                self.owner_found, owners_db,
+                timeout=workspaceindex.git_timeout)
+        self.prefetcher = None
+        if diff_cache_bytes > 0:
+            self.prefetcher = DiffPrefetcher(self.collect_diffs,
+                                             diff_cache_bytes)
         GitRadarTable.columns = columns_
         # indexes = random.sample(range(self.num_rows*2), num_rows)
         main_branch, dev_branch, stage_names, stage_shortnames = model
         self.main_branch = main_branch
         self.dev_branch = dev_branch
         self.stage_names = stage_names
-        self.load_data()
+        self.stage_data = {}
+        self.commit_details = {}
+        self.comparisons = []
+        self.reloading = False
+        self.load_data(analysis)
         self.last_rec = len(self.query_data)
         super(GitRadarTable, self).__init__(*args, **kwargs)
+        urwid.connect_signal(self, 'focus',
+                             lambda source, position: self.prefetch_around(
+                                 position))
+        urwid.connect_signal(self, 'focus',
+                             lambda source, position: self.request_owners(
+                                 position))
 
-    def load_data(self):
-        self.main_branch = 'master'
-        self.dev_branch = 'dev'
-        stage_names, stage_data, filepaths = analyze_changes(self.main_branch,
-                                                             self.dev_branch,
-                                                             self.stage_names)
+    def load_data(self, analysis=None):
+        if self.snapshot is not None:
+            self.stage_names = list(self.snapshot.stage_names)
+            self.query_data = SnapshotRows(self.snapshot, self.snapshot_row)
+            self.num_rows = len(self.query_data)
+            self.rows_by_file = {}
+            return
+        if analysis is None:
+            analysis = self.analyze()
+        stage_names, stage_data, filepaths = analysis
+        self.stage_names = stage_names
+        self.stage_data = stage_data
+        self.commit_details = {}
+        if score_files:
+            self.scores = score_files(stage_names, stage_data, filepaths,
+                                      history=self.score_history)
         stage_names_r = list(stage_names)
         stage_names_r.reverse()
 
@@ -163,15 +282,91 @@ class GitRadarTable(DataTable):
         indexes = list(range(len(filedata)))
 
         self.query_data = [
-            self.fill_row(indexes[i], filepaths, stage_names, stage_data,
-                          filedata)
+            self.fill_row(indexes[i], filepaths[i], stage_names, stage_data,
+                          filedata,
+                          float(self.scores['score'][indexes[i]])
+                          if self.scores else None)
             for i in range(len(filepaths))
             # self.random_row(i) for i in range(self.num_rows)
         ]
         random.shuffle(self.query_data)
+        self.rows_by_file = {row['file']: row for row in self.query_data}
+
+    def analyze(self):
+        """
+        Runs the stages and the comparison columns, which takes a while.
+        :return: stage names, stage data and file paths
+        """
+        registry_stages = [s for s in self.stage_names
+                           if not s.startswith('compare:')]
+        if not self.radar_client:
+            return analyze_changes(self.main_branch, self.dev_branch,
+                                   registry_stages,
+                                   comparisons=self.comparisons)
+        stage_names, stage_data, filepaths = \
+            self.radar_client.analyze_changes()
+        # The daemon does not know the comparisons of this client.
+        compared = comparison_stages(self.comparisons)
+        stage_data.update(resolve_stages({}, compared))
+        for stage_name in compared:
+            filepaths = sorted(set(filepaths).union(
+                stage_data[stage_name]['filepaths']))
+        return stage_names + compared, stage_data, filepaths
+
+    def reload(self):
+        """
+        Analyzes again in the background, the table shows the previous data
+        until the new one is loaded.
+        """
+        if self.reloading:
+            return
+        self.reloading = True
+        result = {}
+
+        def load(_):
+            os.close(pipe)
+            self.reloading = False
+            if 'error' in result:
+                self.dialog(' REFRESH FAILED ', [result['error']])
+                return False
+            stage_names, stage_data, filepaths = result['analysis']
+            # Comparisons added while analyzing keep their column.
+            for spec in self.comparisons:
+                stage_name = 'compare:' + spec
+                if stage_name not in stage_names:
+                    stage_names = stage_names + [stage_name]
+                    stage_data[stage_name] = self.stage_data[stage_name]
+                    filepaths = sorted(set(filepaths).union(
+                        stage_data[stage_name]['filepaths']))
+            if self.prefetcher:
+                self.prefetcher.clear()
+            if self.owner_resolver:
+                self.owner_resolver.reset()
+            self.load_data((stage_names, stage_data, filepaths))
+            self.reset(reset_sort=True)
+            self.refresh_labels()
+            timed_out = [stage_shortnames.get(s, s) for s in self.stage_names
+                         if self.stage_data.get(s, {}).get('timed_out')]
+            if timed_out:
+                self.dialog(' TIMED OUT ',
+                            ['Shown without files: ' + ', '.join(timed_out)])
+            return False
 
-    def fill_row(self, uniqueid, filepaths, stage_names, stage_data, filedata):
-        filepath = filepaths[uniqueid]
+        def analyze():
+            try:
+                if self.radar_client:
+                    self.radar_client.refresh()
+                result['analysis'] = self.analyze()
+            except Exception as e:
+                result['error'] = str(e) or type(e).__name__
+            # Wakes up the main loop which then loads the new data.
+            os.write(pipe, b'x')
+
+        pipe = self.parent.loop.watch_pipe(load)
+        threading.Thread(target=analyze, daemon=True).start()
+
+    def fill_row(self, uniqueid, filepath, stage_names, stage_data, filedata,
+                 score=None):
 
         # filedata = {}
         # filedata[filepath] = {'unstaged': 1234, 'staged': 1234}
@@ -183,21 +378,15 @@ class GitRadarTable(DataTable):
                 return ' '
             return x
 
-        return dict(
+        row = dict(
             uniqueid=uniqueid,
             file=filepath,
-            in_previous_production_release=get_val(
-                filedata[filepath]['in_previous_production_release']),
-            in_last_production_release=get_val(
-                filedata[filepath]['in_last_production_release']),
-            in_merged_prs_not_released=get_val(
-                filedata[filepath]['in_merged_prs_not_released']),
-            pushed_but_not_merged=get_val(
-                filedata[filepath]['pushed_but_not_merged']),
-            in_commits_but_not_pushed=get_val(
-                filedata[filepath]['in_commits_but_not_pushed']),
-            unstaged=get_val(filedata[filepath]['unstaged']),
-            staged=get_val(filedata[filepath]['staged']),
+            score=score,
+            commits=len(set(c for s in stage_names
+                            for c in stage_commits_of_file(stage_data[s],
+                                                           filepath))),
+            owner=self.owners.get(filepath, ''),
+            marked='*' if filepath in self.marked else '',
             qux=urwid.Text([("red", "1"), ("green", "2"), ("blue", "3")]),
             xyzzy=("%0.1f" % (random.uniform(0, 100)) if random.randint(0,
                                                                         5) else None),
@@ -208,6 +397,67 @@ class GitRadarTable(DataTable):
             d=dict(e=dict(f=random.randint(0, 100))),
             color=["red", "green", "blue"][random.randrange(3)],
         )
+        for stage_name in stage_names:
+            row[stage_name] = get_val(filedata[filepath].get(stage_name, 0))
+        return row
+
+    def snapshot_row(self, i):
+        row = self.snapshot.row(i)
+        row.update(
+            qux=urwid.Text([("red", "1"), ("green", "2"), ("blue", "3")]),
+            color=["red", "green", "blue"][i % 3],
+            marked='*' if row['file'] in self.marked else '',
+        )
+        return row
+
+    def get_commit_details(self, filepath):
+        """
+        Commits per stage touching the file, fetched on first expansion of
+        its detail row only.
+        """
+        if filepath not in self.commit_details and self.snapshot is not None:
+            i = self.snapshot.index_of(filepath)
+            details = []
+            for stage_name in self.stage_names:
+                commits = self.snapshot.commits_of(stage_name, i)
+                if commits:
+                    details.append((stage_name, commits))
+            self.commit_details[filepath] = details
+        if filepath not in self.commit_details:
+            details = []
+            timed_out = False
+            for stage_name in self.stage_names:
+                if stage_name not in self.stage_data:
+                    continue
+                try:
+                    with workspaceindex.git_deadline():
+                        commits = commits_touching_file(
+                            self.stage_data[stage_name], filepath)
+                except utils.CommandTimeout:
+                    timed_out = True
+                    commits = [dict(subject='(git log timed out)')]
+                if commits:
+                    details.append((stage_name, commits))
+            if timed_out:
+                # Expanding the row again tries again.
+                return details
+            self.commit_details[filepath] = details
+        return self.commit_details[filepath]
+
+    def detail_widget(self, data):
+        lines = []
+        for stage_name, commits in self.get_commit_details(data['file']):
+            lines.append(urwid.Text(('table_row_header',
+                                     stage_shortnames.get(stage_name,
+                                                          stage_name))))
+            for commit in commits:
+                lines.append(urwid.Text('  {} {} {:<20} {}'.format(
+                    commit.get('hash', ''), commit.get('date', ''),
+                    commit.get('author', '')[:20], commit.get('subject', '')),
+                    wrap='clip'))
+        if not lines:
+            lines.append(urwid.Text('  No commits, changes are uncommitted'))
+        return urwid.Padding(urwid.Pile(lines), left=2)
 
     def query(self, sort=(None, None), offset=None, limit=None, load_all=False):
 
@@ -219,7 +469,9 @@ class GitRadarTable(DataTable):
             sort_field = sort
             sort_reverse = None
 
-        if sort_field:
+        if sort_field and hasattr(self.query_data, 'sort_by_field'):
+            self.query_data.sort_by_field(sort_field, sort_reverse)
+        elif sort_field:
             kwargs = {}
             kwargs[
                 "key"] = lambda x: (
@@ -241,6 +493,23 @@ class GitRadarTable(DataTable):
         for d in r:
             yield d
 
+    def measure(self, phase):
+        if self.latency is None:
+            return contextlib.nullcontext()
+        return self.latency.measure(phase)
+
+    def requery(self, *args, **kwargs):
+        with self.measure('query'):
+            return super(GitRadarTable, self).requery(*args, **kwargs)
+
+    def sort_by_column(self, *args, **kwargs):
+        with self.measure('query'):
+            return super(GitRadarTable, self).sort_by_column(*args, **kwargs)
+
+    def render_item(self, index):
+        with self.measure('rows'):
+            return super(GitRadarTable, self).render_item(index)
+
     def query_result_count(self):
         return self.num_rows
 
@@ -251,13 +520,14 @@ class GitRadarTable(DataTable):
         self.parent.loop.widget = self.parent._body
         self.parent.loop.draw_screen()
 
-    def dialog(self, header, text=None):
+    def dialog(self, header, text=None, more=None):
         '''
         Overlays a dialog box on top of the console UI
 
         Args:
             header
             text (list): A list of strings to display
+            more: called by a More button, which is left out without it
         '''
 
         if text is None:
@@ -277,8 +547,13 @@ class GitRadarTable(DataTable):
 
         # Footer
         button = urwid.Button('OK', self.reset_layout())
-        footer = urwid.AttrWrap(button, 'selectable', 'focus')
-        footer = urwid.GridFlow([footer], 8, 1, 1, 'center')
+        footer = [urwid.AttrWrap(button, 'selectable', 'focus')]
+        if more is not None:
+            more_button = urwid.Button('More')
+            urwid.connect_signal(more_button, 'click',
+                                 lambda button: more())
+            footer.append(urwid.AttrWrap(more_button, 'selectable', 'focus'))
+        footer = urwid.GridFlow(footer, 8, 1, 1, 'center')
 
         # Layout
         layout = urwid.Frame(body, header=header, footer=footer,
@@ -295,6 +570,371 @@ class GitRadarTable(DataTable):
                              lambda button: self.reset_layout())
         self.parent.loop.widget = w
 
+    def show_diffs(self, header, lines, shown=None, expand=None):
+        """
+        Shows the first lines of diffs. More shows further lines and at the
+        end calls expand, which returns the lines with the diffs of large
+        files too.
+        """
+        if shown is None:
+            shown = workspaceindex.diff_line_limit
+        text = lines
+        more = None
+        if len(lines) > shown:
+            more = lambda: self.show_diffs(
+                header, lines, shown + workspaceindex.diff_line_limit, expand)
+            text = lines[:shown] + ['({} more lines)'.format(
+                len(lines) - shown)]
+        elif expand is not None:
+            more = lambda: self.show_diffs(header, expand(), shown)
+        self.dialog(header, text, more=more)
+
+    def fetch_diff(self, stage_name, fp):
+        if self.radar_client:
+            return self.radar_client.diff(stage_name, fp)
+        return analyze_changes_diff(stage_name, self.main_branch,
+                                    self.dev_branch, fp,
+                                    self.stage_data.get(stage_name))
+
+    def collect_diffs(self, filepath, is_wanted=lambda: True, cancel=None,
+                      full=False):
+        """
+        :param cancel: threading.Event set when the diffs are no longer
+                       wanted, given by the prefetcher which then gets None
+                       instead of diffs which timed out
+        :param full: also diff files larger than diff_size_limit, which are
+                     otherwise summarized by their size
+        """
+        if self.snapshot is not None and not self.snapshot.has_diffs:
+            return 'Diffs were not exported to this snapshot\n'
+        self.timed_out_diffs.discard(filepath)
+        self.summarized_diffs.discard(filepath)
+        sizes = {}
+        if self.snapshot is None and self.radar_client is None:
+            try:
+                with workspaceindex.git_deadline(cancel):
+                    # One download of the blobs of all stages in a partial
+                    # clone.
+                    prefetch_diff_blobs(self.stage_names, self.main_branch,
+                                        self.dev_branch, [filepath],
+                                        self.stage_data)
+                    sizes = diff_blob_sizes(self.stage_names,
+                                            self.main_branch,
+                                            self.dev_branch, filepath,
+                                            self.stage_data)
+            except utils.CommandCancelled:
+                return None
+            except utils.CommandTimeout:
+                pass
+        alltext = ''
+        for stage_name in self.stage_names:
+            if not is_wanted():
+                return None
+            title = stage_shortnames[stage_name]
+            stage_sizes = sizes.get(stage_name)
+            if not full and stage_sizes is not None and \
+                    max(size or 0 for size in stage_sizes) > \
+                    workspaceindex.diff_size_limit:
+                self.summarized_diffs.add(filepath)
+                alltext += '{}\n{}, larger than {}, More shows the diff' \
+                           '\n\n'.format(
+                               title, size_summary(stage_sizes),
+                               format_size(workspaceindex.diff_size_limit))
+                continue
+            if self.snapshot is not None:
+                diff1 = self.snapshot.diff(
+                    stage_name, self.snapshot.index_of(filepath))
+            else:
+                try:
+                    with workspaceindex.git_deadline(cancel):
+                        diff1 = self.fetch_diff(stage_name,
+                                                '../' + filepath)
+                except utils.CommandCancelled:
+                    return None
+                except utils.CommandTimeout:
+                    if cancel is not None:
+                        return None
+                    self.timed_out_diffs.add(filepath)
+                    alltext += '{}\n(diff timed out after {}s)\n\n'.format(
+                        title, workspaceindex.git_timeout)
+                    continue
+            if diff1 is None or len(diff1) == 0:
+                continue
+            diff1 = diff1.replace(filepath, '')
+            if stage_sizes is not None:
+                diff1 = BINARY_DIFF.sub(
+                    'Binary file ' + size_summary(stage_sizes), diff1)
+
+            # widget = urwid.Text('U') #Unstaged changes for {}'.
+            #    format(selection.data['file']))
+            # tdd = widget # TextDialogDisplay(['qwer','asdf'], 50, 50)
+            # tdd.add_buttons([("Exit", 0)])
+            # self.parent.loop.widget = tdd
+            # self.parent.loop.draw_screen()
+            alltext += title + '\n' + diff1 + '\n\n'
+        return alltext
+
+    def prefetch_around(self, position):
+        if not self.prefetcher or position is None:
+            return
+        # Browsing is mostly downwards, so the rows below come first.
+        positions = [position]
+        for i in range(1, self.prefetch_ahead + 1):
+            positions.append(position + i)
+        for i in range(1, self.prefetch_behind + 1):
+            positions.append(position - i)
+        filepaths = []
+        for p in positions:
+            if 0 <= p < len(self):
+                filepaths.append(self[p].data['file'])
+        self.prefetcher.focus(filepaths)
+
+    def refresh_labels(self):
+        """
+        Asks the environments again in the background and then relabels
+        the stage columns with the versions and environments found.
+        """
+        if not self.envs or self.labels_fn is None or \
+                self.parent.loop is None:
+            return
+
+        def relabel(_):
+            os.close(pipe)
+            self.set_labels(self.labels_fn(self.stage_names,
+                                           self.stage_data))
+            return False
+
+        pipe = self.parent.loop.watch_pipe(relabel)
+        # Wakes up the main loop which then relabels the columns.
+        refresh_environments(self.envs, lambda: os.write(pipe, b'x'))
+
+    def set_labels(self, labels):
+        for column in self.columns:
+            if column.name in labels:
+                column.label = labels[column.name]
+        if self.with_header:
+            self.header.update()
+
+    def request_owners(self, position):
+        if not self.owner_resolver or self.parent.loop is None or \
+                position is None:
+            return
+        if self.owner_pipe is None:
+            self.owner_pipe = self.parent.loop.watch_pipe(self.apply_owners)
+        # Nearest rows first, the resolver drops rows scrolled away from.
+        positions = [position]
+        for i in range(1, max(self.owners_ahead, self.owners_behind) + 1):
+            if i <= self.owners_ahead:
+                positions.append(position + i)
+            if i <= self.owners_behind:
+                positions.append(position - i)
+        self.owner_resolver.request([self[p].data['file'] for p in positions
+                                     if 0 <= p < len(self)])
+
+    def owner_found(self, filepath, owner):
+        with self.owner_lock:
+            self.owner_updates[filepath] = owner_label(owner)
+            wake_up = len(self.owner_updates) == 1
+        # One wake up for the owners found until the main loop runs.
+        if wake_up:
+            os.write(self.owner_pipe, b'x')
+
+    def apply_owners(self, _):
+        with self.owner_lock:
+            updates = self.owner_updates
+            self.owner_updates = {}
+        self.owners.update(updates)
+        shown = set(self.df.index)
+        indexes = []
+        for filepath, label in updates.items():
+            row = self.rows_by_file.get(filepath)
+            if row is None:
+                continue
+            row['owner'] = label
+            if row['uniqueid'] in shown:
+                self.df.set(row['uniqueid'], 'owner', label)
+                indexes.append(row['uniqueid'])
+        if indexes:
+            self.invalidate_rows(indexes)
+        return True
+
+    def toggle_mark(self):
+        if self.selection is None:
+            return
+        filepath = self.selection.data['file']
+        if filepath in self.marked:
+            self.marked.remove(filepath)
+        else:
+            self.marked.add(filepath)
+        marked = '*' if filepath in self.marked else ''
+        if filepath in self.rows_by_file:
+            self.rows_by_file[filepath]['marked'] = marked
+        self.df.set(self.selection.data['uniqueid'], 'marked', marked)
+        self.invalidate_rows([self.selection.data['uniqueid']])
+        if self.focus_position < len(self) - 1:
+            self.focus_position += 1
+
+    def chosen_stages(self, text):
+        """
+        Stages for a comma separated list of short or full stage names.
+        """
+        wanted = [x.strip() for x in text.split(',')]
+        if 'all' in wanted:
+            return list(self.stage_names)
+        return [s for s in self.stage_names
+                if s in wanted or stage_shortnames.get(s, s) in wanted]
+
+    def write_marked_diffs(self, stage_names, out):
+        filepaths = sorted(self.marked)
+        if self.snapshot is None:
+            with workspaceindex.git_deadline():
+                export_diffs(stage_names, self.main_branch, self.dev_branch,
+                             filepaths, self.stage_data, out)
+            return
+        for stage_name in stage_names:
+            diffs = [self.snapshot.diff(stage_name,
+                                        self.snapshot.index_of(fp))
+                     for fp in filepaths]
+            diffs = [d for d in diffs if d]
+            if diffs:
+                out.write('{}\n{}\n\n'.format(
+                    stage_shortnames.get(stage_name, stage_name),
+                    '\n'.join(diffs)).encode(errors='surrogateescape'))
+
+    def with_marked_stages(self, callback):
+        """
+        Asks for the stages to diff the marked rows in.
+        """
+        if not self.marked:
+            self.dialog(' NO MARKED ROWS ', ['Mark rows with m first'])
+            return
+        self.prompt('Stages, e.g. staged,prod or all: ',
+                    lambda text: callback(self.chosen_stages(text)))
+
+    def export_marked(self, stage_names):
+        def write(path):
+            try:
+                with open(os.path.expanduser(path), 'wb') as out:
+                    self.write_marked_diffs(stage_names, out)
+            except OSError as e:
+                self.dialog(' EXPORT FAILED ', [str(e)])
+                return
+            except utils.CommandTimeout:
+                self.dialog(' EXPORT FAILED ', [
+                    'git diff timed out after {}s'.format(
+                        workspaceindex.git_timeout)])
+                return
+            self.dialog(' EXPORTED ', ['Diffs of {} files written to {}'
+                                       .format(len(self.marked), path)])
+
+        self.prompt('Write diffs to file: ', write)
+
+    def view_marked(self, stage_names):
+        with tempfile.TemporaryFile() as out:
+            try:
+                self.write_marked_diffs(stage_names, out)
+            except utils.CommandTimeout:
+                # Shows the diffs written until then.
+                out.seek(0, os.SEEK_END)
+                out.write('(git diff timed out after {}s)\n'.format(
+                    workspaceindex.git_timeout).encode())
+            out.seek(0)
+            text = out.read().decode(errors='surrogateescape')
+        self.show_diffs(' CHANGES OF {} FILES '.format(len(self.marked)),
+                        text.split('\n'))
+
+    def prompt(self, caption, callback):
+        '''
+        Overlays a one line text prompt, callback gets the text or None
+        '''
+
+        def done(text):
+            self.reset_layout()
+            if text:
+                callback(text)
+
+        edit = PromptEdit(caption, done)
+        w = urwid.Overlay(
+            urwid.LineBox(urwid.Filler(edit)),
+            self.parent._body,
+            align='center',
+            width=80,
+            valign='middle',
+            height=3)
+        self.parent.loop.widget = w
+
+    def add_comparison(self, spec):
+        '''
+        Adds a column for a ref or range, computed in the background
+        without recomputing the other stages.
+        '''
+        stage_name = 'compare:' + spec
+        if stage_name in self.stage_names:
+            return
+        if self.snapshot is not None:
+            self.dialog(' COMPARISON FAILED ',
+                        ['Snapshots can not be compared with refs'])
+            return
+        result = {}
+
+        def patch(_):
+            os.close(pipe)
+            if 'error' in result:
+                self.dialog(' COMPARISON FAILED ', [result['error']])
+            else:
+                self.patch_stage(stage_name, result['stage'])
+            return False
+
+        def compute():
+            try:
+                with workspaceindex.git_deadline():
+                    result['stage'] = analyze__ref_comparison(spec)
+            except utils.CommandTimeout:
+                result['error'] = '{}: timed out after {}s'.format(
+                    spec, workspaceindex.git_timeout)
+            except Exception as e:
+                result['error'] = '{}: {}'.format(spec, e)
+            # Wakes up the main loop which then patches the table.
+            os.write(pipe, b'x')
+
+        pipe = self.parent.loop.watch_pipe(patch)
+        threading.Thread(target=compute, daemon=True).start()
+
+    def patch_stage(self, stage_name, stage):
+        spec = stage_name[len('compare:'):]
+        self.comparisons.append(spec)
+        stage_shortnames[stage_name] = spec[:10]
+        self.stage_names = self.stage_names + [stage_name]
+        self.stage_data[stage_name] = stage
+        self.commit_details = {}
+        # Prefetched diffs lack the new column.
+        if self.prefetcher:
+            self.prefetcher.clear()
+        in_stage = set(stage['filepaths'])
+        known = set()
+        for row in self.query_data:
+            known.add(row['file'])
+            row[stage_name] = 'x' if row['file'] in in_stage else ' '
+        for filepath in stage['filepaths']:
+            if filepath in known:
+                continue
+            row = self.fill_row(self.last_rec, filepath, self.stage_names,
+                                self.stage_data,
+                                {filepath: {stage_name: 'x'}})
+            self.query_data.append(row)
+            self.rows_by_file[filepath] = row
+            self.last_rec += 1
+            self.num_rows += 1
+        self.add_columns(DataTableColumn(
+            stage_name,
+            label=stage_shortnames[stage_name],
+            width=10,
+            align="right",
+            sort_reverse=True,
+            sort_icon=False,
+            padding=1))
+        self.refresh()
+
     def handle_activate(self, cell, selection):
         # Some debug prints that are useful with this complex UI lib
         # print('Selected: {}'.format(cell))
@@ -313,62 +953,37 @@ class GitRadarTable(DataTable):
         # print(selection[0].cell_selection) -> True
         # print(selection.data["staged"])
 
-        diffs = [
-            ('unstaged', analyze_changes_unstaged_diff),
-            ('staged', analyze_changes_staged_diff),
-            (
-                'commit',
-                lambda x: analyze_changes_in_commits_but_not_pushed_diff(
-                    self.dev_branch, x),
-            ),
-            (
-                'review',
-                lambda x: analyze_changes_pushed_but_not_merged_diff(
-                    self.dev_branch,
-                    self.main_branch, x),
-            ), (
-                'main',
-                lambda x: analyze_changes_in_merged_prs_not_released_diff(
-                    self.main_branch, x),
-            ), (
-                'prod',
-                lambda x: analyze_changes_in_recent_production_release_diff(1,
-                                                                            x),
-            ), ('prod-1',
-                lambda x: analyze_changes_in_recent_production_release_diff(2,
-                                                                            x))
-        ]
-
-        alltext = ''
-        for title, fetct_diff in diffs:
-            diff1 = fetct_diff('../' + selection.data['file'])
-            if diff1 is None or len(diff1) == 0:
-                continue
-            diff1 = diff1.replace(selection.data['file'], '')
-
-            # widget = urwid.Text('U') #Unstaged changes for {}'.
-            #    format(selection.data['file']))
-            # tdd = widget # TextDialogDisplay(['qwer','asdf'], 50, 50)
-            # tdd.add_buttons([("Exit", 0)])
-            # self.parent.loop.widget = tdd
-            # self.parent.loop.draw_screen()
-            alltext += title + '\n' + diff1 + '\n\n'
+        filepath = selection.data['file']
+        alltext = None
+        if self.prefetcher:
+            alltext = self.prefetcher.get(filepath)
+        if alltext is None:
+            alltext = self.collect_diffs(filepath)
+            # Diffs which timed out are not cached, opening the row again
+            # tries again.
+            if self.prefetcher and filepath not in self.timed_out_diffs:
+                self.prefetcher.put(filepath, alltext)
 
         if len(alltext) > 0:
-            self.dialog(' CHANGES OF ' + selection.data['file'],
-                        alltext.split('\n'))
+            expand = None
+            if filepath in self.summarized_diffs:
+                expand = lambda: self.collect_diffs(filepath,
+                                                    full=True).split('\n')
+            self.show_diffs(' CHANGES OF ' + filepath, alltext.split('\n'),
+                            expand=expand)
 
     def keypress(self, size, key):
 
         if key == "meta r":
-            self.load_data()
-            self.reset(reset_sort=True)
+            self.reload()
         if key == "ctrl r":
             self.reset(reset_sort=True)
         if key == "ctrl d":
             self.log_dump(20)
         if key == "meta d":
             self.log_dump(20, columns=["unstaged", "file"])
+        if key == "meta l" and self.latency is not None:
+            self.dialog(' LATENCY ', self.latency.report_lines())
         if key == "ctrl f":
             self.focus_position = 0
         elif key == "ctrl t":
@@ -438,6 +1053,14 @@ class GitRadarTable(DataTable):
             logger.info(self.footer.values)
         elif key == "c":
             self.toggle_cell_selection()
+        elif key == "C":
+            self.prompt('Compare with ref or range: ', self.add_comparison)
+        elif key == "m":
+            self.toggle_mark()
+        elif key == "E":
+            self.with_marked_stages(self.export_marked)
+        elif key == "V":
+            self.with_marked_stages(self.view_marked)
         elif key == "shift left":
             self.cycle_sort_column(-1)
         elif key == "shift right":
@@ -0,0 +1,111 @@
+""" Hotspot scores over the file x stage matrix.
+
+The matrix and the commit incidence are built once into NumPy arrays and
+every score is computed in vectorized form, so scoring stays fast with
+100k files and many stages.
+
+score = (presence @ stage weights) * (1 + log(1 + commits))
+        + cochange_weight * log(1 + co-changed files)
+        + history_weight * runs present in recorded history
+"""
+import numpy as np
+
+DEFAULT_STAGE_WEIGHT = 1.0
+COCHANGE_WEIGHT = 0.25
+HISTORY_WEIGHT = 0.1
+
+
+def build_matrix(stage_names, stage_data, filepaths):
+    """
+    :return: bool array of shape (files, stages), dict of file -> row
+    """
+    rows = {fp: i for i, fp in enumerate(filepaths)}
+    matrix = np.zeros((len(filepaths), len(stage_names)), dtype=bool)
+    for column, stage_name in enumerate(stage_names):
+        present = [rows[fp] for fp in stage_data[stage_name]['filepaths']
+                   if fp in rows]
+        matrix[np.array(present, dtype=np.intp), column] = True
+    return matrix, rows
+
+
+def build_commit_incidence(stage_names, stage_data, rows):
+    """
+    Pairs of (file row, commit number) over all stages, each pair once.
+    """
+    commit_numbers = {}
+    file_rows = []
+    commit_columns = []
+    for stage_name in stage_names:
+        stage = stage_data[stage_name]
+        commits = stage.get('commits', [])
+        for fp, positions in stage.get('filepath_to_commits', {}).items():
+            if fp not in rows:
+                continue
+            for position in positions:
+                file_rows.append(rows[fp])
+                commit_columns.append(commit_numbers.setdefault(
+                    commits[position], len(commit_numbers)))
+    if not file_rows:
+        return np.zeros((0, 2), dtype=np.intp)
+    pairs = np.stack([np.array(file_rows, dtype=np.intp),
+                      np.array(commit_columns, dtype=np.intp)], axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def churn_and_cochange(pairs, file_count):
+    """
+    :return: commits per file, files changed together with each file
+    """
+    if len(pairs) == 0:
+        zeros = np.zeros(file_count)
+        return zeros, zeros
+    file_rows, commit_columns = pairs[:, 0], pairs[:, 1]
+    churn = np.bincount(file_rows, minlength=file_count)
+    commit_sizes = np.bincount(commit_columns)
+    cochange = np.bincount(file_rows,
+                           weights=commit_sizes[commit_columns] - 1,
+                           minlength=file_count)
+    return churn, cochange
+
+
+def rank_descending(values):
+    """ 1 for the largest value, ties share the best rank. """
+    order = np.argsort(-values, kind='stable')
+    ranks = np.empty(len(values), dtype=np.intp)
+    if len(values):
+        sorted_values = values[order]
+        first_of_tie = np.r_[True, sorted_values[1:] != sorted_values[:-1]]
+        ranks[order] = np.maximum.accumulate(
+            np.where(first_of_tie, np.arange(1, len(values) + 1), 0))
+    return ranks
+
+
+def score_files(stage_names, stage_data, filepaths, stage_weights=None,
+                history=None):
+    """
+    :param stage_weights: dict of stage name -> weight, default 1 each
+    :param history: dict of file -> number of recorded runs it was in
+    :return: dict with arrays score, churn, churn_rank and cochange,
+             aligned with filepaths
+    """
+    stage_names = [s for s in stage_names if s in stage_data]
+    matrix, rows = build_matrix(stage_names, stage_data, filepaths)
+    weights = np.array([(stage_weights or {}).get(s, DEFAULT_STAGE_WEIGHT)
+                        for s in stage_names])
+    churn, cochange = churn_and_cochange(
+        build_commit_incidence(stage_names, stage_data, rows),
+        len(filepaths))
+    score = (matrix @ weights) * (1 + np.log1p(churn)) \
+        + COCHANGE_WEIGHT * np.log1p(cochange)
+    if history:
+        history_counts = np.zeros(len(filepaths))
+        for fp, count in history.items():
+            if fp in rows:
+                history_counts[rows[fp]] = count
+        score += HISTORY_WEIGHT * history_counts
+    return {
+        'score': np.round(score, 2),
+        'churn': churn,
+        'churn_rank': rank_descending(churn),
+        'cochange': cochange,
+    }
@@ -0,0 +1,201 @@
+""" Top author of files according to git blame.
+
+Blame is slow, so owners are looked up by worker threads for the rows
+around the table cursor only, and stored per (path, blob id) in a local
+database. A file is blamed again only once its content at HEAD changed.
+"""
+import collections
+import re
+import sqlite3
+import threading
+
+from utils import CommandCancelled, CommandTimeout, db_text, deadline, \
+    from_db_text, git_path, git_toplevel, run_cmd
+
+DEFAULT_DB_NAME = 'gitradar-owners.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS owners (
+    path TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    author TEXT NOT NULL,
+    share REAL NOT NULL,
+    PRIMARY KEY (path, blob)
+) WITHOUT ROWID;
+"""
+
+COMMIT_ID = re.compile('[0-9a-f]{40,64}')
+
+
+def default_db_path():
+    return git_path(DEFAULT_DB_NAME)
+
+
+def blob_ids(filepaths, top='.'):
+    """
+    :param top: top directory of the repository, the paths are relative to
+    :return: dict of file -> blob id at HEAD, files not at HEAD are missing
+    """
+    blobs = {}
+    # Chunked to keep the command line short.
+    for i in range(0, len(filepaths), 1000):
+        for entry in run_cmd(['git', '-C', top, 'ls-tree', '-z',
+                              '--full-tree', 'HEAD', '--']
+                             + filepaths[i:i + 1000],
+                             separator='\0'):
+            info, fp = entry.split('\t', 1)
+            mode, object_type, blob = info.split(' ')
+            if object_type == 'blob':
+                blobs[fp] = blob
+    return blobs
+
+
+def top_author(fp, top='.'):
+    """
+    :param top: top directory of the repository, fp is relative to it
+    :return: (author, share of lines) of the file at HEAD or None
+    """
+    authors = {}
+    lines = collections.Counter()
+    commit = None
+    # git blame takes the path relative to the working directory and knows
+    # no :(top) pathspec.
+    for line in run_cmd(['git', '-C', top, 'blame', '--incremental', '-w',
+                         'HEAD', '--', fp]):
+        fields = line.split(' ')
+        if len(fields) == 4 and COMMIT_ID.fullmatch(fields[0]):
+            commit = fields[0]
+            lines[commit] += int(fields[3])
+        elif line.startswith('author '):
+            authors[commit] = line[len('author '):]
+    total = sum(lines.values())
+    if not total:
+        return None
+    author_lines = collections.Counter()
+    for commit, count in lines.items():
+        author_lines[authors.get(commit, '?')] += count
+    author, count = author_lines.most_common(1)[0]
+    return author, count / total
+
+
+def owner_label(owner):
+    if owner is None:
+        return ''
+    author, share = owner
+    return '{} {:.0%}'.format(author, share)
+
+
+class OwnerCache:
+    def __init__(self, db_path=None):
+        # Shared by the worker threads, hence the lock.
+        self.db = sqlite3.connect(db_path or default_db_path(),
+                                  check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, fp, blob):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT author, share FROM owners WHERE path = ? AND blob = ?',
+                (db_text(fp), blob)).fetchone()
+        if row is None:
+            return None
+        author, share = row
+        return from_db_text(author), share
+
+    def put(self, fp, blob, owner):
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO owners (path, blob, author, share) '
+                'VALUES (?, ?, ?, ?)',
+                (db_text(fp), blob, db_text(owner[0]), owner[1]))
+
+
+class OwnershipResolver:
+    """
+    Finds owners of the files asked for with worker threads.
+
+    on_owner(fp, owner) is called from a worker thread with (author, share)
+    or None for files without lines at HEAD or whose blame took longer than
+    timeout seconds.
+    """
+
+    def __init__(self, on_owner, db_path=None, workers=4, timeout=None):
+        self.on_owner = on_owner
+        self.timeout = timeout
+        self.top = git_toplevel()
+        # Set by reset() to stop the blames still running.
+        self.cancel = threading.Event()
+        self.cache = OwnerCache(db_path)
+        self.wanted = []
+        self.started = set()
+        self.blobs = {}
+        self.condition = threading.Condition()
+        self.generation = 0
+        for _ in range(workers):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def request(self, filepaths):
+        """ Replaces the queue, nearest rows first. """
+        with self.condition:
+            self.wanted = [fp for fp in filepaths if fp not in self.started]
+            self.condition.notify_all()
+
+    def reset(self):
+        """ Looks up files again, e.g. after HEAD moved. """
+        with self.condition:
+            self.generation += 1
+            self.cancel.set()
+            self.cancel = threading.Event()
+            self.wanted = []
+            self.started = set()
+            self.blobs = {}
+
+    def blob_of(self, fp, generation):
+        with self.condition:
+            if fp in self.blobs or generation != self.generation:
+                return self.blobs.get(fp)
+            # One ls-tree for the file and the rest of the queue.
+            filepaths = [fp] + [x for x in self.wanted
+                                if x not in self.blobs]
+        blobs = blob_ids(filepaths, self.top)
+        with self.condition:
+            if generation == self.generation:
+                for x in filepaths:
+                    self.blobs[x] = blobs.get(x)
+        return blobs.get(fp)
+
+    def owner_of(self, fp, generation):
+        blob = self.blob_of(fp, generation)
+        if blob is None:
+            return None
+        owner = self.cache.get(fp, blob)
+        if owner is None:
+            owner = top_author(fp, self.top)
+            if owner is not None:
+                self.cache.put(fp, blob, owner)
+        return owner
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.wanted:
+                    self.condition.wait()
+                fp = self.wanted.pop(0)
+                self.started.add(fp)
+                generation = self.generation
+                cancel = self.cancel
+            try:
+                with deadline(self.timeout, cancel):
+                    owner = self.owner_of(fp, generation)
+            except CommandCancelled:
+                continue
+            except CommandTimeout:
+                # Not cached, it is blamed again after a reset.
+                owner = None
+            if generation == self.generation:
+                self.on_owner(fp, owner)
@@ -0,0 +1,123 @@
+""" Limiting the radar to parts of the repository.
+
+Scopes are pushed into git commands as pathspecs, so git skips the rest of
+the tree. The same rules are compiled into one regular expression which
+filters whatever git could not be told about before rows are built.
+"""
+import os
+import re
+
+IGNORE_FILE = '.gitradarignore'
+
+
+def read_patterns(path):
+    patterns = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            # Negated patterns are not supported, they can not be expressed
+            # as git exclude pathspecs.
+            if not line.strip() or line.startswith('#') or \
+                    line.startswith('!'):
+                continue
+            patterns.append(line.strip())
+    return patterns
+
+
+def gitignore_to_globs(pattern):
+    """
+    Converts a gitignore style pattern to globs relative to the repo root.
+    :param pattern: e.g. "vendor/", "*.min.js" or "/build"
+    :return: list of globs, a pattern may match a file or a directory
+    """
+    directory_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    # Like in gitignore, a slash anywhere but the end anchors to the root.
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    if not anchored and not pattern.startswith('**'):
+        pattern = '**/' + pattern
+    if directory_only:
+        return [pattern + '/**']
+    return [pattern, pattern + '/**']
+
+
+def glob_to_regex(glob):
+    i = 0
+    out = ''
+    while i < len(glob):
+        if glob.startswith('**/', i):
+            out += '(?:.*/)?'
+            i += 3
+        elif glob.startswith('/**', i) and i + 3 == len(glob):
+            out += '(?:/.*)?'
+            i += 3
+        elif glob.startswith('**', i):
+            out += '.*'
+            i += 2
+        elif glob[i] == '*':
+            out += '[^/]*'
+            i += 1
+        elif glob[i] == '?':
+            out += '[^/]'
+            i += 1
+        elif glob[i] == '[' and ']' in glob[i + 1:]:
+            end = glob.index(']', i + 1)
+            out += '[' + glob[i + 1:end].replace('!', '^', 1) + ']'
+            i = end + 1
+        else:
+            out += re.escape(glob[i])
+            i += 1
+    return out
+
+
+class PathScope:
+    def __init__(self, paths=(), excludes=()):
+        """
+        :param paths: directories or files to limit the radar to
+        :param excludes: gitignore style patterns to drop
+        """
+        self.paths = [p.strip('/') for p in paths if p.strip('/')]
+        self.excludes = []
+        for pattern in excludes:
+            self.excludes.extend(gitignore_to_globs(pattern))
+
+        include = '.*'
+        if self.paths:
+            include = '(?:' + '|'.join(
+                re.escape(p) + '(?:/.*)?' for p in self.paths) + ')'
+        exclude = '(?!)'
+        if self.excludes:
+            exclude = '(?:' + '|'.join(
+                glob_to_regex(g) for g in self.excludes) + ')'
+        self.regex = re.compile(f'(?!{exclude}$){include}$')
+
+    def pathspec_args(self):
+        args = [':(top)' + p for p in self.paths]
+        if not args:
+            # Exclusions alone would only cover the current directory.
+            args = [':(top)']
+        args += [':(top,exclude,glob)' + g for g in self.excludes]
+        return args
+
+    def matches(self, fp):
+        return self.regex.match(fp) is not None
+
+    def filter(self, filepaths):
+        return [fp for fp in filepaths if self.matches(fp)]
+
+
+def build_path_scope(paths, excludes, exclude_from=None, top='.'):
+    """
+    :param top: top directory of the repository, where IGNORE_FILE is read
+    :return: PathScope or None when the whole repository is in scope
+    """
+    excludes = list(excludes or [])
+    ignore_file = os.path.join(top, IGNORE_FILE)
+    if exclude_from is None and os.path.exists(ignore_file):
+        exclude_from = ignore_file
+    if exclude_from:
+        excludes += read_patterns(exclude_from)
+    if not paths and not excludes:
+        return None
+    return PathScope(paths or [], excludes)
@@ -0,0 +1,204 @@
+""" Long-running radar daemon which owns the analysis and serves it to clients.
+
+The daemon refreshes the stage data in the background and answers
+newline-delimited JSON requests over a local Unix socket, so several
+TUI or headless clients can attach to the same warm data.
+"""
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import utils
+from workspaceindex import analyze_changes, analyze_changes_diff, \
+    fetch_remotes, git_deadline
+
+DEFAULT_SOCKET_NAME = 'gitradar.sock'
+
+
+def default_socket_path():
+    return utils.git_path(DEFAULT_SOCKET_NAME)
+
+
+class RadarState:
+    def __init__(self, main_branch, dev_branch, stage_names,
+                 refresh_interval=300, fetch=True):
+        self.main_branch = main_branch
+        self.dev_branch = dev_branch
+        self.stage_names = stage_names
+        self.refresh_interval = refresh_interval
+        self.fetch = fetch
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.refresh_cancel = None
+        self.generation = 0
+        self.refreshed_at = None
+        self.snapshot = None
+        self.encoded_snapshot = b'null'
+        self.diff_cache = {}
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        """
+        A newer refresh supersedes this one, its git commands are stopped.
+        :return: False when superseded
+        """
+        with self.lock:
+            if self.refresh_cancel is not None:
+                self.refresh_cancel.set()
+            cancel = self.refresh_cancel = threading.Event()
+        # Only one refresh at a time, clients keep reading the old snapshot
+        # until the new one is swapped in.
+        with self.refresh_lock:
+            if cancel.is_set():
+                return False
+            try:
+                with utils.deadline(cancel=cancel):
+                    if self.fetch:
+                        fetch_remotes(verbose=False)
+                    stage_names, stage_data, filepaths = analyze_changes(
+                        self.main_branch, self.dev_branch, self.stage_names,
+                        cancel=cancel)
+            except utils.CommandCancelled:
+                return False
+            snapshot = {
+                'stage_names': list(stage_names),
+                'stage_data': stage_data,
+                'filepaths': filepaths,
+            }
+            with self.lock:
+                self.generation += 1
+                self.refreshed_at = time.time()
+                snapshot['generation'] = self.generation
+                snapshot['refreshed_at'] = self.refreshed_at
+                self.snapshot = snapshot
+                # Encoded once per refresh so attaching clients get the
+                # snapshot without re-serializing it.
+                self.encoded_snapshot = json.dumps(snapshot).encode()
+                self.diff_cache = {}
+        return True
+
+    def stages(self):
+        with self.lock:
+            return self.encoded_snapshot
+
+    def diff(self, stage_name, fp):
+        with self.lock:
+            generation = self.generation
+            key = (stage_name, fp)
+            if key in self.diff_cache:
+                return self.diff_cache[key]
+            status = self.snapshot['stage_data'].get(stage_name)
+        with git_deadline():
+            out = analyze_changes_diff(stage_name, self.main_branch,
+                                       self.dev_branch, fp, status)
+        with self.lock:
+            if generation == self.generation:
+                self.diff_cache[key] = out
+        return out
+
+    def run_refresh_loop(self):
+        while not self.stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the previous snapshot if a refresh fails.
+                print(f'Refresh failed: {e}')
+
+
+class RadarRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        state = self.server.state
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'stages':
+                    self.wfile.write(state.stages() + b'\n')
+                    self.wfile.flush()
+                    continue
+                elif op == 'diff':
+                    response = {'diff': state.diff(request['stage'],
+                                                   request['file'])}
+                elif op == 'refresh':
+                    state.refresh()
+                    response = {'generation': state.generation}
+                elif op == 'ping':
+                    response = {'generation': state.generation}
+                else:
+                    response = {'error': f'Unknown op: {op}'}
+            except utils.CommandTimeout:
+                response = {'timed_out': True}
+            except Exception as e:
+                # Answered like any other failure, so the client gets an
+                # error instead of a dropped connection.
+                response = {'error': str(e) or type(e).__name__}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class RadarServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, state):
+        self.state = state
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super(RadarServer, self).__init__(socket_path, RadarRequestHandler)
+        os.chmod(socket_path, 0o660)
+
+
+def serve(socket_path, state):
+    print(f'Analyzing before accepting clients on {socket_path}')
+    state.refresh()
+    threading.Thread(target=state.run_refresh_loop, daemon=True).start()
+    server = RadarServer(socket_path, state)
+    try:
+        server.serve_forever()
+    finally:
+        state.stopped.set()
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+class RadarClient:
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.reader = self.sock.makefile('rb')
+        self.lock = threading.Lock()
+
+    def request(self, op, **kwargs):
+        kwargs['op'] = op
+        with self.lock:
+            self.sock.sendall(json.dumps(kwargs).encode() + b'\n')
+            response = json.loads(self.reader.readline())
+        if isinstance(response, dict) and 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def analyze_changes(self):
+        snapshot = self.request('stages')
+        return (snapshot['stage_names'], snapshot['stage_data'],
+                snapshot['filepaths'])
+
+    def diff(self, stage_name, fp):
+        """
+        :raise utils.CommandTimeout: git diff timed out in the daemon
+        """
+        response = self.request('diff', stage=stage_name, file=fp)
+        if response.get('timed_out'):
+            raise utils.CommandTimeout(fp)
+        return response['diff']
+
+    def refresh(self):
+        return self.request('refresh')
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
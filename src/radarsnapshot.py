@@ -0,0 +1,333 @@
+""" Portable snapshots of a radar which can be browsed without git.
+
+A snapshot is one file with a small JSON header and columns of fixed width
+integers, so opening it maps the file and parses only the header. Rows,
+commits and diffs are read from the mapping when they are looked at, which
+keeps opening a snapshot of 100k files fast and its memory use small.
+
+Layout, all integers little-endian:
+
+    magic, u64 offset and u64 length of the JSON header
+    sections, each aligned to 8 bytes, located by the JSON header
+    JSON header
+
+Sections, n being the number of files and S the number of stages:
+
+    path_offsets, paths       file paths, sorted, as offsets into a blob
+    masks                     u64 per file, bit k set when in stage k
+    commit_counts             u32 per file, distinct commits of the row
+    scores                    f64 per file, optional
+    commits:k                 commit ids of stage k, padded to the width
+                              in the header, 40 or 64 for SHA-256
+    commit_info_offsets:k,    hash, author, date and subject of the
+    commit_info:k             commits of stage k, NUL separated, optional
+    file_commit_offsets:k,    positions in commits:k of the commits
+    file_commits:k            touching each file
+    diff_offsets, diffs       diff of file i in stage k at i * S + k,
+                              optional
+"""
+import json
+import mmap
+import sys
+import time
+from array import array
+
+MAGIC = b'GRSNAP\x00\x01'
+HEADER_SIZE = len(MAGIC) + 16
+MAX_STAGES = 64
+# Width of the commit ids of snapshots written before it was in the header.
+COMMIT_ID_SIZE = 40
+# Not written to the header as they are stored in columns instead.
+COLUMN_KEYS = ('filepaths', 'commits', 'filepath_to_commits')
+
+
+def encode(text):
+    # Paths are decoded with surrogateescape, undecodable bytes survive.
+    return text.encode(errors='surrogateescape')
+
+
+def decode(data):
+    return bytes(data).decode(errors='surrogateescape')
+
+
+def int_column(typecode, values):
+    column = array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+
+def blob_columns(items):
+    """
+    :return: offsets column and blob of the concatenated items
+    """
+    offsets = [0]
+    chunks = []
+    for item in items:
+        chunks.append(item)
+        offsets.append(offsets[-1] + len(item))
+    return int_column('Q', offsets), b''.join(chunks)
+
+
+def write_snapshot(path, stage_names, stage_data, filepaths, labels=None,
+                   scores=None, describe_fn=None, diff_fn=None):
+    """
+    :param labels: dict of stage name -> column label
+    :param scores: hotspot scores aligned with filepaths
+    :param describe_fn: gets commit ids, returns a dict for each with hash,
+                        author, date and subject
+    :param diff_fn: gets stage name and file path, returns the diff
+    """
+    if len(stage_names) > MAX_STAGES:
+        raise ValueError(f'At most {MAX_STAGES} stages can be exported')
+    order = sorted(range(len(filepaths)), key=lambda i: filepaths[i])
+    id_size = max([len(c) for stage_name in stage_names
+                   for c in stage_data[stage_name].get('commits', [])]
+                  or [COMMIT_ID_SIZE])
+    filepaths = [filepaths[i] for i in order]
+    sections = {}
+
+    path_offsets, paths = blob_columns(encode(fp) for fp in filepaths)
+    sections['path_offsets'] = path_offsets
+    sections['paths'] = paths
+
+    masks = dict.fromkeys(filepaths, 0)
+    commit_ids = {fp: set() for fp in filepaths}
+    for k, stage_name in enumerate(stage_names):
+        stage = stage_data[stage_name]
+        for fp in stage['filepaths']:
+            if fp in masks:
+                masks[fp] |= 1 << k
+        commits = stage.get('commits', [])
+        filepath_to_commits = stage.get('filepath_to_commits', {})
+        file_commits = []
+        for fp in filepaths:
+            positions = filepath_to_commits.get(fp, [])
+            file_commits.append(positions)
+            commit_ids[fp].update(commits[p] for p in positions)
+        sections[f'commits:{k}'] = ''.join(
+            c.ljust(id_size) for c in commits).encode()
+        offsets = [0]
+        for positions in file_commits:
+            offsets.append(offsets[-1] + len(positions))
+        sections[f'file_commit_offsets:{k}'] = int_column('Q', offsets)
+        sections[f'file_commits:{k}'] = int_column(
+            'I', [p for positions in file_commits for p in positions])
+        if describe_fn and commits:
+            infos = []
+            # Chunked to keep the command line of git short.
+            for i in range(0, len(commits), 1000):
+                for info in describe_fn(commits[i:i + 1000]):
+                    infos.append(encode('\x00'.join(
+                        info.get(key, '') for key in
+                        ('hash', 'author', 'date', 'subject'))))
+            # Details are looked up by position, a commit git could not
+            # describe would shift the rest.
+            if len(infos) == len(commits):
+                offsets, blob = blob_columns(infos)
+                sections[f'commit_info_offsets:{k}'] = offsets
+                sections[f'commit_info:{k}'] = blob
+    sections['masks'] = int_column('Q', masks.values())
+    sections['commit_counts'] = int_column(
+        'I', [len(commit_ids[fp]) for fp in filepaths])
+    if scores is not None:
+        sections['scores'] = int_column('d', [float(scores[i])
+                                              for i in order])
+    if diff_fn:
+        diffs = []
+        for fp in filepaths:
+            for k, stage_name in enumerate(stage_names):
+                diff = None
+                if masks[fp] & (1 << k):
+                    diff = diff_fn(stage_name, fp)
+                diffs.append(encode(diff or ''))
+        offsets, blob = blob_columns(diffs)
+        sections['diff_offsets'] = offsets
+        sections['diffs'] = blob
+
+    header = {
+        'version': 1,
+        'created_at': time.time(),
+        'file_count': len(filepaths),
+        'commit_id_size': id_size,
+        'stage_names': list(stage_names),
+        'labels': labels or {},
+        'stages': {s: {k: v for k, v in stage_data[s].items()
+                       if k not in COLUMN_KEYS} for s in stage_names},
+        'sections': {},
+    }
+    with open(path, 'wb') as f:
+        f.write(bytes(HEADER_SIZE))
+        for name, data in sections.items():
+            f.write(bytes(-f.tell() % 8))
+            header['sections'][name] = [f.tell(), len(data)]
+            f.write(data)
+        header_offset = f.tell()
+        encoded = json.dumps(header).encode()
+        f.write(encoded)
+        f.seek(0)
+        f.write(MAGIC + int_column('Q', [header_offset, len(encoded)]))
+
+
+class RadarSnapshot:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        if self.mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a radar snapshot')
+        offset, length = self.ints_at(len(MAGIC), 16, 'Q')
+        self.header = json.loads(self.mm[offset:offset + length])
+        self.stage_names = self.header['stage_names']
+        self.labels = self.header['labels']
+        self.has_diffs = 'diffs' in self.header['sections']
+        self.id_size = self.header.get('commit_id_size', COMMIT_ID_SIZE)
+        self.columns = {}
+
+    def close(self):
+        # Views into the mapping must be gone before it can be closed.
+        self.columns = {}
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.mm.close()
+        self.file.close()
+
+    def ints_at(self, offset, length, typecode):
+        view = memoryview(self.mm)[offset:offset + length]
+        self.views.append(view)
+        if sys.byteorder == 'big':
+            column = array(typecode)
+            column.frombytes(view)
+            column.byteswap()
+            return column
+        column = view.cast(typecode)
+        self.views.append(column)
+        return column
+
+    def bounds(self, name):
+        offset, length = self.header['sections'][name]
+        return offset, offset + length
+
+    def column(self, name, typecode):
+        if name not in self.columns:
+            offset, length = self.header['sections'][name]
+            self.columns[name] = self.ints_at(offset, length, typecode)
+        return self.columns[name]
+
+    def blob_item(self, name, offsets_name, i):
+        offsets = self.column(offsets_name, 'Q')
+        start, _ = self.bounds(name)
+        return decode(self.mm[start + offsets[i]:start + offsets[i + 1]])
+
+    def __len__(self):
+        return self.header['file_count']
+
+    def filepath(self, i):
+        return self.blob_item('paths', 'path_offsets', i)
+
+    def index_of(self, fp):
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.filepath(middle) < fp:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.filepath(low) == fp:
+            return low
+        return None
+
+    def in_stage(self, i, stage_name):
+        k = self.stage_names.index(stage_name)
+        return bool(self.column('masks', 'Q')[i] & (1 << k))
+
+    def score(self, i):
+        if 'scores' not in self.header['sections']:
+            return None
+        return self.column('scores', 'd')[i]
+
+    def row(self, i):
+        mask = self.column('masks', 'Q')[i]
+        row = dict(uniqueid=i, file=self.filepath(i), score=self.score(i),
+                   commits=self.column('commit_counts', 'I')[i])
+        for k, stage_name in enumerate(self.stage_names):
+            row[stage_name] = 'x' if mask & (1 << k) else ' '
+        return row
+
+    def commit_positions(self, k, i):
+        offsets = self.column(f'file_commit_offsets:{k}', 'Q')
+        return list(self.column(f'file_commits:{k}', 'I')[
+                    offsets[i]:offsets[i + 1]])
+
+    def commit_id(self, k, position):
+        start = self.bounds(f'commits:{k}')[0] + position * self.id_size
+        return decode(self.mm[start:start + self.id_size]).rstrip()
+
+    def commits_of(self, stage_name, i):
+        """
+        :return: list of dicts with hash, author, date and subject, only the
+                 hash when the snapshot was exported without commit details
+        """
+        k = self.stage_names.index(stage_name)
+        commits = []
+        for position in self.commit_positions(k, i):
+            if f'commit_info:{k}' in self.header['sections']:
+                commits.append(dict(zip(
+                    ('hash', 'author', 'date', 'subject'),
+                    self.blob_item(f'commit_info:{k}',
+                                   f'commit_info_offsets:{k}',
+                                   position).split('\x00'))))
+            else:
+                commits.append(dict(hash=self.commit_id(k, position)[:7]))
+        return commits
+
+    def diff(self, stage_name, i):
+        if not self.has_diffs:
+            return None
+        k = self.stage_names.index(stage_name)
+        return self.blob_item('diffs', 'diff_offsets',
+                              i * len(self.stage_names) + k) or None
+
+    def order_by(self, field, reverse=False):
+        """
+        Row numbers sorted by a column, reading only that column.
+        """
+        if field in self.stage_names:
+            masks = self.column('masks', 'Q')
+            bit = 1 << self.stage_names.index(field)
+            key = lambda i: not masks[i] & bit
+        elif field == 'score' and 'scores' in self.header['sections']:
+            key = self.column('scores', 'd').__getitem__
+        elif field == 'commits':
+            key = self.column('commit_counts', 'I').__getitem__
+        else:
+            # Files are stored sorted by path.
+            rows = range(len(self))
+            return rows[::-1] if reverse else rows
+        return sorted(range(len(self)), key=key, reverse=bool(reverse))
+
+    def to_analysis(self):
+        """
+        Reads the whole snapshot.
+        :return: stage names, stage data and file paths like analyze_changes
+        """
+        filepaths = [self.filepath(i) for i in range(len(self))]
+        masks = self.column('masks', 'Q')
+        stage_data = {}
+        for k, stage_name in enumerate(self.stage_names):
+            stage = dict(self.header['stages'][stage_name])
+            start, end = self.bounds(f'commits:{k}')
+            stage['commits'] = [
+                decode(self.mm[p:p + self.id_size]).rstrip()
+                for p in range(start, end, self.id_size)]
+            stage['filepaths'] = [fp for i, fp in enumerate(filepaths)
+                                  if masks[i] & (1 << k)]
+            stage['filepath_to_commits'] = {}
+            for i, fp in enumerate(filepaths):
+                positions = self.commit_positions(k, i)
+                if positions:
+                    stage['filepath_to_commits'][fp] = positions
+            stage_data[stage_name] = stage
+        return list(self.stage_names), stage_data, filepaths
@@ -0,0 +1,140 @@
+""" Local history of radar runs for spotting files that keep showing up.
+
+Every recorded run stores one row per file present in any stage, with the
+stages encoded as a bitmask. Paths and stage names are stored once and
+referred to by id, which keeps a year of daily runs small. Runs get
+increasing ids in time order, so queries over the last weeks are range
+scans of the primary key instead of full table scans.
+"""
+import sqlite3
+import time
+
+import utils
+
+DEFAULT_DB_NAME = 'gitradar-history.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS stages (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    week TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_created_at ON runs (created_at);
+CREATE TABLE IF NOT EXISTS run_paths (
+    run_id INTEGER NOT NULL,
+    path_id INTEGER NOT NULL,
+    mask INTEGER NOT NULL,
+    PRIMARY KEY (run_id, path_id)
+) WITHOUT ROWID;
+"""
+
+MAX_STAGES = 63
+
+
+def default_db_path():
+    return utils.git_path(DEFAULT_DB_NAME)
+
+
+class SnapshotStore:
+    def __init__(self, db_path=None):
+        self.db = sqlite3.connect(db_path or default_db_path())
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _ids(self, table, column, values):
+        values = [utils.db_text(v) for v in values]
+        self.db.executemany(
+            f'INSERT OR IGNORE INTO {table} ({column}) VALUES (?)',
+            [(v,) for v in values])
+        ids = {}
+        # Chunked to stay below SQLite's limit of bound variables.
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for row_id, value in self.db.execute(
+                    f'SELECT id, {column} FROM {table} '
+                    f'WHERE {column} IN ({placeholders})', chunk):
+                ids[utils.from_db_text(value)] = row_id
+        return ids
+
+    def stage_bit(self, stage_id):
+        if stage_id > MAX_STAGES:
+            raise ValueError(f'At most {MAX_STAGES} stages can be recorded')
+        return 1 << (stage_id - 1)
+
+    def record(self, stage_names, stage_data, created_at=None):
+        """
+        Appends a run.
+        :return: id of the run
+        """
+        if created_at is None:
+            created_at = time.time()
+        with self.db:
+            stage_ids = self._ids('stages', 'name', stage_names)
+            masks = {}
+            for stage_name in stage_names:
+                bit = self.stage_bit(stage_ids[stage_name])
+                for fp in stage_data[stage_name]['filepaths']:
+                    masks[fp] = masks.get(fp, 0) | bit
+            path_ids = self._ids('paths', 'path', masks)
+            run_id = self.db.execute(
+                "INSERT INTO runs (created_at, week) "
+                "VALUES (?, strftime('%Y-%W', ?, 'unixepoch'))",
+                (created_at, created_at)).lastrowid
+            self.db.executemany(
+                'INSERT INTO run_paths (run_id, path_id, mask) '
+                'VALUES (?, ?, ?)',
+                [(run_id, path_ids[fp], mask) for fp, mask in masks.items()])
+        return run_id
+
+    def first_run_since(self, since):
+        row = self.db.execute('SELECT MIN(id) FROM runs WHERE created_at >= ?',
+                              (since,)).fetchone()
+        return row[0]
+
+    def hotspots(self, stage_name, min_weeks, weeks, now=None):
+        """
+        Files present in the stage in at least min_weeks of the last weeks.
+        :return: list of (path, number of weeks) with the most weeks first
+        """
+        if now is None:
+            now = time.time()
+        row = self.db.execute('SELECT id FROM stages WHERE name = ?',
+                              (stage_name,)).fetchone()
+        first_run = self.first_run_since(now - weeks * 7 * 24 * 3600)
+        if row is None or first_run is None:
+            return []
+        return [(utils.from_db_text(path), n) for path, n in self.db.execute(
+            'SELECT paths.path, COUNT(DISTINCT runs.week) AS n '
+            'FROM run_paths '
+            'JOIN runs ON runs.id = run_paths.run_id '
+            'JOIN paths ON paths.id = run_paths.path_id '
+            'WHERE run_paths.run_id >= ? AND run_paths.mask & ? '
+            'GROUP BY run_paths.path_id HAVING n >= ? '
+            'ORDER BY n DESC, paths.path',
+            (first_run, self.stage_bit(row[0]), min_weeks))]
+
+    def presence_counts(self, weeks, now=None):
+        """
+        :return: dict of file -> number of runs of the last weeks it was in
+        """
+        if now is None:
+            now = time.time()
+        first_run = self.first_run_since(now - weeks * 7 * 24 * 3600)
+        if first_run is None:
+            return {}
+        return {utils.from_db_text(path): n for path, n in self.db.execute(
+            'SELECT paths.path, COUNT(*) FROM run_paths '
+            'JOIN paths ON paths.id = run_paths.path_id '
+            'WHERE run_paths.run_id >= ? GROUP BY run_paths.path_id',
+            (first_run,))}
@@ -1,12 +1,13 @@
 from enum import Enum, auto
 
 stage_names = [
-    'unstaged', 'staged', 'in_commits_but_not_pushed', 'pushed_but_not_merged',
+    'untracked', 'unstaged', 'staged', 'in_commits_but_not_pushed', 'pushed_but_not_merged',
     'in_merged_prs_not_released', 'in_last_production_release',
     'in_previous_production_release'
 ]
 
 stage_shortnames = {
+    'untracked': 'new',
     'unstaged': 'unstaged',
     'staged': 'staged',
     'in_commits_but_not_pushed': 'commit',
@@ -19,6 +20,7 @@ stage_shortnames = {
 
 # TODO: use these instead of string keys for stages
 class Stage(Enum):
+    Untracked = auto()
     Unstaged = auto()
     Staged = auto()
     InCommitsButNotPushed = auto()
@@ -26,3 +28,73 @@ class Stage(Enum):
     MergedButNotReleased = auto()
     InLastProductionRelease = auto()
     InPreviousProductionRelease = auto()
+
+
+class StageRegistry:
+    """
+    Stages and the shared queries they depend on.
+
+    A node is computed by fn(context, inputs) where inputs maps the names
+    listed in its inputs to their results. Stages are nodes which become
+    columns; other nodes (e.g. the list of version tags) are intermediate
+    results shared by several stages.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.stages = []
+        self.diffs = {}
+
+    def add_node(self, name, fn, inputs=()):
+        self.nodes[name] = (fn, tuple(inputs))
+
+    def add_stage(self, name, fn, inputs=(), shortname=None, enabled=None,
+                  diff=None):
+        """
+        :param enabled: fn(context) telling whether the stage is computed,
+                        e.g. only when commit ids were given
+        :param diff: fn(stage data, file path) returning the diff of a file
+                     in the stage, built-in stages have theirs in
+                     workspaceindex.analyze_changes_diff
+        """
+        self.add_node(name, fn, inputs)
+        if diff is not None:
+            self.diffs[name] = diff
+        if name not in [s[0] for s in self.stages]:
+            self.stages.append((name, enabled))
+        stage_shortnames.setdefault(name, shortname or name)
+
+    def enabled_stages(self, context):
+        return [name for name, enabled in self.stages
+                if enabled is None or enabled(context)]
+
+
+class StageScheduler:
+    """
+    Runs the nodes a refresh needs, each of them once.
+    """
+
+    def __init__(self, registry, context):
+        self.registry = registry
+        self.context = context
+        self.results = {}
+
+    def resolve(self, name, resolving=()):
+        if name in self.results:
+            return self.results[name]
+        if name in resolving:
+            raise ValueError('Stage dependency cycle: ' +
+                             ' -> '.join(resolving + (name,)))
+        fn, inputs = self.registry.nodes[name]
+        resolved = {}
+        for input_name in inputs:
+            resolved[input_name] = self.resolve(input_name,
+                                                resolving + (name,))
+        self.results[name] = fn(self.context, resolved)
+        return self.results[name]
+
+    def run(self, stage_names):
+        return {name: self.resolve(name) for name in stage_names}
+
+
+registry = StageRegistry()
@@ -0,0 +1,29 @@
+""" Time spent in the phases of startup, up to the first rendered frame.
+"""
+import contextlib
+import sys
+import time
+
+
+class StartupProfile:
+    def __init__(self, started_at=None):
+        self.started_at = started_at or time.perf_counter()
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start, ''))
+
+    def mark(self, name):
+        """ Records the time from the start, e.g. for the first frame. """
+        self.phases.append((name, time.perf_counter() - self.started_at,
+                            'since start'))
+
+    def report(self, out=sys.stderr):
+        for name, seconds, note in self.phases:
+            print('{:<24} {:8.1f} ms {}'.format(name, seconds * 1000, note),
+                  file=out)
@@ -0,0 +1,135 @@
+""" Latency of keypresses and frames of the table UI.
+
+Time spent between two frames is split into querying rows (the query of
+the table and updating its dataframe), materializing row widgets and
+rendering the screen, which is the rest of draw_screen. A keypress is
+measured from the input until the frame showing its effect was drawn.
+"""
+import contextlib
+import json
+import time
+
+# Upper bounds of the histogram buckets, the last bucket is unbounded.
+BUCKETS_MS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+PHASES = ('query', 'rows', 'render')
+CATEGORIES = ('keypress', 'frame') + PHASES
+
+
+class LatencyRecorder:
+    def __init__(self, log_path=None, written=None):
+        """
+        :param log_path: file getting a JSON line per keypress and frame and
+                         the histograms once closed
+        :param written: function returning the bytes written to the terminal
+                        so far, logs the bytes of each frame
+        """
+        self.log = open(log_path, 'a') if log_path else None
+        self.written = written
+        self.samples = {c: [] for c in CATEGORIES}
+        self.pending = dict.fromkeys(PHASES, 0.0)
+        self.depth = dict.fromkeys(PHASES, 0)
+        self.key = None
+        self.key_at = None
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        """ Adds the time of the block to the phase, once when nested. """
+        start = time.perf_counter()
+        self.depth[phase] += 1
+        try:
+            yield
+        finally:
+            self.depth[phase] -= 1
+            if not self.depth[phase]:
+                self.pending[phase] += time.perf_counter() - start
+
+    def input_received(self, keys):
+        # Keys arriving before the next frame wait for the same frame.
+        if self.key_at is None:
+            self.key = ' '.join(k if isinstance(k, str) else str(k[0])
+                                for k in keys)
+            self.key_at = time.perf_counter()
+
+    def draw(self, draw_screen):
+        """ Runs draw_screen and records the frame. """
+        rows_before = self.pending['rows']
+        written_before = self.written() if self.written else None
+        start = time.perf_counter()
+        draw_screen()
+        end = time.perf_counter()
+        self.pending['render'] = (end - start -
+                                  (self.pending['rows'] - rows_before))
+        phases = {p: round(self.pending[p] * 1000, 3) for p in PHASES}
+        self.add('frame', (end - start) * 1000)
+        for p in PHASES:
+            if self.pending[p]:
+                self.add(p, phases[p])
+        event = dict(event='frame', ms=round((end - start) * 1000, 3),
+                     **phases)
+        if written_before is not None:
+            event['bytes'] = self.written() - written_before
+        if self.key_at is not None:
+            self.add('keypress', (end - self.key_at) * 1000)
+            event.update(event='keypress', key=self.key,
+                         ms=round((end - self.key_at) * 1000, 3))
+            self.key_at = None
+        self.write(event)
+        self.pending = dict.fromkeys(PHASES, 0.0)
+
+    def add(self, category, ms):
+        self.samples[category].append(ms)
+
+    def write(self, event):
+        if self.log:
+            self.log.write(json.dumps(event) + '\n')
+
+    def histogram(self, category):
+        counts = [0] * (len(BUCKETS_MS) + 1)
+        for ms in self.samples[category]:
+            i = 0
+            while i < len(BUCKETS_MS) and ms > BUCKETS_MS[i]:
+                i += 1
+            counts[i] += 1
+        return counts
+
+    def percentile(self, category, p):
+        values = sorted(self.samples[category])
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def report_lines(self, width=40):
+        """
+        :return: text lines with a histogram per category
+        """
+        lines = []
+        for category in CATEGORIES:
+            values = self.samples[category]
+            lines.append('{}: {} samples, p50 {:.1f} ms, p95 {:.1f} ms, '
+                         'max {:.1f} ms'.format(
+                             category, len(values),
+                             self.percentile(category, 0.5),
+                             self.percentile(category, 0.95),
+                             max(values, default=0.0)))
+            counts = self.histogram(category)
+            most = max(counts) or 1
+            for i, count in enumerate(counts):
+                if not count:
+                    continue
+                bound = ('<= {:>4} ms'.format(BUCKETS_MS[i])
+                         if i < len(BUCKETS_MS)
+                         else ' > {:>4} ms'.format(BUCKETS_MS[-1]))
+                lines.append('  {} {:<{}} {}'.format(
+                    bound, '#' * max(1, count * width // most), width,
+                    count))
+            lines.append('')
+        return lines
+
+    def close(self):
+        if self.log:
+            for category in CATEGORIES:
+                self.write(dict(event='histogram', category=category,
+                                buckets_ms=list(BUCKETS_MS),
+                                counts=self.histogram(category)))
+            self.log.close()
+            self.log = None
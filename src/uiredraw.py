@@ -0,0 +1,209 @@
+""" Minimal redraw of the table UI for slow terminals and SSH sessions.
+
+urwid rewrites every screen line which changed, the whole line. The screen
+here compares the cells of a changed line with what is on the terminal and
+writes only the span from the first to the last changed cell. Frames are
+limited to a maximum rate, updates arriving in between are drawn together
+with the next frame.
+"""
+import time
+
+import urwid
+from urwid import escape
+from urwid.str_util import get_width
+
+# Upper bounds of the histogram buckets, the last bucket is unbounded.
+BUCKETS_BYTES = (16, 64, 256, 1024, 4096, 16384)
+
+
+def row_cells(row):
+    """
+    :return: (attr, charset, bytes) of each terminal cell of a canvas row,
+             None when the row has characters not one cell wide
+    """
+    utf8 = urwid.get_encoding_mode() == 'utf8'
+    cells = []
+    for a, cs, run in row:
+        if cs is None and utf8:
+            for c in run.decode('utf-8', 'replace'):
+                if get_width(ord(c)) != 1:
+                    return None
+                cells.append((a, cs, c.encode('utf-8')))
+        elif cs is None and urwid.get_encoding_mode() == 'wide':
+            return None
+        else:
+            cells.extend((a, cs, run[i:i + 1]) for i in range(len(run)))
+    return cells
+
+
+def changed_span(old, new):
+    """
+    :return: first and end index of the cells differing, None when the same
+    """
+    if old == new:
+        return None
+    if old is None or len(old) != len(new):
+        return 0, len(new)
+    start = 0
+    while old[start] == new[start]:
+        start += 1
+    end = len(new)
+    while old[end - 1] == new[end - 1]:
+        end -= 1
+    return start, end
+
+
+class MinimalRedrawScreen(urwid.raw_display.Screen):
+    def __init__(self, *args, **kwargs):
+        super(MinimalRedrawScreen, self).__init__(*args, **kwargs)
+        self.frame_bytes = []
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data.encode('utf-8', 'replace')
+                            if isinstance(data, str) else data)
+        super(MinimalRedrawScreen, self).write(data)
+
+    def draw_screen(self, maxres, r):
+        written = self.written
+        self.draw_changed_cells(maxres, r)
+        if self.written != written:
+            self.frame_bytes.append(self.written - written)
+
+    def draw_changed_cells(self, maxres, r):
+        maxcol, maxrow = maxres
+        if self.screen_buf and r is self._screen_buf_canvas:
+            return
+        rows = list(r.content())
+        if (self._resized or self._rows_used is not None or
+                not self.screen_buf or len(self.screen_buf) != len(rows)):
+            return super(MinimalRedrawScreen, self).draw_screen(maxres, r)
+
+        o = [escape.HIDE_CURSOR]
+        for y, row in enumerate(rows):
+            old = self.screen_buf[y]
+            if old == row:
+                continue
+            new_cells = row_cells(row)
+            if new_cells is None:
+                span = (0, None)
+            else:
+                span = changed_span(row_cells(old), new_cells)
+            if span is None:
+                continue
+            start, end = span
+            if y == maxrow - 1 and (end is None or end >= maxcol):
+                # The bottom right cell would scroll the terminal, urwid
+                # knows how to write it.
+                return super(MinimalRedrawScreen, self).draw_screen(maxres,
+                                                                    r)
+            o.append(escape.set_cursor_position(start, y))
+            if new_cells is None:
+                o.extend(self.cells_to_escape(row))
+            else:
+                o.extend(self.cells_to_escape(new_cells[start:end]))
+
+        if r.cursor is not None:
+            x, y = r.cursor
+            o += [escape.set_cursor_position(x, y), escape.SHOW_CURSOR]
+            self._cy = y
+        try:
+            for part in o:
+                if isinstance(part, bytes):
+                    part = part.decode('utf-8', 'replace')
+                self.write(part)
+            self.flush()
+        except IOError as e:
+            # ignore interrupted syscall
+            if e.args[0] != 4:
+                raise
+        self.screen_buf = rows
+        self._screen_buf_canvas = r
+
+    def cells_to_escape(self, cells):
+        o = []
+        lasta = lastcs = object()
+        for a, cs, text in cells:
+            if lasta != a:
+                if a in self._pal_escape:
+                    o.append(self._pal_escape[a])
+                elif isinstance(a, urwid.AttrSpec):
+                    o.append(self._attrspec_to_escape(a))
+                else:
+                    o.append(self._attrspec_to_escape(
+                        urwid.AttrSpec('default', 'default')))
+                lasta = a
+            if lastcs != cs:
+                if lastcs == 'U':
+                    o.append(escape.IBMPC_OFF)
+                if cs is None:
+                    o.append(escape.SI)
+                elif cs == 'U':
+                    o.append(escape.IBMPC_ON)
+                else:
+                    o.append(escape.SO)
+                lastcs = cs
+            if cs != 'U':
+                text = text.translate(
+                    urwid.raw_display.UNPRINTABLE_TRANS_TABLE)
+            o.append(text)
+        if lastcs == 'U':
+            o.append(escape.IBMPC_OFF)
+        return o
+
+    def report_lines(self, width=40):
+        """
+        :return: text lines with a histogram of the bytes per frame
+        """
+        values = sorted(self.frame_bytes)
+        if not values:
+            return ['bytes per frame: 0 frames']
+        lines = ['bytes per frame: {} frames, {} bytes, p50 {}, p95 {}, '
+                 'max {}'.format(len(values), sum(values),
+                                 values[len(values) // 2],
+                                 values[min(len(values) - 1,
+                                            int(len(values) * 0.95))],
+                                 values[-1])]
+        counts = [0] * (len(BUCKETS_BYTES) + 1)
+        for n in values:
+            i = 0
+            while i < len(BUCKETS_BYTES) and n > BUCKETS_BYTES[i]:
+                i += 1
+            counts[i] += 1
+        most = max(counts)
+        for i, count in enumerate(counts):
+            if not count:
+                continue
+            bound = ('<= {:>5} B'.format(BUCKETS_BYTES[i])
+                     if i < len(BUCKETS_BYTES)
+                     else ' > {:>5} B'.format(BUCKETS_BYTES[-1]))
+            lines.append('  {} {:<{}} {}'.format(
+                bound, '#' * max(1, count * width // most), width, count))
+        return lines
+
+
+def cap_frame_rate(loop, draw_screen, max_fps):
+    """
+    :return: draw_screen drawing at most max_fps frames a second, a frame
+             asked for earlier is drawn once the interval has passed. With
+             max_fps 0 every frame is drawn.
+    """
+    if not max_fps:
+        return draw_screen
+    interval = 1.0 / max_fps
+    state = dict(last=0.0, alarm=None)
+
+    def interval_passed(loop, user_data):
+        # The main loop draws the screen when it becomes idle after this.
+        state['alarm'] = None
+
+    def capped_draw_screen():
+        wait = state['last'] + interval - time.monotonic()
+        if wait > 0:
+            if state['alarm'] is None:
+                state['alarm'] = loop.set_alarm_in(wait, interval_passed)
+            return
+        state['last'] = time.monotonic()
+        draw_screen()
+
+    return capped_draw_screen
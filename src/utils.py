@@ -1,10 +1,209 @@
-import delegator
+import contextlib
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
 
 
-def run_cmd(cmd, cmd_title='', verbose=False):
-    lines = []
+class CommandTimeout(Exception):
+    pass
+
+
+class CommandCancelled(Exception):
+    pass
+
+
+# Deadline and cancel event of the operation the current thread runs
+# commands for, see deadline().
+operation = threading.local()
+
+# Seconds between checks of the cancel event while a command runs.
+CANCEL_POLL_INTERVAL = 0.05
+
+
+@contextlib.contextmanager
+def deadline(seconds=None, cancel=None):
+    """
+    Commands run in the block together get at most seconds and are stopped
+    once the threading.Event cancel is set. Nested blocks keep the earlier
+    deadline and the outer cancel event when not given one.
+    """
+    previous = (getattr(operation, 'deadline', None),
+                getattr(operation, 'cancel', None))
+    end = previous[0]
+    if seconds:
+        end = time.monotonic() + seconds
+        if previous[0] is not None:
+            end = min(end, previous[0])
+    operation.deadline = end
+    operation.cancel = cancel or previous[1]
+    try:
+        yield
+    finally:
+        operation.deadline, operation.cancel = previous
+
+
+def remaining_time():
+    """
+    :return: seconds left until the deadline of the current operation or
+             None without a deadline
+    """
+    end = getattr(operation, 'deadline', None)
+    if end is None:
+        return None
+    return max(0, end - time.monotonic())
+
+
+def run_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                input=None, check=False, foreground=False):
+    """
+    Runs cmd within the deadline of the current operation.
+    :param input: bytes written to the standard input of cmd
+    :param check: raise subprocess.CalledProcessError when cmd fails
+    :param foreground: keep cmd in the session of the terminal, so it can
+                       ask for passwords and passphrases. Only cmd itself
+                       is killed then, not the commands it started.
+    :return: the output when stdout is PIPE
+    :raise CommandTimeout: the deadline passed, the command was killed
+    :raise CommandCancelled: the operation was cancelled, the command was
+                             killed
+    """
+    end = getattr(operation, 'deadline', None)
+    cancel = getattr(operation, 'cancel', None)
+    # A session of its own lets the whole group be killed, e.g. a textconv
+    # filter started by git diff.
+    stdin = None
+    if input:
+        # communicate cannot go on writing input after a timeout, a thread
+        # writes it instead while the loop below polls.
+        stdin, input_fd = os.pipe()
+    try:
+        process = subprocess.Popen(cmd, shell=isinstance(cmd, str),
+                                   stdin=stdin, stdout=stdout, stderr=stderr,
+                                   start_new_session=not foreground)
+    except BaseException:
+        if input:
+            os.close(input_fd)
+        raise
+    finally:
+        if input:
+            os.close(stdin)
+    if input:
+        threading.Thread(target=write_input, args=(input_fd, input),
+                         daemon=True).start()
+    while True:
+        timeout = None
+        if end is not None:
+            timeout = max(0, end - time.monotonic())
+        if cancel is not None:
+            timeout = min(timeout or CANCEL_POLL_INTERVAL,
+                          CANCEL_POLL_INTERVAL)
+        try:
+            out, _ = process.communicate(timeout=timeout)
+            if check and process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+            return out
+        except subprocess.TimeoutExpired:
+            pass
+        if cancel is not None and cancel.is_set():
+            kill(process, group=not foreground)
+            raise CommandCancelled(cmd)
+        if end is not None and time.monotonic() >= end:
+            kill(process, group=not foreground)
+            raise CommandTimeout(cmd)
+
+
+def write_input(fd, input):
+    """ Writes input to the pipe fd and closes it. """
+    try:
+        with open(fd, 'wb') as f:
+            f.write(input)
+    except BrokenPipeError:
+        # The command exited or was killed without reading all of it.
+        pass
+
+
+def kill(process, group=True):
+    """
+    :param group: kill the process group led by process, which started a
+                  session of its own
+    """
+    try:
+        if group:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+    process.communicate()
+
+
+def run_cmd(cmd, cmd_title='', verbose=False, separator='\n'):
+    """
+    :param cmd: argv list, executed without a shell. A string is still run
+                by the shell for customized env lookups relying on it.
+    :param separator: '\\0' for output of git commands given -z, the fields
+                      are then returned verbatim
+    """
+    shell = isinstance(cmd, str)
     if verbose:
-        print(cmd_title + '  : ' + cmd)
-    for line in delegator.run(cmd).out.splitlines():
+        print(cmd_title + '  : ' + (cmd if shell else shlex.join(cmd)),
+              file=sys.stderr)
+    out = run_process(cmd)
+    # surrogateescape keeps undecodable path bytes intact when the path is
+    # passed back to git as an argument.
+    out = out.decode(errors='surrogateescape')
+    if separator != '\n':
+        return [x for x in out.split(separator) if len(x) > 0]
+    lines = []
+    for line in out.splitlines():
         lines.append(line.rstrip())
     return list(filter(lambda x: len(x) > 0, lines))
+
+
+def stream_cmd(cmd, out, cmd_title='', verbose=False):
+    """
+    Runs an argv list with its output going straight to the file out.
+    """
+    if verbose:
+        print(cmd_title + '  : ' + shlex.join(cmd), file=sys.stderr)
+    run_process(cmd, stdout=out)
+
+
+def git_toplevel():
+    for line in run_cmd(['git', 'rev-parse', '--show-toplevel']):
+        return line
+    return '.'
+
+
+def git_path(name):
+    """
+    :return: absolute path of name in the git directory, which is not
+             ./.git below the top of the repository, in a worktree or in a
+             submodule
+    """
+    for line in run_cmd(['git', 'rev-parse', '--git-path', name]):
+        return os.path.abspath(line)
+    return os.path.abspath(os.path.join('.git', name))
+
+
+def db_text(text):
+    """
+    :return: text to bind in a SQLite query, bytes when it holds undecodable
+             bytes of a path read with surrogateescape, which SQLite can not
+             store as text
+    """
+    try:
+        text.encode()
+        return text
+    except UnicodeEncodeError:
+        return text.encode(errors='surrogateescape')
+
+
+def from_db_text(value):
+    if isinstance(value, bytes):
+        return value.decode(errors='surrogateescape')
+    return value
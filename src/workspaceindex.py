@@ -1,81 +1,587 @@
 """ Get information about the relevant changes worked on right now.
 """
+import contextlib
 import inspect
 import os
+import re
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-# noinspection PyPackageRequirements
-import delegator
+import utils
+from pathscope import IGNORE_FILE
+from stages import registry, stage_shortnames, StageScheduler
 
-debug = True
+# Traces the git commands to stderr, enabled by -v.
+debug = False
 
+# Rename tracking is optional as inexact rename detection is expensive on
+# large ranges. rename_limit is passed to git as -l, past it git falls back
+# to exact renames only instead of stalling the refresh.
+find_renames = False
+rename_limit = 1000
+rename_cache = {}
+renamed_from = {}
 
-def run_cmd(cmd, cmd_title=''):
-    lines = []
-    if debug:
-        print(cmd_title + '  : ' + cmd)
-    for line in delegator.run(cmd).out.splitlines():
-        lines.append(line.rstrip())
-    return list(filter(lambda x: len(x) > 0, lines))
+# Promisor remotes per repository. In a partial clone, e.g. cloned with
+# --filter=blob:none, git downloads a missing blob on its own once one at
+# a time, so the stages are computed from commits and trees only and the
+# blobs a diff needs are fetched beforehand in one request.
+promisor_cache = {}
+fetched_blobs = set()
+OBJECT_ID = re.compile('[0-9a-f]{40,64}')
 
+# pathscope.PathScope limiting every query to a part of the repository
+path_scope = None
 
-def analyze_changes_unstaged():
-    filepaths = map_paths(
-        run_cmd('git diff --name-only', inspect.stack()[0][0].f_code.co_name))
-    return {'filepaths': filepaths, 'commits': []}
+# Submodules are analyzed against their own remotes and tags, at most
+# submodule_jobs of them at a time. Their files get rows prefixed by the
+# submodule path.
+recurse_submodules = False
+submodule_jobs = 8
+submodule_stage_data = {}
+
+# Seconds git fetch may take before startup goes on with the local refs,
+# and seconds each stage, diff or other git operation may take.
+fetch_timeout = 120
+git_timeout = 60
+
+# Diffs of files larger than this are summarized by their size unless asked
+# for, and the UI shows this many lines of diffs at a time.
+diff_size_limit = 512 * 1024
+diff_line_limit = 500
+
+# Repository the git commands of a thread run in, the working directory
+# unless a submodule is being analyzed.
+repo = threading.local()
+
+# Top directory of the repository of each working directory.
+toplevels = {}
+
+
+@contextlib.contextmanager
+def in_repo(path):
+    previous = getattr(repo, 'path', None)
+    repo.path = path
+    try:
+        yield
+    finally:
+        repo.path = previous
+
+
+def toplevel():
+    """
+    :return: top directory of the repository gitradar runs in, usually one
+             directory above the working directory
+    """
+    cwd = os.getcwd()
+    if cwd not in toplevels:
+        toplevels[cwd] = utils.git_toplevel()
+    return toplevels[cwd]
+
+
+def git_cmd(cmd):
+    path = getattr(repo, 'path', None)
+    if path and cmd[:1] == ['git']:
+        # Submodule paths are relative to the top, not to the working
+        # directory.
+        return ['git', '-C', os.path.join(toplevel(), path)] + cmd[1:]
+    return cmd
+
+
+def git_deadline(cancel=None):
+    """
+    Limits the git commands of the block to git_timeout seconds.
+    :param cancel: threading.Event stopping the commands once set
+    """
+    return utils.deadline(git_timeout, cancel)
+
+
+def scope_pathspec():
+    # The scope is on paths of the superproject, submodule rows are
+    # filtered once prefixed.
+    if path_scope is None or getattr(repo, 'path', None):
+        return []
+    return ['--'] + path_scope.pathspec_args()
+
+
+def run_cmd(cmd, cmd_title='', separator='\n'):
+    return utils.run_cmd(git_cmd(cmd), cmd_title, debug, separator)
+
+
+def stream_cmd(cmd, out, cmd_title=''):
+    return utils.stream_cmd(git_cmd(cmd), out, cmd_title, debug)
+
+
+def run_cmd_z(cmd, cmd_title=''):
+    """ For git commands given -z, file paths come back verbatim. """
+    return run_cmd(cmd, cmd_title, '\0')
+
+
+def promisor_remotes():
+    """
+    :return: remotes missing objects are fetched from, empty unless the
+             repository is a partial clone
+    """
+    key = getattr(repo, 'path', None)
+    if key not in promisor_cache:
+        remotes = []
+        for line in run_cmd(['git', 'config', '--get-regexp',
+                             r'^remote\..*\.promisor$'],
+                            inspect.stack()[0][0].f_code.co_name):
+            name, _, value = line.partition(' ')
+            if value.lower() in ('true', 'yes', 'on', '1'):
+                remotes.append(name[len('remote.'):-len('.promisor')])
+        promisor_cache[key] = remotes
+    return promisor_cache[key]
+
+
+def name_only_rename_args():
+    """
+    Limits git diff --name-only to exact renames in a partial clone, as
+    inexact rename detection reads the blobs of added and deleted files.
+    """
+    if promisor_remotes():
+        return ['--find-renames=100%']
+    return []
+
+
+def diff_raw_entries(cmds):
+    """
+    Files a git diff or git show command compares, found from the trees.
+    :return: list of (old blob id, new blob id, status, path), an id of
+             zeros is a missing file or the work tree
+    """
+    entries = []
+    for cmd in cmds:
+        raw = cmd[:2] + ['--raw', '--no-abbrev', '-z', '--no-renames']
+        if cmd[1] == 'show':
+            raw += ['--format=']
+        fields = iter(run_cmd_z(raw + cmd[2:],
+                                inspect.stack()[0][0].f_code.co_name))
+        for field in fields:
+            if field.startswith(':'):
+                _, _, old_id, new_id, status = field[1:].split(' ')[:5]
+                entries.append((old_id, new_id, status, next(fields, '')))
+    return entries
+
+
+def diff_blob_ids(cmds):
+    """
+    Blob ids a git diff or git show command reads, found from the trees.
+    """
+    return {blob_id for entry in diff_raw_entries(cmds)
+            for blob_id in entry[:2]
+            if OBJECT_ID.fullmatch(blob_id) and blob_id.strip('0')}
+
+
+def blob_sizes(blob_ids):
+    """
+    Sizes of the blobs from one git cat-file query.
+    :return: dict of blob id to size, missing ones are left out
+    """
+    blob_ids = sorted(blob_ids)
+    if not blob_ids:
+        return {}
+    out = utils.run_process(git_cmd(
+        ['git', 'cat-file', '--batch-check=%(objectname) %(objectsize)']),
+        input='\n'.join(blob_ids).encode())
+    sizes = {}
+    for line in out.decode(errors='replace').splitlines():
+        blob_id, _, size = line.partition(' ')
+        if size.isdigit():
+            sizes[blob_id] = int(size)
+    return sizes
+
+
+def diff_blob_sizes(stage_names, main_branch, dev_branch, fp, stage_data):
+    """
+    Sizes of the file before and after in the diff of each stage, the blobs
+    of all stages queried at once.
+    :return: dict of stage name to (old size, new size), a size is None
+             when the file is absent, stages diffed by custom code are left
+             out
+    """
+    submodule, path = submodule_of(fp)
+    prefix = submodule + '/' if submodule is not None else ''
+    entries = {}
+    with in_repo(submodule):
+        for stage_name in stage_names:
+            status = stage_data.get(stage_name)
+            if submodule is not None:
+                status = submodule_stage_data[submodule].get(stage_name)
+            if status is None or not set(status['filepaths']).intersection(
+                    paths_of_row(path, prefix)):
+                continue
+            if stage_name == 'untracked':
+                entries[stage_name] = [('0' * 40, '0' * 40, 'A', path)]
+                continue
+            cmds = stage_diff_cmds(stage_name, main_branch, dev_branch,
+                                   [path], status, prefix)
+            if cmds is not None:
+                entries[stage_name] = diff_raw_entries(cmds)
+        sizes = blob_sizes({blob_id for stage in entries.values()
+                            for entry in stage for blob_id in entry[:2]
+                            if blob_id.strip('0')})
+        top = None
+        result = {}
+        for stage_name, stage_entries in entries.items():
+            if not stage_entries:
+                continue
+            old_size = new_size = None
+            # A git show of many commits compares the file once per commit,
+            # the first and last version are summarized.
+            for i, (old_id, new_id, status, entry_path) in enumerate(
+                    stage_entries):
+                if i == 0 and status[0] != 'A':
+                    old_size = sizes.get(old_id)
+                if status[0] == 'D':
+                    new_size = None
+                elif new_id.strip('0'):
+                    new_size = sizes.get(new_id)
+                else:
+                    # The work tree side of git diff.
+                    if top is None:
+                        top = run_cmd(['git', 'rev-parse', '--show-toplevel'],
+                                      inspect.stack()[0][0].f_code.co_name)
+                    try:
+                        new_size = os.path.getsize(
+                            os.path.join(top[0], entry_path))
+                    except (OSError, IndexError):
+                        new_size = None
+            result[stage_name] = (old_size, new_size)
+    return result
+
+
+def format_size(size):
+    if size is None:
+        return '-'
+    if size < 1024:
+        return '{} B'.format(size)
+    if size < 1024 * 1024:
+        return '{:.1f} kB'.format(size / 1024)
+    return '{:.1f} MB'.format(size / 1024 / 1024)
+
+
+def size_summary(sizes):
+    """ One line telling how the size of a file changed. """
+    old_size, new_size = sizes
+    delta = (new_size or 0) - (old_size or 0)
+    return '{} -> {} ({}{})'.format(format_size(old_size),
+                                    format_size(new_size),
+                                    '+' if delta >= 0 else '-',
+                                    format_size(abs(delta)))
+
+
+def index_blob_ids(pathspec):
+    """ Blob ids of the index, which a checkout has downloaded. """
+    blob_ids = set()
+    # Chunked to keep the command line short.
+    for i in range(0, len(pathspec), 1000):
+        for entry in run_cmd_z(['git', 'ls-files', '-s', '-z', '--']
+                               + pathspec[i:i + 1000],
+                               inspect.stack()[0][0].f_code.co_name):
+            blob_ids.add(entry.split(' ')[1])
+    return blob_ids
+
+
+def prefetch_blobs(blob_ids):
+    """
+    Downloads blobs of a partial clone in one request per remote, those of
+    the index and those fetched earlier are skipped.
+    """
+    wanted = sorted(set(blob_ids) - fetched_blobs)
+    if not wanted:
+        return
+    for remote in promisor_remotes():
+        try:
+            # Like git does for a single missing blob, without negotiation
+            # as all that is wanted are these objects.
+            utils.run_process(git_cmd([
+                'git', '-c', 'fetch.negotiationAlgorithm=noop', 'fetch',
+                remote, '--no-tags', '--no-write-fetch-head',
+                '--recurse-submodules=no', '--filter=blob:none', '--stdin']),
+                input='\n'.join(wanted).encode(), check=True)
+        except subprocess.CalledProcessError:
+            # The remote lacks some of them, e.g. origin the commits only
+            # on upstream, they are asked from the next one.
+            continue
+        fetched_blobs.update(wanted)
+        return
+
+
+def prefetch_diff_blobs(stage_names, main_branch, dev_branch, filepaths,
+                        stage_data):
+    """
+    Fetches the blobs the diffs of the files need in a partial clone, in
+    one request instead of one per blob.
+    """
+    by_repo = {}
+    for fp in filepaths:
+        submodule, path = submodule_of(fp)
+        by_repo.setdefault(submodule, []).append(path)
+    for submodule, paths in by_repo.items():
+        with in_repo(submodule):
+            if not promisor_remotes():
+                continue
+            prefix = submodule + '/' if submodule is not None else ''
+            cmds = []
+            for stage_name in stage_names:
+                status = stage_data.get(stage_name)
+                if submodule is not None:
+                    status = submodule_stage_data[submodule].get(stage_name)
+                # The index and HEAD are checked out, thus downloaded.
+                if status is None or stage_name in ('untracked', 'unstaged',
+                                                    'staged'):
+                    continue
+                stage_paths = set(status['filepaths'])
+                in_stage = [path for path in paths
+                            if stage_paths.intersection(
+                                paths_of_row(path, prefix))]
+                if in_stage:
+                    cmds += stage_diff_cmds(stage_name, main_branch,
+                                            dev_branch, in_stage, status,
+                                            prefix) or []
+            blob_ids = diff_blob_ids(cmds)
+            if blob_ids:
+                prefetch_blobs(blob_ids - index_blob_ids(
+                    batch_pathspec(paths, prefix)))
+
+
+def detect_renames(old_ref, new_ref):
+    if not find_renames:
+        return {}
+    key = tuple(run_cmd(['git', 'rev-parse', old_ref, new_ref],
+                        inspect.stack()[0][0].f_code.co_name))
+    key += (rename_limit, tuple(scope_pathspec()))
+    if key not in rename_cache:
+        if promisor_remotes():
+            # Rename detection compares the added and deleted files.
+            prefetch_blobs(diff_blob_ids(
+                [['git', 'diff', '--diff-filter=AD', old_ref, new_ref]
+                 + scope_pathspec()]))
+        renames = {}
+        fields = iter(run_cmd_z(['git', 'diff', '--name-status', '-z', '-M',
+                                 f'-l{rename_limit}', old_ref, new_ref]
+                                + scope_pathspec(),
+                                inspect.stack()[0][0].f_code.co_name))
+        # Entries are status, path and for renames and copies a second path
+        for status in fields:
+            old_path = next(fields, None)
+            if status[0] in 'RC':
+                new_path = next(fields, None)
+                if status[0] == 'R':
+                    renames[old_path] = new_path
+        rename_cache[key] = renames
+    return rename_cache[key]
+
+
+def detect_renames_of_commits(commit_ids):
+    renames = {}
+    for commit_id in commit_ids:
+        renames.update(detect_renames(f'{commit_id}^', commit_id))
+    return renames
+
+
+def link_renamed_paths(renames):
+    """
+    Maps every old path to the newest path it was renamed to.
+    :param renames: dict of old path -> new path
+    :return: dict of old path -> newest path
+    """
+    mapping = {}
+    for old in renames:
+        new = renames[old]
+        seen = {old}
+        while new in renames and new not in seen:
+            seen.add(new)
+            new = renames[new]
+        mapping[old] = new
+    return mapping
+
+
+# Let git use its untracked cache and a file system monitor for the status
+# of the worktree. The untracked cache is stored in the index by git.
+status_accelerators = False
+fsmonitor_supported = None
+
+
+def status_config():
+    global fsmonitor_supported
+    if not status_accelerators:
+        return []
+    if fsmonitor_supported is None:
+        fsmonitor_supported = any(
+            'fsmonitor--daemon' in line for line in
+            run_cmd(['git', 'version', '--build-options'],
+                    inspect.stack()[0][0].f_code.co_name))
+    config = ['-c', 'core.untrackedCache=true']
+    if fsmonitor_supported:
+        config += ['-c', 'core.fsmonitor=true']
+    return config
+
+
+def analyze_worktree_status():
+    """
+    Unstaged, staged and untracked files from one git status pass.
+    """
+    unstaged = []
+    staged = []
+    untracked = []
+    fields = iter(run_cmd_z(['git'] + status_config() +
+                            ['status', '--porcelain=v2', '-z',
+                             '--untracked-files=all'] + scope_pathspec(),
+                            inspect.stack()[0][0].f_code.co_name))
+    for field in fields:
+        kind = field[0]
+        if kind == '?':
+            # The radar's own ignore file is not a change worked on.
+            if field[2:] != IGNORE_FILE:
+                untracked.append(field[2:])
+        elif kind in '12u':
+            # Ordinary, renamed and unmerged entries have 8, 9 and 10 fields
+            # before the path. The original path of a rename follows.
+            parts = field.split(' ', {'1': 8, '2': 9, 'u': 10}[kind])
+            xy, path = parts[1], parts[-1]
+            if kind == '2':
+                next(fields, None)
+            if xy[0] != '.' and kind != 'u':
+                staged.append(path)
+            if xy[1] != '.' or kind == 'u':
+                unstaged.append(path)
+    return {'unstaged': unstaged, 'staged': staged, 'untracked': untracked}
+
+
+def analyze_changes_unstaged(status=None):
+    if status is None:
+        status = analyze_worktree_status()
+    return {'filepaths': map_paths(status['unstaged']), 'commits': []}
 
 
 def analyze_changes_unstaged_diff(fp):
     return '\n'.join(
-        run_cmd('git diff ' + fp, inspect.stack()[0][0].f_code.co_name))
+        run_cmd(['git', 'diff', '--', fp],
+                inspect.stack()[0][0].f_code.co_name))
 
 
-def analyze_changes_staged():
-    filepaths = map_paths(
-        run_cmd('git diff --name-only --cached',
+def analyze_changes_untracked(status=None):
+    if status is None:
+        status = analyze_worktree_status()
+    return {'filepaths': map_paths(status['untracked']), 'commits': []}
+
+
+def analyze_changes_untracked_diff(fp):
+    return '\n'.join(
+        run_cmd(['git', 'diff', '--no-index', '--', os.devnull, fp],
                 inspect.stack()[0][0].f_code.co_name))
-    return {'filepaths': filepaths, 'commits': []}
+
+
+def analyze_changes_staged(status=None):
+    if status is None:
+        status = analyze_worktree_status()
+    return {'filepaths': map_paths(status['staged']), 'commits': []}
 
 
 def analyze_changes_staged_diff(fp):
-    return '\n'.join(run_cmd('git diff --cached ' + fp,
+    return '\n'.join(run_cmd(['git', 'diff', '--cached', '--', fp],
                              inspect.stack()[0][0].f_code.co_name))
 
 
+def log_filepath_to_commits(rev_args):
+    """
+    Lists the commits of a revision range together with the files each of
+    them touched, in a single git log pass.
+    :param rev_args: list of git log arguments selecting the commits
+    :return: commit ids newest first, dict of file path -> commit ids
+    """
+    commits = []
+    filepath_to_commits = {}
+    # Each commit starts with \x01, its id and a newline before the first
+    # NUL terminated path.
+    for field in run_cmd_z(['git', 'log', '-z', '--format=format:%x01%H',
+                            '--name-only', '--no-renames'] + rev_args
+                           + scope_pathspec(),
+                           inspect.stack()[0][0].f_code.co_name):
+        if field.startswith('\x01'):
+            commit_id, _, field = field[1:].partition('\n')
+            commits.append(commit_id)
+        if field and commits:
+            filepath_to_commits.setdefault(field, []).append(commits[-1])
+    return commits, filepath_to_commits
+
+
+def index_filepath_to_commits(commits, filepath_to_commit_ids):
+    """
+    Stores the commits of each file as positions in the stage's commit list,
+    so the index of a big range does not repeat 40 char ids per file.
+    """
+    position = {commit_id: i for i, commit_id in enumerate(commits)}
+    return {fp: [position[c] for c in commit_ids if c in position]
+            for fp, commit_ids in filepath_to_commit_ids.items()}
+
+
+def stage_commits_of_file(stage, fp):
+    """
+    Commit ids of a stage which touched the file, an O(1) index lookup.
+    """
+    commits = stage.get('commits', [])
+    return [commits[i] for i in
+            stage.get('filepath_to_commits', {}).get(fp, [])]
+
+
 def analyze__in_commits_but_not_pushed(devbranch):
     # TODO Make this detect current branch instead of parameterizing
     filepaths = map_paths(
-        run_cmd('git diff origin/{}..HEAD --name-only'.format(devbranch),
-                inspect.stack()[0][0].f_code.co_name))
-    commits_not_pushed = run_cmd(
-        'git log --format=format:%H origin/{}..HEAD'.format(devbranch),
-        inspect.stack()[0][0].f_code.co_name)
-    return {'filepaths': filepaths, 'commits': commits_not_pushed}
+        run_cmd_z(['git', 'diff', f'origin/{devbranch}..HEAD',
+                   '--name-only', '-z'] + name_only_rename_args()
+                  + scope_pathspec(),
+                  inspect.stack()[0][0].f_code.co_name))
+    commits_not_pushed, filepath_to_commits = log_filepath_to_commits(
+        [f'origin/{devbranch}..HEAD'])
+    return {'filepaths': filepaths, 'commits': commits_not_pushed,
+            'filepath_to_commits': index_filepath_to_commits(
+                commits_not_pushed, filepath_to_commits),
+            'renames': detect_renames(f'origin/{devbranch}', 'HEAD')}
 
 
 def analyze_changes_in_commits_but_not_pushed_diff(devbranch, fp):
     return '\n'.join(
-        run_cmd('git diff origin/{}..HEAD {}'.format(devbranch, fp),
+        run_cmd(['git', 'diff', f'origin/{devbranch}..HEAD', '--', fp],
                 inspect.stack()[0][0].f_code.co_name))
 
 
 def analyze__in_commits(commit_ids):
-    filepaths = []
-    for commit_id in commit_ids:
-        filepaths += map_paths(
-            run_cmd(f'git diff --name-only {commit_id}^ {commit_id}',
+    # Merge commits are listed against their first parent like git diff c^ c
+    commits, filepath_to_commits = log_filepath_to_commits(
+        ['--no-walk=unsorted', '-m', '--first-parent'] + list(commit_ids))
+    filepaths = map_paths(list(filepath_to_commits))
+    return {'filepaths': filepaths, 'commits': commits,
+            'filepath_to_commits': index_filepath_to_commits(
+                commits, filepath_to_commits),
+            'renames': detect_renames_of_commits(commit_ids)}
+
+
+def analyze_changes_in_commits_diff(commit_ids, fp, status=None):
+    if status is None:
+        status = analyze__in_commits(commit_ids)
+    out = ''
+    for commit_id in stage_commits_of_file(status, fp.replace('../', '')):
+        out += '\n'.join(
+            run_cmd(['git', 'show', commit_id, '--', fp],
                     inspect.stack()[0][0].f_code.co_name))
-    return {'filepaths': filepaths, 'commits': commit_ids}
+    return out or None
 
 
-def analyze_changes_in_commits_diff(commit_ids, fp):
-    status = analyze__in_commits(commit_ids)
-    if fp.replace('../', '') in status['filepaths']:
-        out = ''
-        for commit_id in commit_ids:
-            out += '\n'.join(
-                run_cmd(f'git show {commit_id} {fp}',
-                        inspect.stack()[0][0].f_code.co_name))
-        return out
+def commits_not_in(upstream):
+    """
+    Commits of HEAD not in upstream, oldest first, the commits git cherry
+    lists. Read from the commit graph, git cherry would also compute patch
+    ids from the blobs of the commits.
+    """
+    return run_cmd(['git', 'rev-list', '--reverse', '--no-merges',
+                    f'{upstream}..HEAD'],
+                   inspect.stack()[0][0].f_code.co_name)
 
 
 def analyze__in_branch(branch, main_branch, remote):
@@ -83,14 +589,20 @@ def analyze__in_branch(branch, main_branch, remote):
     if remote:
         remote_and_slash = remote + '/'
     filepaths = map_paths(
-        run_cmd(
-            f'git diff --name-only {branch}..{remote_and_slash}{main_branch}',
-            inspect.stack()[0][0].f_code.co_name))
-    commits = map(
-        lambda x: x[2:].strip(),
-        run_cmd(f'git cherry {remote_and_slash}{main_branch}',
-                inspect.stack()[0][0].f_code.co_name))
-    return {'filepaths': filepaths, 'commits': commits}
+        run_cmd_z(['git', 'diff', '--name-only', '-z',
+                   f'{branch}..{remote_and_slash}{main_branch}']
+                  + name_only_rename_args() + scope_pathspec(),
+                  inspect.stack()[0][0].f_code.co_name))
+    commits = commits_not_in(f'{remote_and_slash}{main_branch}')
+    filepath_to_commits = {}
+    if commits:
+        _, filepath_to_commits = log_filepath_to_commits(
+            ['--no-walk=unsorted'] + commits)
+    return {'filepaths': filepaths, 'commits': commits,
+            'filepath_to_commits': index_filepath_to_commits(
+                commits, filepath_to_commits),
+            'renames': detect_renames(branch,
+                                      f'{remote_and_slash}{main_branch}')}
 
 
 def analyze_changes_in_branch_diff(branch, main_branch, remote, fp):
@@ -98,114 +610,402 @@ def analyze_changes_in_branch_diff(branch, main_branch, remote, fp):
     if remote:
         remote_and_slash = remote + '/'
     return '\n'.join(
-        run_cmd(f'git diff {branch}..{remote_and_slash}{main_branch} {fp}',
-                inspect.stack()[0][0].f_code.co_name))
+        run_cmd(['git', 'diff', f'{branch}..{remote_and_slash}{main_branch}',
+                 '--', fp], inspect.stack()[0][0].f_code.co_name))
 
 
-def analyze__pushed_but_not_merged(devbranch, main_branch):
-    commits = map(
-        lambda x: x[2:].strip(),
-        run_cmd('git cherry upstream/' + main_branch,
-                inspect.stack()[0][0].f_code.co_name))
+def analyze__pushed_but_not_merged(devbranch, main_branch, not_pushed=None):
+    commits = commits_not_in('upstream/' + main_branch)
 
-    not_pushed = analyze__in_commits_but_not_pushed(devbranch)
+    if not_pushed is None:
+        not_pushed = analyze__in_commits_but_not_pushed(devbranch)
 
     unmerged_commits = [x for x in commits if x not in not_pushed['commits']]
 
-    filepaths = []
     filepath_to_commits = {}
-    for commit_id in unmerged_commits:
-        filepaths_of_commit = map_paths(
-            run_cmd(f'git diff-tree --no-commit-id --name-only -r {commit_id}',
-                    inspect.stack()[0][0].f_code.co_name))
-        filepaths.extend(filepaths_of_commit)
-        for filepath in filepaths_of_commit:
-            filepath_to_commits.setdefault(filepath, []).append(commit_id)
+    if unmerged_commits:
+        _, filepath_to_commits = log_filepath_to_commits(
+            ['--no-walk=unsorted'] + unmerged_commits)
+    filepaths = map_paths(list(filepath_to_commits))
 
     return {
         'filepaths': filepaths,
         'commits': unmerged_commits,
-        'filepath_to_commits': filepath_to_commits
+        'filepath_to_commits': index_filepath_to_commits(
+            unmerged_commits, filepath_to_commits),
+        'renames': detect_renames_of_commits(unmerged_commits)
     }
 
 
-def analyze_changes_pushed_but_not_merged_diff(devbranch, main_branch, fp):
-    status = analyze__pushed_but_not_merged(devbranch, main_branch)
-    if fp.replace('../', '') in status['filepath_to_commits']:
-        out = ''
-        for commit in status['filepath_to_commits'][fp.replace('../', '')]:
-            out = f'\nDiff of {commit}'
-            out += '\n'.join(
-                run_cmd(f'git show {commit} {fp}',
-                        inspect.stack()[0][0].f_code.co_name))
-        return out
+def analyze_changes_pushed_but_not_merged_diff(devbranch, main_branch, fp,
+                                               status=None):
+    if status is None:
+        status = analyze__pushed_but_not_merged(devbranch, main_branch)
+    out = ''
+    for commit in stage_commits_of_file(status, fp.replace('../', '')):
+        out += f'\nDiff of {commit}\n'
+        out += '\n'.join(
+            run_cmd(['git', 'show', commit, '--', fp],
+                    inspect.stack()[0][0].f_code.co_name))
+    return out or None
 
 
-def analyze__in_merged_prs_not_released(main_branch):
-    latest_version_tag = run_cmd('git tag -l --sort -version:refname '
-                                 '| grep -vE "stable|show" |head -n 1',
-                                 inspect.stack()[0][0].f_code.co_name)[0]
+def comparison_ranges(spec):
+    """
+    :param spec: a ref (branch, tag, remote-tracking ref or commit) or a
+                 range A..B or A...B
+    :return: range for git diff, range for git log
+    """
+    if '...' in spec:
+        left, right = spec.split('...', 1)
+        return spec, f'{left}..{right}'
+    if '..' in spec:
+        return spec, spec
+    # A single ref shows what it changes since it forked from HEAD.
+    return f'HEAD...{spec}', f'HEAD..{spec}'
+
+
+def verify_comparison(spec):
+    """
+    Raises ValueError unless both ends of the spec name commits, as git
+    diff would otherwise show nothing or take the spec for an option.
+    """
+    ends = re.split(r'\.\.\.?', spec, maxsplit=1)
+    for ref in ends:
+        # An empty end of a range is HEAD.
+        if not ref and len(ends) == 2:
+            continue
+        try:
+            utils.run_process(git_cmd(['git', 'rev-parse', '--verify', '-q',
+                                       '--end-of-options',
+                                       ref + '^{commit}']), check=True)
+        except subprocess.CalledProcessError:
+            raise ValueError(f'{ref!r} is not a commit')
+
+
+def analyze__ref_comparison(spec):
+    verify_comparison(spec)
+    diff_range, log_range = comparison_ranges(spec)
     filepaths = map_paths(
-        run_cmd(f'git diff {latest_version_tag}..upstream/{main_branch} '
-                f'--name-only', inspect.stack()[0][0].f_code.co_name))
-    commits = [run_cmd(f'git rev-list -n 1 upstream/{main_branch}')[0]]
-    for line in run_cmd(f'git log --pretty="%H" --no-merges '
-                        f'-w {latest_version_tag}..upstream/{main_branch}'):
-        commits.append(line)
+        run_cmd_z(['git', 'diff', '--name-only', '-z', diff_range]
+                  + name_only_rename_args() + scope_pathspec(),
+                  inspect.stack()[0][0].f_code.co_name))
+    commits, filepath_to_commits = log_filepath_to_commits([log_range])
     return {'filepaths': filepaths, 'commits': commits,
-            'latest_version_tag': latest_version_tag}
+            'filepath_to_commits': index_filepath_to_commits(
+                commits, filepath_to_commits),
+            'diff_range': diff_range}
+
 
+def comparison_stages(specs):
+    """
+    Registers a node computing each ref comparison, so a refresh runs them
+    with the other stages and within their timeout.
+    :return: names of the nodes, which are the names of their columns
+    """
+    names = []
+    for spec in specs:
+        name = 'compare:' + spec
+        registry.add_node(
+            name, lambda context, inputs, spec=spec:
+            analyze__ref_comparison(spec))
+        names.append(name)
+    return names
 
-def analyze_changes_in_merged_prs_not_released_diff(main_branch, fp):
-    status = analyze__in_merged_prs_not_released(main_branch)
+
+def analyze_changes_ref_comparison_diff(fp, status):
+    return '\n'.join(
+        run_cmd(['git', 'diff', status['diff_range'], '--', fp],
+                inspect.stack()[0][0].f_code.co_name))
+
+
+def list_version_tags():
+    return [tag for tag in run_cmd(['git', 'tag', '-l',
+                                    '--sort=-version:refname'],
+                                   inspect.stack()[0][0].f_code.co_name)
+            if not re.search('stable|show', tag)]
+
+
+def analyze__in_merged_prs_not_released(main_branch, version_tags=None):
+    if version_tags is None:
+        version_tags = list_version_tags()
+    latest_version_tag = version_tags[0]
+    filepaths = map_paths(
+        run_cmd_z(['git', 'diff',
+                   f'{latest_version_tag}..upstream/{main_branch}',
+                   '--name-only', '-z'] + name_only_rename_args()
+                  + scope_pathspec(),
+                  inspect.stack()[0][0].f_code.co_name))
+    commits = [run_cmd(['git', 'rev-list', '-n', '1',
+                        f'upstream/{main_branch}'])[0]]
+    logged_commits, filepath_to_commits = log_filepath_to_commits(
+        ['--no-merges', '-w', f'{latest_version_tag}..upstream/{main_branch}'])
+    commits += [x for x in logged_commits if x != commits[0]]
+    return {'filepaths': filepaths, 'commits': commits,
+            'filepath_to_commits': index_filepath_to_commits(
+                commits, filepath_to_commits),
+            'latest_version_tag': latest_version_tag,
+            'renames': detect_renames(latest_version_tag,
+                                      f'upstream/{main_branch}')}
+
+
+def analyze_changes_in_merged_prs_not_released_diff(main_branch, fp,
+                                                    status=None):
+    if status is None:
+        status = analyze__in_merged_prs_not_released(main_branch)
     if fp.replace('../', '') in status['filepaths']:
         tag = status['latest_version_tag']
         return '\n'.join(
-            run_cmd(f'git diff {tag}..upstream/{main_branch} {fp}',
+            run_cmd(['git', 'diff', f'{tag}..upstream/{main_branch}', '--', fp],
                     inspect.stack()[0][0].f_code.co_name))
 
 
-def analyze__in_recent_production_release(n):
-    versions = run_cmd('git tag -l --sort -version:refname '
-                       '| grep -vE "stable|show" |head -n {} '
-                       '| tail -n 2'.format(n + 1),
-                       inspect.stack()[0][0].f_code.co_name)
-    newer = versions[0]
-    older = versions[1]
+def analyze__in_recent_production_release(n, version_tags=None):
+    if version_tags is None:
+        version_tags = list_version_tags()
+    newer = version_tags[n - 1]
+    older = version_tags[n]
     filepaths = map_paths(
-        run_cmd('git diff {}..{} --name-only'.format(older, newer),
-                inspect.stack()[0][0].f_code.co_name))
-    commits = [run_cmd(f'git rev-list -n 1 {newer}')[0]]
-    for line in run_cmd(
-            f'git log --pretty="%H" --no-merges -w {older}..{newer}'):
-        if line not in commits:
-            commits.append(line)
+        run_cmd_z(['git', 'diff', f'{older}..{newer}', '--name-only', '-z']
+                  + name_only_rename_args() + scope_pathspec(),
+                  inspect.stack()[0][0].f_code.co_name))
+    commits = [run_cmd(['git', 'rev-list', '-n', '1', newer])[0]]
+    logged_commits, filepath_to_commits = log_filepath_to_commits(
+        ['--no-merges', '-w', f'{older}..{newer}'])
+    commits += [x for x in logged_commits if x != commits[0]]
 
     return {
         'filepaths': filepaths,
         'commits': commits,
+        'filepath_to_commits': index_filepath_to_commits(
+            commits, filepath_to_commits),
         'version_number': newer,
-        'previous_version_number': older
+        'previous_version_number': older,
+        'renames': detect_renames(older, newer)
     }
 
 
-def analyze_changes_in_recent_production_release_diff(n, fp):
+def analyze_changes_in_recent_production_release_diff(n, fp, status=None):
     """
     fp is relative path from here.... but status['filepaths'] is absolute
     :param n:
     :param fp:
+    :param status: already analyzed stage data, analyzed again if not given
     :return:
     """
-    status = analyze__in_recent_production_release(n)
+    if status is None:
+        status = analyze__in_recent_production_release(n)
     if fp.replace('../', '') in status['filepaths']:
         out = run_cmd(
-            'git diff {}..{} {}'.format(status['previous_version_number'],
-                                        status['version_number'],
-                                        fp),
+            ['git', 'diff', '{}..{}'.format(status['previous_version_number'],
+                                            status['version_number']),
+             '--', fp],
             inspect.stack()[0][0].f_code.co_name)
         return '\n'.join(out)
 
 
+def submodule_of(fp):
+    """
+    :return: path of the submodule holding the file or None, the path of
+             the file in it
+    """
+    for path in sorted(submodule_stage_data, key=len, reverse=True):
+        if fp.startswith(path + '/'):
+            return path, fp[len(path) + 1:]
+    return None, fp
+
+
+def analyze_changes_diff(stage_name, main_branch, dev_branch, fp,
+                         status=None):
+    # A row of a renamed file carries its newest path, older stages know it
+    # by one of its previous paths.
+    prefix = '../' if fp.startswith('../') else ''
+    paths = [fp[len(prefix):]] + renamed_from.get(fp[len(prefix):], [])
+    prefetch_diff_blobs([stage_name], main_branch, dev_branch, paths[:1],
+                        {stage_name: status})
+    submodule, _ = submodule_of(paths[0])
+    if submodule is not None:
+        # Diffed inside the submodule against its own stage data.
+        prefix = ''
+        paths = [submodule_of(path)[1] for path in paths]
+        status = submodule_stage_data[submodule].get(stage_name)
+    with in_repo(submodule):
+        for path in paths:
+            out = analyze_changes_diff_of_path(stage_name, main_branch,
+                                               dev_branch, prefix + path,
+                                               status)
+            if out:
+                return out
+    return None
+
+
+def analyze_changes_diff_of_path(stage_name, main_branch, dev_branch, fp,
+                                 status=None):
+    if stage_name == 'untracked':
+        # A diff against /dev/null would show any file as new.
+        if status is not None and \
+                fp.replace('../', '') not in status['filepaths']:
+            return None
+        return analyze_changes_untracked_diff(fp)
+    if stage_name == 'unstaged':
+        return analyze_changes_unstaged_diff(fp)
+    if stage_name == 'staged':
+        return analyze_changes_staged_diff(fp)
+    if stage_name == 'in_commits_but_not_pushed':
+        return analyze_changes_in_commits_but_not_pushed_diff(dev_branch, fp)
+    if stage_name == 'pushed_but_not_merged':
+        return analyze_changes_pushed_but_not_merged_diff(
+            dev_branch, main_branch, fp, status)
+    if stage_name == 'in_merged_prs_not_released':
+        return analyze_changes_in_merged_prs_not_released_diff(
+            main_branch, fp, status)
+    if stage_name == 'in_last_production_release':
+        return analyze_changes_in_recent_production_release_diff(1, fp,
+                                                                 status)
+    if stage_name == 'in_previous_production_release':
+        return analyze_changes_in_recent_production_release_diff(2, fp,
+                                                                 status)
+    if stage_name == 'by_commit_ids' and status is not None:
+        return analyze_changes_in_commits_diff(status['commits'], fp, status)
+    if status is not None and 'diff_range' in status:
+        return analyze_changes_ref_comparison_diff(fp, status)
+    if stage_name in registry.diffs and status is not None:
+        return registry.diffs[stage_name](status, fp)
+    return None
+
+
+def paths_of_row(fp, prefix=''):
+    """
+    Path and earlier paths of a renamed file.
+    :param prefix: submodule path and a slash for files in a submodule
+    """
+    return [fp] + [path[len(prefix):]
+                   for path in renamed_from.get(prefix + fp, [])]
+
+
+def batch_pathspec(filepaths, prefix=''):
+    return [':(top,literal)' + path for fp in filepaths
+            for path in paths_of_row(fp, prefix)]
+
+
+def stage_diff_cmds(stage_name, main_branch, dev_branch, filepaths, status,
+                    prefix=''):
+    """
+    Git commands showing the diffs of many files of a stage, one command
+    per 1000 files.
+    :param prefix: submodule path and a slash for files in a submodule
+    :return: list of argv lists, None when the stage diffs file by file
+    """
+    if stage_name == 'unstaged':
+        base = ['git', 'diff']
+    elif stage_name == 'staged':
+        base = ['git', 'diff', '--cached']
+    elif stage_name == 'in_commits_but_not_pushed':
+        base = ['git', 'diff', f'origin/{dev_branch}..HEAD']
+    elif stage_name in ('pushed_but_not_merged', 'by_commit_ids'):
+        positions = set()
+        for fp in filepaths:
+            for path in paths_of_row(fp, prefix):
+                positions.update(
+                    status.get('filepath_to_commits', {}).get(path, []))
+        if not positions:
+            return []
+        base = ['git', 'show'] + [status['commits'][i]
+                                  for i in sorted(positions)]
+    elif stage_name == 'in_merged_prs_not_released':
+        base = ['git', 'diff',
+                f"{status['latest_version_tag']}..upstream/{main_branch}"]
+    elif 'previous_version_number' in status:
+        base = ['git', 'diff', '{}..{}'.format(
+            status['previous_version_number'], status['version_number'])]
+    elif 'diff_range' in status:
+        base = ['git', 'diff', status['diff_range']]
+    else:
+        return None
+    return [base + ['--'] + batch_pathspec(filepaths[i:i + 1000], prefix)
+            for i in range(0, len(filepaths), 1000)]
+
+
+def export_diffs(stage_names, main_branch, dev_branch, filepaths, stage_data,
+                 out):
+    """
+    Writes the diffs of the files in each stage to out, a binary file,
+    as the output of git comes in.
+    """
+    prefetch_diff_blobs(stage_names, main_branch, dev_branch, filepaths,
+                        stage_data)
+    for stage_name in stage_names:
+        in_stage = set(stage_data[stage_name]['filepaths'])
+        stage_filepaths = [fp for fp in filepaths if fp in in_stage]
+        if not stage_filepaths:
+            continue
+        out.write('{}\n'.format(
+            stage_shortnames.get(stage_name, stage_name)).encode())
+        out.flush()
+        by_repo = {}
+        for fp in stage_filepaths:
+            submodule, path = submodule_of(fp)
+            by_repo.setdefault(submodule, []).append(path)
+        for submodule, paths in by_repo.items():
+            status = stage_data[stage_name]
+            prefix = ''
+            if submodule is not None:
+                status = submodule_stage_data[submodule][stage_name]
+                prefix = submodule + '/'
+            with in_repo(submodule):
+                cmds = stage_diff_cmds(stage_name, main_branch, dev_branch,
+                                       paths, status, prefix)
+                if cmds is None:
+                    # Untracked files and custom stages have no batched
+                    # form.
+                    for fp in paths:
+                        # The paths are relative to the top, git runs in
+                        # the working directory unless in a submodule.
+                        if submodule is None:
+                            fp = os.path.relpath(os.path.join(toplevel(),
+                                                              fp))
+                        diff = analyze_changes_diff_of_path(
+                            stage_name, main_branch, dev_branch, fp, status)
+                        if diff:
+                            out.write(diff.encode(errors='surrogateescape')
+                                      + b'\n')
+                for cmd in cmds or []:
+                    stream_cmd(cmd, out,
+                               inspect.stack()[0][0].f_code.co_name)
+                    out.flush()
+        out.write(b'\n')
+
+
+def commits_touching_file(stage, fp):
+    """
+    Lists the commits of a stage which touched the file, newest first.
+    :param stage: stage data as returned by analyze_changes
+    :param fp: file path of the row, renamed rows also match their old paths
+    :return: list of dicts with hash, author, date and subject
+    """
+    commit_ids = []
+    for filepath in [fp] + renamed_from.get(fp, []):
+        commit_ids += stage_commits_of_file(stage, filepath)
+    with in_repo(submodule_of(fp)[0]):
+        return describe_commits(commit_ids)
+
+
+def describe_commits(commit_ids):
+    """
+    :return: list of dicts with hash, author, date and subject
+    """
+    if not commit_ids:
+        return []
+    commits = []
+    for line in run_cmd(['git', 'log', '--no-walk=unsorted', '--date=short',
+                         '--format=format:%h%x00%an%x00%ad%x00%s']
+                        + commit_ids,
+                        inspect.stack()[0][0].f_code.co_name):
+        commits.append(dict(zip(('hash', 'author', 'date', 'subject'),
+                                line.split('\x00'))))
+    return commits
+
+
 def compress_to_suitable_length(x):
     if len(x) > 68:
         return x[0:32] + '..' + x[-32:]
@@ -235,35 +1035,256 @@ def map_filepaths_to_dirpaths_if_needed(pathlist):
     return mapping
 
 
-# noinspection PyDictCreation
-def analyze_changes(main_branch, personal_branch, stage_names, commit_ids=None,
-                    branch=None):
+registry.add_node('version_tags', lambda ctx, i: list_version_tags())
+registry.add_node('worktree_status',
+                  lambda ctx, i: analyze_worktree_status())
+registry.add_stage(
+    'untracked',
+    lambda ctx, i: analyze_changes_untracked(i['worktree_status']),
+    inputs=['worktree_status'])
+registry.add_stage(
+    'unstaged',
+    lambda ctx, i: analyze_changes_unstaged(i['worktree_status']),
+    inputs=['worktree_status'])
+registry.add_stage(
+    'staged',
+    lambda ctx, i: analyze_changes_staged(i['worktree_status']),
+    inputs=['worktree_status'])
+registry.add_stage(
+    'in_commits_but_not_pushed',
+    lambda ctx, i: analyze__in_commits_but_not_pushed(ctx['dev_branch']))
+registry.add_stage(
+    'by_commit_ids',
+    lambda ctx, i: analyze__in_commits(ctx['commit_ids']),
+    enabled=lambda ctx: ctx.get('commit_ids'))
+registry.add_stage(
+    'by_branch',
+    lambda ctx, i: analyze__in_branch(ctx['branch'], ctx['main_branch'],
+                                      'upstream'),
+    enabled=lambda ctx: ctx.get('branch'))
+registry.add_stage(
+    'pushed_but_not_merged',
+    lambda ctx, i: analyze__pushed_but_not_merged(
+        ctx['dev_branch'], ctx['main_branch'],
+        i['in_commits_but_not_pushed']),
+    inputs=['in_commits_but_not_pushed'])
+registry.add_stage(
+    'in_merged_prs_not_released',
+    lambda ctx, i: analyze__in_merged_prs_not_released(
+        ctx['main_branch'], i['version_tags']),
+    inputs=['version_tags'])
+registry.add_stage(
+    'in_last_production_release',
+    lambda ctx, i: analyze__in_recent_production_release(
+        1, i['version_tags']),
+    inputs=['version_tags'])
+registry.add_stage(
+    'in_previous_production_release',
+    lambda ctx, i: analyze__in_recent_production_release(
+        2, i['version_tags']),
+    inputs=['version_tags'])
+
+try:
+    # Custom stages register themselves into stages.registry on import.
+    import customizedstages  # noqa
+except ModuleNotFoundError:
+    pass
+
+
+def submodule_fetch_args():
+    """ Lets git fetch fetch the submodules too, in parallel. """
+    if not recurse_submodules:
+        return []
+    return ['--recurse-submodules=yes', f'--jobs={submodule_jobs}']
+
+
+def list_submodules():
+    """
+    Paths of the checked out submodules relative to the top, nested ones
+    included.
+    """
+    prefix = ''
+    if getattr(repo, 'path', None):
+        prefix = repo.path + '/'
+    paths = []
+    entries = run_cmd_z(['git', 'config', '-z', '--file',
+                         os.path.join(toplevel(), prefix, '.gitmodules'),
+                         '--get-regexp', r'^submodule\..*\.path$'],
+                        inspect.stack()[0][0].f_code.co_name)
+    for entry in entries:
+        path = prefix + entry.split('\n', 1)[1].strip('/')
+        if os.path.exists(os.path.join(toplevel(), path, '.git')):
+            paths.append(path)
+            with in_repo(path):
+                paths += list_submodules()
+    return paths
+
+
+def fetch_remotes(verbose=True):
+    """
+    Fetches origin and upstream, each within fetch_timeout.
+    :return: the fetch commands which timed out
+    """
+    timed_out = []
+    for cmd in (['git', 'fetch'], ['git', 'fetch', 'upstream']):
+        if verbose:
+            print('Running ' + ' '.join(cmd), file=sys.stderr)
+        else:
+            cmd = cmd[:2] + ['-q'] + cmd[2:]
+        try:
+            with utils.deadline(fetch_timeout):
+                # Progress, errors and password prompts of git fetch go to
+                # the terminal.
+                utils.run_process(cmd + submodule_fetch_args(),
+                                  stdout=None, stderr=None, foreground=True)
+        except utils.CommandTimeout:
+            if verbose:
+                print('{} timed out after {}s, using the refs fetched '
+                      'earlier'.format(' '.join(cmd), fetch_timeout),
+                      file=sys.stderr)
+            timed_out.append(cmd)
+    return timed_out
+
+
+def timed_out_stage():
+    return {'filepaths': [], 'commits': [], 'timed_out': True}
+
+
+def resolve_stages(context, stage_names, cancel=None,
+                   tolerate_errors=False):
+    """
+    Runs the stages each within git_timeout. A stage which takes longer is
+    left empty and marked with 'timed_out', the others are still shown.
+    :param tolerate_errors: leave a stage which fails empty instead of
+                            failing all of them
+    :raise utils.CommandCancelled: cancel was set
+    """
+    scheduler = StageScheduler(registry, context)
     stage_data = {}
-    stage_data['unstaged'] = analyze_changes_unstaged()
-    stage_data['staged'] = analyze_changes_staged()
-    stage_data[
-        'in_commits_but_not_pushed'] = analyze__in_commits_but_not_pushed(
-        personal_branch)
-    if commit_ids:
-        stage_data['by_commit_ids'] = analyze__in_commits(commit_ids)
-    if branch:
-        stage_data['by_branch'] = analyze__in_branch(branch, main_branch,
-                                                     'upstream')
-    stage_data['pushed_but_not_merged'] = analyze__pushed_but_not_merged(
-        personal_branch, main_branch)
-    stage_data[
-        'in_merged_prs_not_released'] = analyze__in_merged_prs_not_released(
-        main_branch)
-    stage_data['in_last_production_release'] = \
-        analyze__in_recent_production_release(1)
-    stage_data['in_previous_production_release'] = \
-        analyze__in_recent_production_release(2)
+    for stage_name in stage_names:
+        try:
+            with git_deadline(cancel):
+                stage_data[stage_name] = scheduler.resolve(stage_name)
+        except utils.CommandTimeout:
+            stage_data[stage_name] = timed_out_stage()
+        except utils.CommandCancelled:
+            raise
+        except Exception:
+            if not tolerate_errors:
+                raise
+            stage_data[stage_name] = {'filepaths': [], 'commits': []}
+    return stage_data
+
+
+def analyze_submodule(path, context, stage_names, cancel=None):
+    with in_repo(path):
+        # e.g. without an upstream remote or version tags, the other stages
+        # of the submodule are still shown.
+        return resolve_stages(context, stage_names, cancel,
+                              tolerate_errors=True)
+
+
+def merge_submodule_stages(stage_data, path, submodule_data):
+    """
+    Adds the files and commits of a submodule to the stages, with paths
+    prefixed by the submodule path.
+    """
+    prefix = path + '/'
+    for stage_name, v in stage_data.items():
+        sub = submodule_data.get(stage_name)
+        if sub and sub.get('timed_out'):
+            v['timed_out'] = True
+        if not sub or not sub['filepaths']:
+            continue
+        offset = len(v.get('commits', []))
+        v['filepaths'] = v['filepaths'] + [prefix + fp
+                                           for fp in sub['filepaths']]
+        v['commits'] = v.get('commits', []) + sub.get('commits', [])
+        filepath_to_commits = dict(v.get('filepath_to_commits', {}))
+        for fp, positions in sub.get('filepath_to_commits', {}).items():
+            filepath_to_commits[prefix + fp] = [p + offset
+                                                for p in positions]
+        v['filepath_to_commits'] = filepath_to_commits
+        if sub.get('renames'):
+            renames = dict(v.get('renames', {}))
+            for old, new in sub['renames'].items():
+                renames[prefix + old] = prefix + new
+            v['renames'] = renames
+
+
+def publish_analysis(previous_paths, submodule_data):
+    """
+    Makes the renames and submodule stages of a finished refresh the ones
+    diffs are looked up with. The dicts are replaced, never updated, as
+    other threads read them while the next refresh runs.
+    """
+    global renamed_from, submodule_stage_data
+    renamed_from, submodule_stage_data = previous_paths, submodule_data
+
+
+def analyze_changes(main_branch, personal_branch, stage_names, commit_ids=None,
+                    branch=None, cancel=None, comparisons=()):
+    """
+    :param cancel: threading.Event, once set the git commands running are
+                   stopped and utils.CommandCancelled is raised
+    :param comparisons: refs or ranges added as columns after the stages
+    """
+    context = {
+        'main_branch': main_branch,
+        'dev_branch': personal_branch,
+        'commit_ids': commit_ids,
+        'branch': branch,
+    }
+    enabled_stages = registry.enabled_stages(context)
+    # Custom stages become columns after the built-in ones.
+    stage_names = list(stage_names) + [
+        s for s in enabled_stages
+        if s not in stage_names and s not in ('by_commit_ids', 'by_branch')]
+    compared = comparison_stages(comparisons)
+    stage_names += compared
+    submodules = list_submodules() if recurse_submodules else []
+    with ThreadPoolExecutor(max_workers=max(1, submodule_jobs)) as pool:
+        futures = [(path, pool.submit(analyze_submodule, path, context,
+                                      enabled_stages, cancel))
+                   for path in submodules]
+        stage_data = resolve_stages(context, enabled_stages + compared,
+                                    cancel)
+        submodule_data = {path: future.result() for path, future in futures}
+    for path in submodules:
+        merge_submodule_stages(stage_data, path, submodule_data[path])
+    if submodules:
+        # The gitlink entries are replaced by the files changed inside.
+        for k, v in stage_data.items():
+            v['filepaths'] = [fp for fp in v['filepaths']
+                              if fp not in submodule_data]
 
     all_files = set()
     for k, v in stage_data.items():
         for filepath in v['filepaths']:
             all_files.add(filepath)
 
+    previous_paths = {}
+    if find_renames:
+        renames = {}
+        for k, v in stage_data.items():
+            renames.update(v.get('renames', {}))
+        rename_mapping = link_renamed_paths(renames)
+        for old, new in rename_mapping.items():
+            previous_paths.setdefault(new, []).append(old)
+        for k, v in stage_data.items():
+            linked = []
+            seen = set()
+            for filepath in v['filepaths']:
+                filepath = rename_mapping.get(filepath, filepath)
+                if filepath not in seen:
+                    seen.add(filepath)
+                    linked.append(filepath)
+            v['filepaths'] = linked
+
+    if path_scope is not None:
+        for k, v in stage_data.items():
+            v['filepaths'] = path_scope.filter(v['filepaths'])
+
     map_to_dirpaths = False
     if map_to_dirpaths:
         mapping_to_dirpaths = map_filepaths_to_dirpaths_if_needed(all_files)
@@ -286,4 +1307,5 @@ def analyze_changes(main_branch, personal_branch, stage_names, commit_ids=None,
         for filepath in v['filepaths']:
             filepaths.add(filepath)
     filepaths = sorted(filepaths)
+    publish_analysis(previous_paths, submodule_data)
     return stage_names, stage_data, filepaths
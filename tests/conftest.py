@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The modules are run from src/ and import each other by their plain names.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+class Repo:
+    def __init__(self, top):
+        self.top = top
+
+    def git(self, *args, check=True):
+        return subprocess.run(('git',) + args, cwd=self.top, check=check,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True).stdout
+
+    def write(self, fp, text=''):
+        path = os.path.join(self.top, fp)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def commit(self, message, files=None):
+        """
+        :param files: dict of file path -> text written and committed
+        :return: id of the commit
+        """
+        for fp, text in (files or {}).items():
+            self.write(fp, text)
+            self.git('add', '--', fp)
+        self.git('commit', '-q', '--allow-empty', '-m', message)
+        return self.git('rev-parse', 'HEAD').strip()
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """
+    Repository with the working directory in its src subdirectory, the
+    layout gitradar is run in (--dir one level below the top).
+    """
+    for role in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv(f'GIT_{role}_NAME', 'A')
+        monkeypatch.setenv(f'GIT_{role}_EMAIL', 'a@example.com')
+    monkeypatch.setenv('GIT_CONFIG_GLOBAL', os.devnull)
+    monkeypatch.setenv('GIT_CONFIG_NOSYSTEM', '1')
+    top = tmp_path / 'repo'
+    (top / 'src').mkdir(parents=True)
+    repo = Repo(str(top))
+    repo.git('init', '-q')
+    repo.commit('initial', {'src/main.py': 'print()\n'})
+    monkeypatch.chdir(top / 'src')
+    return repo
+
+
+@pytest.fixture
+def radar_repo(repo, tmp_path):
+    """
+    The repository with the remotes, branches and release tags the built-in
+    stages compare: origin and upstream in a bare repository reached by a
+    file:// URL, main, master and dev branches there and three version tags.
+    """
+    for version in ('1.0.0', '1.1.0', '1.2.0'):
+        repo.commit(version, {'src/lib.py': version + '\n'})
+        repo.git('tag', 'v' + version)
+    remote = tmp_path / 'remote.git'
+    repo.git('init', '-q', '--bare', str(remote))
+    for name in ('origin', 'upstream'):
+        repo.git('remote', 'add', name, remote.as_uri())
+    # gitradar itself compares with master, the tests pass main.
+    repo.git('push', '-q', 'origin', 'HEAD:refs/heads/main',
+             'HEAD:refs/heads/master', 'HEAD:refs/heads/dev', '--tags')
+    repo.git('fetch', '-q', '--all')
+    repo.remote = str(remote)
+    return repo
@@ -0,0 +1,90 @@
+import threading
+import time
+
+from diffprefetch import DiffCache, DiffPrefetcher
+
+
+def test_get_missing():
+    assert DiffCache(100).get('a') is None
+
+
+def test_evicts_least_recently_used():
+    cache = DiffCache(10)
+    cache.put('a', 'aaaa')
+    cache.put('b', 'bbbb')
+    # Reading a makes b the least recently used entry.
+    assert cache.get('a') == 'aaaa'
+    cache.put('c', 'cccc')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'aaaa'
+    assert cache.get('c') == 'cccc'
+    assert cache.size == 8
+
+
+def test_bounded_by_encoded_bytes():
+    cache = DiffCache(4)
+    cache.put('a', 'éé')
+    cache.put('b', 'x')
+    # 'éé' takes 4 bytes, adding a fifth evicts it.
+    assert cache.get('a') is None
+    assert cache.size == 1
+
+
+def test_replacing_a_key_updates_the_size():
+    cache = DiffCache(10)
+    cache.put('a', 'aaaaaaaa')
+    cache.put('a', 'aa')
+    cache.put('b', 'bbbbbbbb')
+    assert cache.get('a') == 'aa'
+    assert cache.size == 10
+
+
+def test_value_larger_than_the_cache_is_not_stored():
+    cache = DiffCache(4)
+    cache.put('a', 'aaa')
+    cache.put('b', 'bbbbb')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'aaa'
+
+
+def test_clear():
+    cache = DiffCache(10)
+    cache.put('a', 'aaa')
+    cache.clear()
+    assert cache.get('a') is None
+    assert cache.size == 0
+
+
+def test_undecodable_bytes_in_a_diff():
+    # As decoded by utils.run_cmd from a file which is not UTF-8.
+    diff = b'+caf\xe9\n'.decode(errors='surrogateescape')
+    cache = DiffCache(10)
+    cache.put('a', diff)
+    assert cache.get('a') == diff
+    assert cache.size == 6
+    cache.put('a', diff + diff)
+    cache.put('b', diff)
+    assert cache.get('a') is None
+    assert cache.get('b') == diff
+    assert cache.size == 6
+
+
+def test_prefetching_goes_on_after_a_failure(caplog):
+    done = threading.Event()
+
+    def fetch(fp, is_wanted, cancel):
+        if fp == 'bad':
+            raise ValueError('no diff')
+        done.set()
+        return 'diff of ' + fp
+
+    prefetcher = DiffPrefetcher(fetch, 100)
+    prefetcher.focus(['bad', 'good'])
+    assert done.wait(5)
+    for _ in range(100):
+        if prefetcher.get('good') is not None:
+            break
+        time.sleep(0.01)
+    assert prefetcher.get('good') == 'diff of good'
+    assert prefetcher.get('bad') is None
+    assert 'Prefetching the diff of bad failed' in caplog.text
@@ -0,0 +1,81 @@
+import http.server
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import environmentindex
+
+
+class VersionHandler(http.server.BaseHTTPRequestHandler):
+    """ /<env> answers the version of env, /slow only after a while. """
+
+    versions = {'test': '1.1.0', 'prod': '{"version": "1.0.0"}', 'slow': '2.0'}
+
+    def do_GET(self):
+        env = self.path.strip('/')
+        if env == 'slow':
+            time.sleep(2)
+        body = self.versions.get(env)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def env_url(monkeypatch):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), VersionHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    providers = environmentindex.ProviderRegistry()
+    monkeypatch.setattr(environmentindex, 'providers', providers)
+    url = 'http://127.0.0.1:%d/{env}' % server.server_address[1]
+    providers.add_provider('url', environmentindex.http_provider(url))
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_provider_reads_text_and_json(env_url):
+    fetch = environmentindex.http_provider(env_url)
+    assert fetch('test') == '1.1.0'
+    assert fetch('prod') == '1.0.0'
+
+
+def test_environments_are_queried_at_the_same_time(env_url):
+    started = time.monotonic()
+    versions = environmentindex.query_environments(
+        ['test', 'prod', 'missing', 'slow', 'slow'], timeout=1)
+    # Neither the unknown nor the slow environment holds up the others.
+    assert time.monotonic() - started < 1.9
+    assert versions == {'test': '1.1.0', 'prod': '1.0.0'}
+
+
+def test_versions_are_cached_in_the_git_directory(repo, env_url,
+                                                  monkeypatch):
+    versions = environmentindex.build__environment__version(
+        ['test', 'prod'], lambda version: 'v' + version)
+    assert versions == {'test': 'v1.1.0', 'prod': 'v1.0.0'}
+    path = os.path.join(repo.top, '.git', environmentindex.DEFAULT_CACHE_NAME)
+    with open(path) as f:
+        assert {env: entry[0] for env, entry in json.load(f).items()} == {
+            'test': '1.1.0', 'prod': '1.0.0'}
+    # Within the ttl the server is not asked again.
+    monkeypatch.setattr(VersionHandler, 'versions', {'test': '1.2.0'})
+    assert environmentindex.build__environment__version(
+        ['test'], lambda version: version) == {'test': '1.1.0'}
+    monkeypatch.setattr(environmentindex, 'cache_ttl', 0)
+    assert environmentindex.build__environment__version(
+        ['test'], lambda version: version) == {'test': '1.2.0'}
+    # An outdated environment which no longer answers keeps its version.
+    monkeypatch.setattr(VersionHandler, 'versions', {})
+    assert environmentindex.build__environment__version(
+        ['test'], lambda version: version) == {'test': '1.2.0'}
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+GITRADAR = os.path.join(os.path.dirname(__file__), '..', 'src',
+                        'gitradar.py')
+
+
+def gitradar(*args, env=None):
+    process = subprocess.run(
+        [sys.executable, GITRADAR, '--dir=.'] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env)
+    assert process.returncode == 0, process.stderr
+    return process.stdout
+
+
+def test_snapshot_browsed_without_git(radar_repo, tmp_path):
+    radar_repo.write('src/main.py', 'print(2)\n')
+    snapshot = str(tmp_path / 'radar.grs')
+    gitradar('--export-snapshot=' + snapshot)
+    no_git = dict(os.environ, PATH=str(tmp_path / 'empty'))
+    out = gitradar('--snapshot=' + snapshot, '--headless', env=no_git)
+    assert 'src/main.py' in out
+
+
+def test_negative_frame_rate_is_rejected():
+    process = subprocess.run(
+        [sys.executable, GITRADAR, '--minimal-redraw', '--max-fps=-1'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    assert process.returncode == 2
+    assert '--max-fps must be 0 or more' in process.stderr
@@ -0,0 +1,79 @@
+import os
+import select
+
+import pytest
+
+pytest.importorskip('urwid')
+datatable = pytest.importorskip('panwid.datatable')
+
+import workspaceindex  # noqa: E402
+from gitradartable import GitRadarTable  # noqa: E402
+
+STAGES = ['untracked', 'unstaged', 'staged']
+
+
+class Loop:
+    """ The part of urwid.MainLoop the table uses to hear from threads. """
+
+    def __init__(self):
+        self.watched = {}
+
+    def watch_pipe(self, callback):
+        read_fd, write_fd = os.pipe()
+        self.watched[read_fd] = callback
+        return write_fd
+
+    def run_once(self, timeout=30):
+        ready, _, _ = select.select(list(self.watched), [], [], timeout)
+        assert ready, 'nothing was written to the watched pipes'
+        for read_fd in ready:
+            data = os.read(read_fd, 1024)
+            if self.watched[read_fd](data) is False:
+                del self.watched[read_fd]
+                os.close(read_fd)
+
+
+class Parent:
+    def __init__(self):
+        self.loop = Loop()
+
+
+def table(analysis):
+    columns = [datatable.DataTableColumn(name, width=10)
+               for name in ['file', 'marked'] + STAGES]
+    return GitRadarTable(columns, Parent(), ('main', 'dev', STAGES, {}), 33,
+                         index='uniqueid', analysis=analysis,
+                         diff_cache_bytes=0)
+
+
+def test_added_comparison_rows_are_complete(radar_repo):
+    branch = radar_repo.git('branch', '--show-current').strip()
+    radar_repo.git('checkout', '-q', '-b', 'feature')
+    radar_repo.commit('feature', {'src/feature.py': ''})
+    radar_repo.git('checkout', '-q', branch)
+    t = table(workspaceindex.analyze_changes('main', 'dev', STAGES))
+    assert 'src/feature.py' not in t.rows_by_file
+    t.marked.add('src/feature.py')
+    t.patch_stage('compare:feature',
+                  workspaceindex.analyze__ref_comparison('feature'))
+    row = t.rows_by_file['src/feature.py']
+    # Built like the rows of the analysis, marks and colors included.
+    assert set(t.query_data[0]) == set(row)
+    assert row['marked'] == '*'
+    assert row['compare:feature'] == 'x'
+    assert row['unstaged'] == ' '
+
+
+def test_reload_analyzes_in_the_background(radar_repo):
+    t = table(workspaceindex.analyze_changes('main', 'dev', STAGES))
+    t.patch_stage('compare:v1.1.0..HEAD',
+                  workspaceindex.analyze__ref_comparison('v1.1.0..HEAD'))
+    radar_repo.write('src/new.py')
+    t.reload()
+    # Shown unchanged until the main loop hears the analysis is done.
+    assert 'src/new.py' not in t.rows_by_file
+    t.parent.loop.run_once()
+    assert not t.reloading
+    assert t.rows_by_file['src/new.py']['untracked'] == 'x'
+    assert t.rows_by_file['src/lib.py']['compare:v1.1.0..HEAD'] == 'x'
+    assert t.stage_names[-1] == 'compare:v1.1.0..HEAD'
@@ -0,0 +1,51 @@
+import os
+import queue
+
+import ownership
+import utils
+
+
+def commit_lines(repo):
+    repo.commit('a', {'src/lib.py': '1\n2\n3\n'})
+    repo.write('src/lib.py', '1\n2\n3\n4\n')
+    repo.git('commit', '-q', '-a', '-m', 'b', '--author=B <b@example.com>')
+
+
+def test_top_author_from_a_subdirectory(repo):
+    commit_lines(repo)
+    top = utils.git_toplevel()
+    assert ownership.top_author('src/lib.py', top) == ('A', 0.75)
+    assert ownership.top_author('src/missing.py', top) is None
+
+
+def test_blob_ids_from_a_subdirectory(repo):
+    blobs = ownership.blob_ids(['src/main.py', 'src/new.py'],
+                               utils.git_toplevel())
+    assert blobs == {'src/main.py': repo.git('rev-parse',
+                                             'HEAD:src/main.py').strip()}
+
+
+def test_resolver_caches_owners_in_the_git_directory(repo):
+    commit_lines(repo)
+    owners = queue.Queue()
+    resolver = ownership.OwnershipResolver(
+        lambda fp, owner: owners.put((fp, owner)), workers=1)
+    resolver.request(['src/lib.py', 'src/untracked.py'])
+    assert owners.get(timeout=10) == ('src/lib.py', ('A', 0.75))
+    assert owners.get(timeout=10) == ('src/untracked.py', None)
+    assert os.path.exists(os.path.join(repo.top, '.git',
+                                       ownership.DEFAULT_DB_NAME))
+    blob = repo.git('rev-parse', 'HEAD:src/lib.py').strip()
+    assert resolver.cache.get('src/lib.py', blob) == ('A', 0.75)
+
+
+def test_cache_of_undecodable_names(tmp_path):
+    odd = b'caf\xe9.py'.decode(errors='surrogateescape')
+    author = b'Jos\xe9'.decode(errors='surrogateescape')
+    cache = ownership.OwnerCache(str(tmp_path / 'owners.db'))
+    cache.put(odd, 'b' * 40, (author, 0.5))
+    cache.put('a.py', 'b' * 40, ('A', 1.0))
+    assert cache.get(odd, 'b' * 40) == (author, 0.5)
+    assert cache.get('a.py', 'b' * 40) == ('A', 1.0)
+    assert cache.get(odd, 'c' * 40) is None
+    cache.close()
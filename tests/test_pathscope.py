@@ -0,0 +1,35 @@
+import utils
+from pathscope import IGNORE_FILE, PathScope, build_path_scope, \
+    gitignore_to_globs
+
+
+def test_gitignore_to_globs():
+    assert gitignore_to_globs('*.min.js') == ['**/*.min.js',
+                                              '**/*.min.js/**']
+    assert gitignore_to_globs('vendor/') == ['**/vendor/**']
+    assert gitignore_to_globs('/build') == ['build', 'build/**']
+
+
+def test_matches_paths_and_excludes():
+    scope = PathScope(['src/'], ['*.min.js', 'vendor/'])
+    assert scope.filter(['src/a.py', 'src/b.min.js', 'src/vendor/c.py',
+                         'docs/d.md', 'srcx/e.py']) == ['src/a.py']
+
+
+def test_pathspec_args():
+    assert PathScope(['src'], ['/build']).pathspec_args() == [
+        ':(top)src', ':(top,exclude,glob)build',
+        ':(top,exclude,glob)build/**']
+    # Exclusions alone still cover the whole repository.
+    assert PathScope([], ['/build']).pathspec_args()[0] == ':(top)'
+
+
+def test_whole_repository_in_scope(repo):
+    assert build_path_scope([], [], top=utils.git_toplevel()) is None
+
+
+def test_ignore_file_read_from_the_top_in_a_subdirectory(repo):
+    repo.write(IGNORE_FILE, '# generated\nvendor/\n!keep\n')
+    scope = build_path_scope([], [], top=utils.git_toplevel())
+    assert scope.excludes == ['**/vendor/**']
+    assert not scope.matches('src/vendor/lib.py')
@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+import workspaceindex
+from radardaemon import RadarClient, RadarServer, RadarState
+
+
+@pytest.fixture
+def daemon(radar_repo, tmp_path):
+    state = RadarState('main', 'dev', ['untracked', 'unstaged', 'staged'],
+                       fetch=False)
+    server = RadarServer(str(tmp_path / 'radar.sock'), state)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = RadarClient(str(tmp_path / 'radar.sock'))
+    yield state, client
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_failures_are_answered(daemon):
+    state, client = daemon
+    # Asked for a diff before the first refresh, the lookup of the stage in
+    # the missing snapshot fails.
+    with pytest.raises(RuntimeError):
+        client.diff('unstaged', 'src/main.py')
+    with pytest.raises(RuntimeError, match='Unknown op'):
+        client.request('nope')
+    assert client.request('ping') == {'generation': 0}
+
+
+def test_refresh_and_diff(daemon, radar_repo):
+    state, client = daemon
+    radar_repo.write('src/main.py', 'print(2)\n')
+    assert client.refresh() == {'generation': 1}
+    stage_names, stage_data, filepaths = client.analyze_changes()
+    assert stage_data['unstaged']['filepaths'] == ['src/main.py']
+    assert '+print(2)' in client.diff('unstaged', '../src/main.py')
+
+
+def test_refresh_replaces_the_shared_lookups(radar_repo, monkeypatch):
+    previous = {'src/new.py': ['src/old.py']}
+    monkeypatch.setattr(workspaceindex, 'renamed_from', previous)
+    monkeypatch.setattr(workspaceindex, 'find_renames', True)
+    workspaceindex.analyze_changes('main', 'dev', ['unstaged'])
+    # Readers holding the dict of the previous refresh see it unchanged.
+    assert previous == {'src/new.py': ['src/old.py']}
+    assert workspaceindex.renamed_from == {}
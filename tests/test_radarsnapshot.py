@@ -0,0 +1,105 @@
+import pytest
+
+from radarsnapshot import RadarSnapshot, write_snapshot
+
+C1, C2, C3 = ('1' * 40, '2' * 40, '3' * 40)
+# An undecodable byte in a path, as read from git with surrogateescape.
+ODD = 'src/caf\udce9.py'
+
+
+def analysis():
+    stage_names = ['unstaged', 'in_commits_but_not_pushed']
+    stage_data = {
+        'unstaged': {'filepaths': ['b.py'], 'commits': [],
+                     'filepath_to_commits': {}},
+        'in_commits_but_not_pushed': {
+            'filepaths': ['a.py', ODD],
+            'commits': [C3, C2, C1],
+            'filepath_to_commits': {'a.py': [0, 2], ODD: [1]},
+            'timed_out': False,
+        },
+    }
+    return stage_names, stage_data, ['b.py', ODD, 'a.py']
+
+
+def describe(commit_ids):
+    return [dict(hash=c[:7], author='A', date='today', subject=f's{c[0]}')
+            for c in commit_ids]
+
+
+def diff(stage_name, fp):
+    return f'{stage_name}:{fp}'
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    path = str(tmp_path / 'radar.snap')
+    write_snapshot(path, *analysis(), labels={'unstaged': 'unstaged'},
+                   scores=[0.5, 2.0, 1.0], describe_fn=describe,
+                   diff_fn=diff)
+    snapshot = RadarSnapshot(path)
+    yield snapshot
+    snapshot.close()
+
+
+def test_round_trip(snapshot):
+    stage_names, stage_data, filepaths = analysis()
+    assert snapshot.to_analysis() == (stage_names, stage_data,
+                                      sorted(filepaths))
+    assert snapshot.labels == {'unstaged': 'unstaged'}
+
+
+def test_rows(snapshot):
+    i = snapshot.index_of('a.py')
+    assert snapshot.row(i) == dict(
+        uniqueid=i, file='a.py', score=1.0, commits=2, unstaged=' ',
+        in_commits_but_not_pushed='x')
+    assert snapshot.index_of('missing.py') is None
+    assert [snapshot.filepath(i) for i in snapshot.order_by('score')] == [
+        'b.py', 'a.py', ODD]
+    assert [snapshot.filepath(i) for i in snapshot.order_by('unstaged')][
+        0] == 'b.py'
+
+
+def test_commits_and_diffs(snapshot):
+    i = snapshot.index_of('a.py')
+    assert snapshot.commits_of('in_commits_but_not_pushed', i) == [
+        dict(hash=C3[:7], author='A', date='today', subject='s3'),
+        dict(hash=C1[:7], author='A', date='today', subject='s1')]
+    assert snapshot.diff('in_commits_but_not_pushed', i) == \
+        'in_commits_but_not_pushed:a.py'
+    # Files get no diff for stages they are not in.
+    assert snapshot.diff('unstaged', i) is None
+
+
+def test_without_optional_sections(tmp_path):
+    path = str(tmp_path / 'radar.snap')
+    write_snapshot(path, *analysis())
+    snapshot = RadarSnapshot(path)
+    i = snapshot.index_of(ODD)
+    assert not snapshot.has_diffs
+    assert snapshot.score(i) is None
+    assert snapshot.commits_of('in_commits_but_not_pushed', i) == [
+        dict(hash=C2[:7])]
+    snapshot.close()
+
+
+def test_not_a_snapshot(tmp_path):
+    path = tmp_path / 'other'
+    path.write_bytes(b'x' * 64)
+    with pytest.raises(ValueError):
+        RadarSnapshot(str(path))
+
+
+def test_sha256_commit_ids(tmp_path):
+    path = str(tmp_path / 'radar.snap')
+    commits = ['a' * 64, 'b' * 64]
+    write_snapshot(path, ['in_commits_but_not_pushed'], {
+        'in_commits_but_not_pushed': {
+            'filepaths': ['a.py'], 'commits': commits,
+            'filepath_to_commits': {'a.py': [1]}}}, ['a.py'])
+    snapshot = RadarSnapshot(path)
+    stage_names, stage_data, filepaths = snapshot.to_analysis()
+    assert stage_data['in_commits_but_not_pushed']['commits'] == commits
+    assert snapshot.commit_id(0, 1) == 'b' * 64
+    snapshot.close()
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+import snapshotstore
+from snapshotstore import SnapshotStore
+
+WEEK = 7 * 24 * 3600
+NOW = 1700000000.0
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'history.db'))
+    yield store
+    store.close()
+
+
+def stages(**filepaths):
+    return list(filepaths), {name: {'filepaths': fps}
+                             for name, fps in filepaths.items()}
+
+
+def test_record_stores_stages_as_bitmasks(store):
+    run_id = store.record(*stages(unstaged=['a.py', 'b.py'],
+                                  staged=['b.py']), created_at=NOW)
+    masks = dict(store.db.execute(
+        'SELECT paths.path, run_paths.mask FROM run_paths '
+        'JOIN paths ON paths.id = run_paths.path_id WHERE run_id = ?',
+        (run_id,)))
+    assert masks == {'a.py': 0b01, 'b.py': 0b11}
+
+
+def test_hotspots_count_distinct_weeks(store):
+    for weeks_ago, filepaths in ((3, ['a.py', 'b.py']), (2, ['a.py']),
+                                 (1, ['a.py', 'b.py']), (1, ['b.py'])):
+        store.record(*stages(unstaged=filepaths),
+                     created_at=NOW - weeks_ago * WEEK)
+    assert store.hotspots('unstaged', 2, 4, now=NOW) == [('a.py', 3),
+                                                         ('b.py', 2)]
+    assert store.hotspots('unstaged', 3, 4, now=NOW) == [('a.py', 3)]
+    # Older runs are out of the window.
+    assert store.hotspots('unstaged', 2, 1, now=NOW) == []
+    assert store.hotspots('staged', 1, 4, now=NOW) == []
+    assert store.presence_counts(4, now=NOW) == {'a.py': 3, 'b.py': 3}
+
+
+def test_reopened_store_keeps_ids(tmp_path):
+    path = str(tmp_path / 'history.db')
+    store = SnapshotStore(path)
+    store.record(*stages(unstaged=['a.py']), created_at=NOW)
+    store.close()
+    store = SnapshotStore(path)
+    store.record(*stages(staged=['a.py'], unstaged=['a.py']),
+                 created_at=NOW)
+    assert store.presence_counts(1, now=NOW) == {'a.py': 2}
+    assert store.db.execute('SELECT COUNT(*) FROM paths').fetchone() == (1,)
+    store.close()
+
+
+def test_too_many_stages(store):
+    names = [f's{i}' for i in range(snapshotstore.MAX_STAGES + 1)]
+    with pytest.raises(ValueError):
+        store.record(names, {name: {'filepaths': []} for name in names})
+
+
+def test_default_db_in_the_git_directory(repo):
+    store = SnapshotStore()
+    store.close()
+    assert os.path.exists(os.path.join(repo.top, '.git',
+                                       snapshotstore.DEFAULT_DB_NAME))
+
+
+def test_default_db_in_a_worktree(repo, monkeypatch):
+    worktree = os.path.join(os.path.dirname(repo.top), 'wt')
+    repo.git('worktree', 'add', '-q', worktree)
+    monkeypatch.chdir(os.path.join(worktree, 'src'))
+    assert snapshotstore.default_db_path() == os.path.join(
+        repo.top, '.git', 'worktrees', 'wt', snapshotstore.DEFAULT_DB_NAME)
+
+
+def test_undecodable_path(store):
+    odd = b'caf\xe9.py'.decode(errors='surrogateescape')
+    store.record(*stages(unstaged=[odd, 'a.py']), created_at=NOW)
+    store.record(*stages(unstaged=[odd]), created_at=NOW - WEEK)
+    assert store.hotspots('unstaged', 2, 4, now=NOW) == [(odd, 2)]
+    assert store.presence_counts(4, now=NOW) == {odd: 2, 'a.py': 1}
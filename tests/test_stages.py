@@ -0,0 +1,63 @@
+import pytest
+
+import stages
+from stages import StageRegistry, StageScheduler
+
+
+@pytest.fixture(autouse=True)
+def shortnames(monkeypatch):
+    # Registering stages names their columns in the module wide dict.
+    monkeypatch.setattr(stages, 'stage_shortnames',
+                        dict(stages.stage_shortnames))
+
+
+def counting_registry():
+    calls = []
+    registry = StageRegistry()
+
+    def node(name, value):
+        def fn(context, inputs):
+            calls.append(name)
+            return (value, context, inputs)
+        return fn
+
+    registry.add_node('tags', node('tags', ['v2', 'v1']))
+    registry.add_stage('prod', node('prod', 'p'), ['tags'])
+    registry.add_stage('prod-1', node('prod-1', 'q'), ['tags'])
+    return registry, calls
+
+
+def test_shared_input_runs_once():
+    registry, calls = counting_registry()
+    results = StageScheduler(registry, 'ctx').run(['prod', 'prod-1'])
+    assert calls == ['tags', 'prod', 'prod-1']
+    tags = (['v2', 'v1'], 'ctx', {})
+    assert results == {'prod': ('p', 'ctx', {'tags': tags}),
+                       'prod-1': ('q', 'ctx', {'tags': tags})}
+
+
+def test_results_memoized_across_runs():
+    registry, calls = counting_registry()
+    scheduler = StageScheduler(registry, None)
+    scheduler.run(['prod'])
+    scheduler.run(['prod', 'prod-1'])
+    assert calls == ['tags', 'prod', 'prod-1']
+
+
+def test_cycle_detected():
+    registry = StageRegistry()
+    registry.add_node('a', lambda context, inputs: None, ['b'])
+    registry.add_node('b', lambda context, inputs: None, ['a'])
+    with pytest.raises(ValueError, match='a -> b -> a'):
+        StageScheduler(registry, None).run(['a'])
+
+
+def test_enabled_stages():
+    registry = StageRegistry()
+    registry.add_stage('always', lambda context, inputs: None)
+    registry.add_stage('with_ids', lambda context, inputs: None,
+                       enabled=lambda context: bool(context['ids']))
+    # Registering a stage again replaces its node, not its column.
+    registry.add_stage('always', lambda context, inputs: 1)
+    assert registry.enabled_stages({'ids': []}) == ['always']
+    assert registry.enabled_stages({'ids': ['x']}) == ['always', 'with_ids']
@@ -0,0 +1,62 @@
+import pytest
+
+urwid = pytest.importorskip('urwid')
+
+from uiredraw import cap_frame_rate, changed_span, row_cells  # noqa: E402
+
+
+def cells(text, attr=None):
+    return row_cells([(attr, None, text.encode())])
+
+
+def test_changed_span():
+    assert changed_span(cells('abcdef'), cells('abcdef')) is None
+    assert changed_span(cells('abcdef'), cells('abXYef')) == (2, 4)
+    assert changed_span(cells('abcdef'), cells('Xbcdef')) == (0, 1)
+    assert changed_span(cells('abcdef'), cells('abcdeX')) == (5, 6)
+
+
+def test_attribute_change_is_a_change():
+    assert changed_span(cells('abc'), cells('abc', 'focus')) == (0, 3)
+
+
+def test_whole_row_when_unknown_or_resized():
+    assert changed_span(None, cells('abc')) == (0, 3)
+    assert changed_span(cells('ab'), cells('abc')) == (0, 3)
+
+
+def test_wide_characters_are_not_split_into_cells():
+    urwid.set_encoding('utf8')
+    assert row_cells([(None, None, '表'.encode())]) is None
+    assert cells('é') == [(None, None, 'é'.encode())]
+
+
+class Loop:
+    def __init__(self):
+        self.alarms = []
+
+    def set_alarm_in(self, seconds, callback):
+        self.alarms.append(seconds)
+        return callback
+
+
+def test_frames_are_capped():
+    frames = []
+    loop = Loop()
+    draw_screen = cap_frame_rate(loop, lambda: frames.append(1), 10)
+    draw_screen()
+    draw_screen()
+    draw_screen()
+    # The later frames wait for one alarm at the end of the interval.
+    assert len(frames) == 1
+    assert len(loop.alarms) == 1 and 0 < loop.alarms[0] <= 0.1
+
+
+def test_no_frame_rate_limit():
+    frames = []
+    loop = Loop()
+    draw_screen = cap_frame_rate(loop, lambda: frames.append(1), 0)
+    draw_screen()
+    draw_screen()
+    assert len(frames) == 2
+    assert loop.alarms == []
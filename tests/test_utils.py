@@ -0,0 +1,30 @@
+import os
+import sys
+import threading
+
+import pytest
+
+import utils
+
+SESSION = [sys.executable, '-c', 'import os; print(os.getsid(0))']
+
+
+def test_foreground_commands_stay_in_the_session():
+    assert int(utils.run_process(SESSION, foreground=True)) == os.getsid(0)
+    assert int(utils.run_process(SESSION)) != os.getsid(0)
+
+
+def test_input_of_a_cancellable_command():
+    # Polled for the cancel event while cat still waits to read more than
+    # a pipe holds.
+    input = b'blob id\n' * 100000
+    with utils.deadline(cancel=threading.Event()):
+        assert utils.run_process('sleep 0.3; cat', input=input) == input
+
+
+def test_cancelled_before_the_input_is_read():
+    cancel = threading.Event()
+    threading.Timer(0.3, cancel.set).start()
+    with pytest.raises(utils.CommandCancelled):
+        with utils.deadline(cancel=cancel):
+            utils.run_process('sleep 10', input=b'blob id\n' * 100000)
@@ -0,0 +1,205 @@
+import threading
+import time
+
+import pytest
+
+import utils
+import workspaceindex
+from pathscope import IGNORE_FILE
+from conftest import Repo
+
+
+def test_ignore_file_is_not_untracked(repo):
+    repo.write(IGNORE_FILE, 'vendor/\n')
+    repo.write('src/new.py')
+    status = workspaceindex.analyze_worktree_status()
+    assert status['untracked'] == ['src/new.py']
+
+
+def test_index_filepath_to_commits():
+    commits = ['c3', 'c2', 'c1']
+    index = workspaceindex.index_filepath_to_commits(
+        commits, {'a.py': ['c3', 'c1'], 'b.py': ['c2', 'other']})
+    assert index == {'a.py': [0, 2], 'b.py': [1]}
+    assert workspaceindex.stage_commits_of_file(
+        {'commits': commits, 'filepath_to_commits': index},
+        'a.py') == ['c3', 'c1']
+
+
+def test_log_filepath_to_commits_reads_nul_delimited_paths(repo):
+    first = repo.git('rev-parse', 'HEAD').strip()
+    second = repo.commit('odd names', {'src/a b.py': '', 'docs/x\ny.md': '',
+                                       'src/main.py': 'print(1)\n'})
+    third = repo.commit('empty')
+    fourth = repo.commit('tab', {'src/t\tü.py': ''})
+    commits, filepath_to_commits = workspaceindex.log_filepath_to_commits(
+        ['HEAD'])
+    assert commits == [fourth, third, second, first]
+    # Paths are relative to the top, not to the working directory.
+    assert filepath_to_commits == {
+        'src/t\tü.py': [fourth],
+        'src/a b.py': [second],
+        'docs/x\ny.md': [second],
+        'src/main.py': [second, first],
+    }
+
+
+def test_worktree_status_from_porcelain_v2(repo):
+    repo.commit('files', {'src/unstaged.py': '', 'src/staged.py': '',
+                          'src/both.py': '', 'src/old name.py': 'x\n'})
+    repo.write('src/unstaged.py', '1\n')
+    repo.write('src/staged.py', '1\n')
+    repo.write('src/both.py', '1\n')
+    repo.git('add', 'src/staged.py', 'src/both.py')
+    repo.write('src/both.py', '2\n')
+    repo.git('mv', 'src/old name.py', 'src/new name.py')
+    repo.write('src/new dir/n.py')
+    status = workspaceindex.analyze_worktree_status()
+    assert sorted(status['unstaged']) == ['src/both.py', 'src/unstaged.py']
+    # The original path following a rename is not an entry of its own.
+    assert sorted(status['staged']) == ['src/both.py', 'src/new name.py',
+                                        'src/staged.py']
+    assert status['untracked'] == ['src/new dir/n.py']
+
+
+def test_worktree_status_of_a_merge_conflict(repo):
+    branch = repo.git('branch', '--show-current').strip()
+    repo.git('checkout', '-q', '-b', 'other')
+    repo.commit('other', {'src/main.py': 'other\n'})
+    repo.git('checkout', '-q', branch)
+    repo.commit('mine', {'src/main.py': 'mine\n'})
+    repo.git('merge', '-q', 'other', check=False)
+    status = workspaceindex.analyze_worktree_status()
+    assert status == {'unstaged': ['src/main.py'], 'staged': [],
+                      'untracked': []}
+
+
+@pytest.mark.parametrize('spec', ['HEAD~1', 'HEAD~1..', '..HEAD',
+                                  'HEAD~1...HEAD'])
+def test_verify_comparison_accepts_commits(repo, spec):
+    repo.commit('second')
+    workspaceindex.verify_comparison(spec)
+
+
+@pytest.mark.parametrize('spec', ['nope', 'HEAD..nope', '--output=x', 'x..'])
+def test_verify_comparison_rejects(repo, spec):
+    with pytest.raises(ValueError):
+        workspaceindex.verify_comparison(spec)
+
+
+def test_diff_blob_sizes(repo):
+    repo.commit('big', {'src/big.bin': 'x' * 100})
+    repo.write('src/big.bin', 'x' * 3000)
+    repo.write('src/new.txt', 'y' * 10)
+    status = workspaceindex.analyze_worktree_status()
+    stage_names = ['untracked', 'unstaged', 'staged']
+    stage_data = {name: {'filepaths': status[name], 'commits': []}
+                  for name in stage_names}
+    # A tracked file gets no size entry of the untracked stage.
+    assert workspaceindex.diff_blob_sizes(
+        stage_names, 'main', 'dev', 'src/big.bin', stage_data) == {
+        'unstaged': (100, 3000)}
+    assert workspaceindex.diff_blob_sizes(
+        stage_names, 'main', 'dev', 'src/new.txt', stage_data) == {
+        'untracked': (None, 10)}
+    assert workspaceindex.size_summary((100, 3000)) == \
+        '100 B -> 2.9 kB (+2.8 kB)'
+
+
+def test_comparisons_are_analyzed_with_the_stages(radar_repo):
+    stage_names, stage_data, filepaths = workspaceindex.analyze_changes(
+        'main', 'dev', ['unstaged'], comparisons=['v1.1.0..HEAD'])
+    assert stage_names[-1] == 'compare:v1.1.0..HEAD'
+    assert stage_data['compare:v1.1.0..HEAD']['filepaths'] == ['src/lib.py']
+    assert 'src/lib.py' in filepaths
+
+
+def test_export_diffs_from_a_subdirectory(repo, tmp_path):
+    repo.write('src/main.py', 'print(2)\n')
+    repo.write('docs/new.md', 'new file\n')
+    status = workspaceindex.analyze_worktree_status()
+    stage_names = ['untracked', 'unstaged']
+    stage_data = {name: {'filepaths': status[name], 'commits': []}
+                  for name in stage_names}
+    with open(tmp_path / 'diffs', 'wb+') as out:
+        workspaceindex.export_diffs(stage_names, 'main', 'dev',
+                                    ['docs/new.md', 'src/main.py'],
+                                    stage_data, out)
+        out.seek(0)
+        text = out.read().decode()
+    assert '+new file' in text
+    assert '+print(2)' in text
+
+
+def test_submodules_from_a_subdirectory(radar_repo, tmp_path, monkeypatch):
+    lib = tmp_path / 'lib'
+    lib.mkdir()
+    radar_repo.git('-C', str(lib), 'init', '-q')
+    radar_repo.git('-C', str(lib), 'commit', '-q', '--allow-empty', '-m',
+                   'initial')
+    (lib / 'lib.c').write_text('int x;\n')
+    radar_repo.git('-C', str(lib), 'add', 'lib.c')
+    radar_repo.git('-C', str(lib), 'commit', '-q', '-m', 'lib')
+    radar_repo.git('-c', 'protocol.file.allow=always', 'submodule', 'add',
+                   '-q', lib.as_uri(), 'vendor/lib')
+    radar_repo.commit('submodule')
+    radar_repo.write('vendor/lib/lib.c', 'int y;\n')
+    assert workspaceindex.list_submodules() == ['vendor/lib']
+    monkeypatch.setattr(workspaceindex, 'recurse_submodules', True)
+    stage_names, stage_data, filepaths = workspaceindex.analyze_changes(
+        'main', 'dev', ['unstaged'])
+    assert stage_data['unstaged']['filepaths'] == ['vendor/lib/lib.c']
+    assert '+int y;' in workspaceindex.analyze_changes_diff(
+        'unstaged', 'main', 'dev', '../vendor/lib/lib.c',
+        stage_data['unstaged'])
+
+
+def test_fetch_from_a_slow_remote_times_out(radar_repo, monkeypatch):
+    # git runs the upload-pack of a file:// remote through the shell.
+    for remote in ('origin', 'upstream'):
+        radar_repo.git('config', f'remote.{remote}.uploadpack',
+                       'sleep 10; git-upload-pack')
+    monkeypatch.setattr(workspaceindex, 'fetch_timeout', 0.5)
+    started = time.monotonic()
+    timed_out = workspaceindex.fetch_remotes(verbose=False)
+    assert time.monotonic() - started < 5
+    assert timed_out == [['git', 'fetch', '-q'],
+                         ['git', 'fetch', '-q', 'upstream']]
+
+
+def test_prefetch_blobs_of_a_partial_clone(radar_repo, tmp_path, monkeypatch):
+    radar_repo.git('-C', radar_repo.remote, 'config', 'uploadpack.allowFilter',
+                   'true')
+    clone = Repo(str(tmp_path / 'clone'))
+    radar_repo.git('clone', '-q', '--filter=blob:none',
+                   'file://' + radar_repo.remote, clone.top)
+    # Slower than the polls for the cancel event.
+    clone.git('config', 'remote.origin.uploadpack',
+              'sleep 0.3; git-upload-pack')
+    monkeypatch.chdir(clone.top + '/src')
+    monkeypatch.setattr(workspaceindex, 'promisor_cache', {})
+    monkeypatch.setattr(workspaceindex, 'fetched_blobs', set())
+
+    def missing():
+        return [line for line in clone.git(
+            'rev-list', '--objects', '--missing=print', 'v1.0.0').split()
+            if line.startswith('?')]
+
+    old_blob = '?' + radar_repo.git('rev-parse', 'v1.0.0:src/lib.py').strip()
+    assert old_blob in missing()
+    stage_data = {'compare:v1.0.0..HEAD':
+                  workspaceindex.analyze__ref_comparison('v1.0.0..HEAD')}
+    with utils.deadline(cancel=threading.Event()):
+        workspaceindex.prefetch_diff_blobs(
+            list(stage_data), 'main', 'dev', ['src/lib.py'], stage_data)
+    assert missing() == []
+
+
+def test_blob_sizes_of_a_cancellable_operation(repo):
+    blob = repo.git('rev-parse', 'HEAD:src/main.py').strip()
+    # More ids than cat-file answers before the first poll for the cancel
+    # event, the remaining input is written on the next polls.
+    absent = ['%040x' % i for i in range(1, 20000)]
+    with utils.deadline(cancel=threading.Event()):
+        sizes = workspaceindex.blob_sizes(absent + [blob])
+    assert sizes == {blob: len('print()\n')}